@@ -79,6 +79,7 @@ from kithara.callbacks import Checkpointer, Profiler
 import jax
 from kithara.utils.gcs_utils import find_cache_root_dir
 from kithara.model import KerasHubModel, MaxTextModel, Model
+from kithara.model.generation import SamplingParams, InferenceEngine, TokenConstraint
 from kithara.distributed import ShardingStrategy, PredefinedShardingStrategy
 
 # Cache JAX compilation to speed up future runs. You should notice
@@ -1,3 +1,4 @@
 from kithara.dataset.dataloader import Dataloader
+from kithara.dataset.prefetcher import DevicePrefetcher
 from kithara.dataset.sft import SFTDataset
 from kithara.dataset.text_completion import TextCompletionDataset
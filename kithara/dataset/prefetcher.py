@@ -0,0 +1,105 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+_END = object()
+
+
+class DevicePrefetcher(Iterator):
+    """Loads batches and transfers them to the devices on a background
+    thread, so that data loading and host-to-device transfers overlap with
+    the computation of the previous steps.
+
+    Attributes:
+        batches: Iterable over host batches, e.g. a Kithara Dataloader.
+        prepare_fn: Converts a host batch into the arrays passed to the
+            model, e.g. global `jax.Array`s sharded across devices.
+        depth: Maximum number of prepared batches waiting to be consumed.
+            Every prepared batch holds device memory, 2 to 4 is usually
+            enough to hide the loading time. With 0, batches are prepared
+            on the calling thread when requested. Defaults to 2.
+
+    Example:
+        ```
+        prefetcher = DevicePrefetcher(dataloader, trainer._prepare_batch_input_for_training)
+        try:
+            for batch in prefetcher:
+                ...
+        finally:
+            prefetcher.close()
+        ```
+    """
+
+    def __init__(
+        self,
+        batches: Iterable[Any],
+        prepare_fn: Callable[[Any], Any],
+        depth: int = 2,
+    ):
+        self.depth = depth
+        self._batches = iter(batches)
+        self._prepare_fn = prepare_fn
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._closed = threading.Event()
+        self._thread = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _put(self, item) -> bool:
+        """Put `item` into the queue, unless the prefetcher is closed."""
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for batch in self._batches:
+                if not self._put(self._prepare_fn(batch)):
+                    return
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+
+    def __next__(self):
+        if self._closed.is_set():
+            raise StopIteration
+        if self._thread is None:
+            return self._prepare_fn(next(self._batches))
+        item = self._queue.get()
+        if item is _END:
+            self._queue.put(_END)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        """Stop the background thread. Batches that were already prepared
+        are discarded, and the prefetcher yields no more batches."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        # Release the device memory of the prepared batches.
+        while not self._queue.empty():
+            self._queue.get_nowait()
@@ -22,7 +22,8 @@ from jax.sharding import Mesh
 from kithara.utils.tree_utils import named_tree_map
 import jax
 import keras
-from typing import Union
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Union
 import numpy as np 
 
 """Util functions for array sharding"""
@@ -75,6 +76,95 @@ def entire_tree_is_sharded(pytree):
     return not tree_reduce(lambda x, y: x or y, tree_map(is_not_sharded, pytree))
 
 
+def sharding_signature(pytree) -> Tuple:
+    """Hashable signature of the (shape, dtype, sharding) of every array in
+    `pytree`. A jitted function is compiled once per input signature."""
+    leaves, treedef = jax.tree_util.tree_flatten(pytree)
+    return treedef, tuple((x.shape, x.dtype, x.sharding) for x in leaves)
+
+
+@dataclass
+class UnshardedArray:
+    """An array that is fully replicated across the devices of its mesh."""
+
+    group: str
+    path: str
+    shape: Tuple[int, ...]
+    dtype: str
+    size_mb: float
+
+
+@dataclass
+class ShardingReport:
+    """Result of `validate_sharding()`.
+
+    Attributes:
+        num_arrays (int): Number of arrays checked.
+        unsharded (List[UnshardedArray]): Unsharded input arrays, and unsharded
+            variables that are larger than the size threshold.
+    """
+
+    num_arrays: int = 0
+    unsharded: List[UnshardedArray] = field(default_factory=list)
+
+    @property
+    def is_sharded(self) -> bool:
+        return not self.unsharded
+
+    def __str__(self):
+        if self.is_sharded:
+            return f"Sharding report: all {self.num_arrays} arrays are sharded."
+        lines = [
+            f"Sharding report: {len(self.unsharded)} of {self.num_arrays} arrays are not sharded."
+        ]
+        for array in self.unsharded:
+            lines.append(
+                f"  {array.group} {array.path}: shape={array.shape} "
+                f"dtype={array.dtype} size={array.size_mb:.1f}mb"
+            )
+        return "\n".join(lines)
+
+
+def validate_sharding(
+    data, variables: Dict[str, Tuple[List[keras.Variable], List[jax.Array]]]
+) -> ShardingReport:
+    """Check that the input data and the variable values are sharded.
+
+    Args:
+        data: Pytree of input arrays. Every input array should be sharded.
+        variables: Maps a group name, e.g. "trainable", to a pair of
+            (Keras variables, values of these variables). Only values larger
+            than 20mb are required to be sharded.
+
+    Returns:
+        ShardingReport: The arrays that are not sharded.
+    """
+    report = ShardingReport()
+
+    def check_data(path, x):
+        report.num_arrays += 1
+        if is_not_sharded(x):
+            report.unsharded.append(
+                UnshardedArray("data", path, x.shape, str(x.dtype), get_size_in_mb(x))
+            )
+
+    named_tree_map(check_data, data, sep="/")
+    for group, (group_variables, values) in variables.items():
+        for variable, value in zip(group_variables, values):
+            report.num_arrays += 1
+            if is_not_sharded_and_is_large(value):
+                report.unsharded.append(
+                    UnshardedArray(
+                        group,
+                        variable.path,
+                        value.shape,
+                        str(value.dtype),
+                        get_size_in_mb(value),
+                    )
+                )
+    return report
+
+
 def get_size_in_mb(jax_array):
     size_in_bytes = np.prod(jax_array.shape) * jax_array.dtype.itemsize
     size_in_mb = size_in_bytes / (1024 * 1024)
@@ -0,0 +1,50 @@
+from kithara.model.generation.decoding import (
+    generate_on_device,
+    prefill_on_device,
+    decode_on_device,
+    init_decode_state,
+    decode_steps_on_device,
+    decode_chunk_on_device,
+)
+from kithara.model.generation.prefix_cache import (
+    PrefixCache,
+    build_prefix_kv_cache,
+    store_prefix_blocks,
+)
+from kithara.model.generation.bucketing import get_bucket_size, next_power_of_two
+from kithara.model.generation.sampling import (
+    SamplingParams,
+    filter_logits,
+    sample_next_tokens,
+)
+from kithara.model.generation.quantization import (
+    QuantizedArray,
+    QUANTIZATION_MODES,
+    quantize_array,
+    dequantize_variables,
+)
+from kithara.model.generation.scoring import (
+    token_log_probs,
+    score_on_device,
+    score_with_prefill_on_device,
+)
+from kithara.model.generation.embedding import (
+    POOLING_MODES,
+    pool_hidden_states,
+    embed_on_device,
+)
+from kithara.model.generation.streaming import IncrementalDetokenizer
+from kithara.model.generation.beam_search import beam_search_on_device
+from kithara.model.generation.constraints import (
+    TokenConstraint,
+    json_schema_to_regex,
+    apply_token_constraint,
+    advance_token_constraint,
+)
+from kithara.model.generation.batch_generation import (
+    ShardWriter,
+    PromptPrefetcher,
+    bucket_prompts,
+)
+from kithara.model.generation.speculative import speculative_generate_on_device
+from kithara.model.generation.engine import InferenceEngine, GenerationResult
@@ -0,0 +1,261 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Host-side helpers of `Model.batch_generate()`.
+
+Prompts are read, tokenized and bucketed by length on a background thread,
+so that the next batches are ready as soon as the device finishes the
+current one. Results are written to numbered shards. A shard file only
+appears once it is complete, so an interrupted run resumes after the last
+shard that was written.
+"""
+
+import itertools
+import json
+import os
+import queue
+import threading
+import numpy as np
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from kithara.utils.gcs_utils import (
+    find_cache_root_dir,
+    list_files_in_gcs,
+    upload_file_to_gcs,
+)
+
+OUTPUT_FORMATS = ("jsonl", "parquet")
+
+
+class ShardWriter:
+    """Writes the results of one host to `output_path`, with one file per
+    shard named `shard-{shard_index:06d}-host-{host_id:04d}.{output_format}`.
+
+    Args:
+        output_path (str): Local directory or "gs://" path. It is created if
+            it does not exist.
+        output_format (str): "jsonl" or "parquet". Defaults to "jsonl".
+        host_id (int): Index of the host writing the shards. Defaults to 0.
+    """
+
+    def __init__(
+        self, output_path: str, output_format: str = "jsonl", host_id: int = 0
+    ):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unsupported output format {output_format}. "
+                f"Supported formats are {list(OUTPUT_FORMATS)}."
+            )
+        self.output_path = output_path
+        self.output_format = output_format
+        self.host_id = host_id
+        self._local_dir = output_path
+        if output_path.startswith("gs://"):
+            self._local_dir = os.path.join(find_cache_root_dir(), "temp_batch_generate")
+        os.makedirs(self._local_dir, exist_ok=True)
+
+    def shard_name(self, shard_index: int) -> str:
+        return f"shard-{shard_index:06d}-host-{self.host_id:04d}.{self.output_format}"
+
+    def num_completed_shards(self) -> int:
+        """Number of consecutive shards of this host written so far,
+        starting from shard 0."""
+        if self.output_path.startswith("gs://"):
+            files = set(list_files_in_gcs(self.output_path))
+        else:
+            files = set(os.listdir(self.output_path))
+        num_shards = 0
+        while self.shard_name(num_shards) in files:
+            num_shards += 1
+        return num_shards
+
+    def write(self, shard_index: int, rows: List[Dict[str, Any]]) -> str:
+        """Write one shard. The file is written under a temporary name and
+        renamed once complete.
+
+        Returns:
+            str: Path of the written shard.
+        """
+        name = self.shard_name(shard_index)
+        local_path = os.path.join(self._local_dir, name)
+        temp_path = local_path + ".tmp"
+        if self.output_format == "jsonl":
+            with open(temp_path, "w") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            pq.write_table(pa.Table.from_pylist(rows), temp_path)
+        os.replace(temp_path, local_path)
+
+        output_path = os.path.join(self.output_path, name)
+        if self.output_path.startswith("gs://"):
+            upload_file_to_gcs(
+                local_path, output_path, remove_local_file_after_upload=True
+            )
+        return output_path
+
+
+def bucket_prompts(
+    prompt_token_ids: List[List[int]], batch_size: int, max_length: int
+) -> List[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """Split prompts into batches of prompts of similar length.
+
+    Args:
+        prompt_token_ids: Token ids of every prompt, at most `max_length`
+            tokens each.
+        batch_size: Number of prompts per batch. The last batch may be
+            smaller.
+        max_length: Length the prompts are right-padded to.
+
+    Returns:
+        list: One tuple per batch, holding the indices of its prompts in
+            `prompt_token_ids` and the model input with 'token_ids' and
+            'padding_mask' of shape [batch, max_length].
+    """
+    lengths = np.array([len(token_ids) for token_ids in prompt_token_ids])
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start : start + batch_size]
+        token_ids = np.zeros((len(indices), max_length), dtype=np.int32)
+        padding_mask = np.zeros((len(indices), max_length), dtype=np.int32)
+        for row, index in enumerate(indices):
+            token_ids[row, : lengths[index]] = prompt_token_ids[index]
+            padding_mask[row, : lengths[index]] = 1
+        batches.append(
+            (indices, {"token_ids": token_ids, "padding_mask": padding_mask})
+        )
+    return batches
+
+
+class PromptPrefetcher(Iterator):
+    """Reads, tokenizes and buckets shards of prompts on a background thread.
+
+    Every shard holds `prompts_per_shard` consecutive rows of `rows`, except
+    for the last shard, which may be smaller. The rows of the first
+    `first_shard` shards are skipped without being processed.
+
+    Args:
+        rows: Iterable over the dataset rows.
+        get_prompt: Returns the prompt string of a row.
+        tokenizer: HuggingFace tokenizer.
+        prompts_per_shard: Number of rows per shard.
+        batch_size: Number of prompts per batch.
+        max_length: Prompts are padded to this length, the total length of
+            the prompt and the generated tokens.
+        first_shard: Index of the first shard to produce. Defaults to 0.
+        depth: Maximum number of shards prepared ahead. Defaults to 2.
+        max_prompt_length: Prompts are truncated to this length, which must
+            be smaller than `max_length` to leave room for generated tokens.
+            Defaults to `max_length // 2`.
+
+    Yields:
+        tuple: (shard index, prompts of the shard, batches of the shard as
+            returned by `bucket_prompts()`, whether each prompt of the shard
+            was truncated)
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Any],
+        get_prompt: Callable[[Any], str],
+        tokenizer,
+        prompts_per_shard: int,
+        batch_size: int,
+        max_length: int,
+        first_shard: int = 0,
+        depth: int = 2,
+        max_prompt_length: Optional[int] = None,
+    ):
+        if max_prompt_length is None:
+            max_prompt_length = max_length // 2
+        if not 0 < max_prompt_length < max_length:
+            raise ValueError(
+                f"max_prompt_length must be between 1 and {max_length - 1}, the "
+                f"max_length minus one, but got {max_prompt_length}."
+            )
+        self._rows = rows
+        self._get_prompt = get_prompt
+        self._tokenizer = tokenizer
+        self._prompts_per_shard = prompts_per_shard
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._max_prompt_length = max_prompt_length
+        self._first_shard = first_shard
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        """Put `item` into the queue, unless the prefetcher is closed."""
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            rows = iter(self._rows)
+            skipped = self._first_shard * self._prompts_per_shard
+            # Consume the rows of completed shards without processing them.
+            for _ in itertools.islice(rows, skipped):
+                pass
+            shard_index = self._first_shard
+            while not self._closed.is_set():
+                shard_rows = list(itertools.islice(rows, self._prompts_per_shard))
+                if not shard_rows:
+                    break
+                prompts = [self._get_prompt(row) for row in shard_rows]
+                # One extra token tells whether the prompt was truncated.
+                prompt_token_ids = self._tokenizer(
+                    prompts, max_length=self._max_prompt_length + 1, truncation=True
+                )["input_ids"]
+                truncated = [
+                    len(token_ids) > self._max_prompt_length
+                    for token_ids in prompt_token_ids
+                ]
+                prompt_token_ids = [
+                    token_ids[: self._max_prompt_length]
+                    for token_ids in prompt_token_ids
+                ]
+                batches = bucket_prompts(
+                    prompt_token_ids, self._batch_size, self._max_length
+                )
+                if not self._put((shard_index, prompts, batches, truncated)):
+                    return
+                shard_index += 1
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is None:
+            self._queue.put(None)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        """Stop the background thread."""
+        self._closed.set()
@@ -0,0 +1,259 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""On-device beam search for models that support kv caching.
+
+Beams are kept as part of the batch dimension: a batch of B prompts decodes
+B * num_beams rows, where row `b * num_beams + k` holds beam k of prompt b.
+Every step selects the best continuations, reorders the kv cache rows with a
+gather, and applies the length penalty, all inside a single
+`jax.lax.while_loop`.
+
+The search keeps `num_beams` alive beams and `num_beams` finished hypotheses
+per prompt. A prompt is done when no alive beam can reach a better
+length-normalized score than its worst finished hypothesis.
+"""
+
+import jax
+import jax.numpy as jnp
+from typing import Dict, Tuple
+from kithara.model.generation.decoding import _decode_start_index, prefill_on_device
+
+
+def _length_penalty(num_generated_tokens: jax.Array, alpha: jax.Array) -> jax.Array:
+    return jnp.maximum(num_generated_tokens, 1).astype(jnp.float32) ** alpha
+
+
+def beam_search_on_device(
+    model: "kithara.Model",
+    num_beams: int,
+    trainable_variables,
+    non_trainable_variables,
+    prefill_inputs: Dict[str, jax.Array],
+    token_ids: jax.Array,
+    padding_mask: jax.Array,
+    prompt_lengths: jax.Array,
+    stop_token_ids: jax.Array,
+    max_length: jax.Array,
+    length_penalty: jax.Array,
+) -> Tuple[jax.Array, jax.Array, jax.Array]:
+    """Generate the most likely continuation of every prompt with beam search.
+
+    Hypotheses are ranked by the sum of the log-probabilities of their
+    generated tokens divided by `num_generated_tokens ** length_penalty`.
+    The prompt is prefilled once per prompt, and its kv cache is copied to
+    every beam with `model.reorder_kv_cache()`. If `model.decodes_in_lockstep`
+    is True, rows with longer prompts feed their remaining prompt tokens to
+    all of their beams before the search starts for them.
+
+    Args:
+        model (kithara.Model): A model where `supports_kv_cache` is True.
+        num_beams (int): Number of beams per prompt. This is a static value.
+        length_penalty: Scalar exponent of the length normalization. 0 ranks
+            hypotheses by their total log-probability, larger values favor
+            longer hypotheses. This is a traced value.
+        For the rest of the args, please refer to `generate_on_device()`.
+
+    Returns:
+        tuple: (token_ids [B, S], padding_mask [B, S], scores [B]) of the best
+            hypothesis of every prompt.
+    """
+    batch_size, seq_len = token_ids.shape
+    batch_index = jnp.arange(batch_size)
+    beam_index = jnp.arange(num_beams)
+    max_length = jnp.minimum(max_length, seq_len)
+    start_index = _decode_start_index(model, prompt_lengths)
+    max_generated_tokens = max_length - prompt_lengths
+
+    next_token_logits, cache = prefill_on_device(
+        model,
+        trainable_variables,
+        non_trainable_variables,
+        prefill_inputs,
+        prompt_lengths,
+    )
+    # Copy the prompt of every row to all of its beams.
+    expand_index = jnp.repeat(batch_index, num_beams)
+    cache = model.reorder_kv_cache(cache, expand_index)
+    next_token_logits = next_token_logits[expand_index]
+
+    # All beams start out identical, so only the first beam is expanded at
+    # the first step.
+    initial_log_probs = jnp.where(beam_index == 0, 0.0, -jnp.inf)
+    state = {
+        "step": jnp.int32(0),
+        "alive_seqs": jnp.repeat(token_ids[:, None], num_beams, axis=1),
+        "alive_log_probs": jnp.tile(initial_log_probs, (batch_size, 1)),
+        "alive_lengths": prompt_lengths,
+        "finished_seqs": jnp.zeros((batch_size, num_beams, seq_len), token_ids.dtype),
+        "finished_scores": jnp.full((batch_size, num_beams), -jnp.inf),
+        "finished_lengths": jnp.zeros((batch_size, num_beams), jnp.int32),
+        "cache": cache,
+        "next_token_logits": next_token_logits,
+        "done": (prompt_lengths == 0) | (prompt_lengths >= max_length),
+    }
+
+    def cond(state):
+        return (state["step"] < seq_len) & ~jnp.all(state["done"])
+
+    def body(state):
+        done = state["done"]
+        index = start_index + state["step"]
+        in_prompt = index < prompt_lengths
+        num_generated_tokens = index + 1 - prompt_lengths
+
+        # Select the 2 * num_beams best continuations, so that at least
+        # num_beams of them stay alive if the others end.
+        log_probs = jax.nn.log_softmax(
+            state["next_token_logits"].astype(jnp.float32), axis=-1
+        )
+        vocab_size = log_probs.shape[-1]
+        candidate_log_probs = state["alive_log_probs"][..., None] + log_probs.reshape(
+            batch_size, num_beams, vocab_size
+        )
+        topk_log_probs, topk_index = jax.lax.top_k(
+            candidate_log_probs.reshape(batch_size, num_beams * vocab_size),
+            2 * num_beams,
+        )
+        topk_beams = topk_index // vocab_size
+        topk_tokens = topk_index % vocab_size
+
+        # Rows that are still in their prompt feed the next prompt token to
+        # every beam.
+        prompt_tokens = token_ids[batch_index, jnp.minimum(index, seq_len - 1)]
+        forced_log_probs = jnp.concatenate(
+            [state["alive_log_probs"], jnp.full((batch_size, num_beams), -jnp.inf)],
+            axis=1,
+        )
+        forced_beams = jnp.concatenate([beam_index, jnp.zeros_like(beam_index)])
+        topk_log_probs = jnp.where(in_prompt[:, None], forced_log_probs, topk_log_probs)
+        topk_beams = jnp.where(in_prompt[:, None], forced_beams, topk_beams)
+        topk_tokens = jnp.where(
+            in_prompt[:, None], prompt_tokens[:, None], topk_tokens
+        ).astype(token_ids.dtype)
+
+        topk_seqs = jnp.take_along_axis(
+            state["alive_seqs"], topk_beams[..., None], axis=1
+        )
+        is_index = jnp.arange(seq_len)[None, :] == index[:, None]
+        topk_seqs = jnp.where(is_index[:, None, :], topk_tokens[..., None], topk_seqs)
+        ends = ~in_prompt[:, None] & (
+            jnp.isin(topk_tokens, stop_token_ids) | (index + 1 >= max_length)[:, None]
+        )
+
+        # Continuations that did not end compete for the alive beams.
+        alive_log_probs, alive_index = jax.lax.top_k(
+            jnp.where(ends, -jnp.inf, topk_log_probs), num_beams
+        )
+        alive_seqs = jnp.take_along_axis(topk_seqs, alive_index[..., None], axis=1)
+        alive_beams = jnp.take_along_axis(topk_beams, alive_index, axis=1)
+        alive_tokens = jnp.take_along_axis(topk_tokens, alive_index, axis=1)
+
+        # Continuations that ended compete with the finished hypotheses.
+        scores = jnp.where(
+            ends,
+            topk_log_probs
+            / _length_penalty(num_generated_tokens, length_penalty)[:, None],
+            -jnp.inf,
+        )
+        finished_scores, finished_index = jax.lax.top_k(
+            jnp.concatenate([state["finished_scores"], scores], axis=1), num_beams
+        )
+        finished_seqs = jnp.take_along_axis(
+            jnp.concatenate([state["finished_seqs"], topk_seqs], axis=1),
+            finished_index[..., None],
+            axis=1,
+        )
+        lengths = jnp.broadcast_to((index + 1)[:, None], scores.shape)
+        finished_lengths = jnp.take_along_axis(
+            jnp.concatenate([state["finished_lengths"], lengths], axis=1),
+            finished_index,
+            axis=1,
+        )
+
+        # Rows that are done keep their beams.
+        def keep_if_done(old, new):
+            return jnp.where(done.reshape((-1,) + (1,) * (new.ndim - 1)), old, new)
+
+        alive_seqs = keep_if_done(state["alive_seqs"], alive_seqs)
+        alive_log_probs = keep_if_done(state["alive_log_probs"], alive_log_probs)
+        alive_lengths = keep_if_done(
+            state["alive_lengths"], jnp.maximum(prompt_lengths, index + 1)
+        )
+        alive_beams = keep_if_done(
+            jnp.broadcast_to(beam_index, alive_beams.shape), alive_beams
+        )
+        alive_tokens = keep_if_done(jnp.zeros_like(alive_tokens), alive_tokens)
+        finished_seqs = keep_if_done(state["finished_seqs"], finished_seqs)
+        finished_scores = keep_if_done(state["finished_scores"], finished_scores)
+        finished_lengths = keep_if_done(state["finished_lengths"], finished_lengths)
+
+        # Move the kv cache of every alive beam to its new row, then run the
+        # forward pass for its newest token.
+        source_rows = (batch_index[:, None] * num_beams + alive_beams).reshape(-1)
+        cache = model.reorder_kv_cache(state["cache"], source_rows)
+        next_token_logits, cache = model.stateless_decode(
+            trainable_variables,
+            non_trainable_variables,
+            cache,
+            alive_tokens.reshape(-1, 1),
+            jnp.repeat(index, num_beams)[:, None].astype(jnp.int32),
+        )
+
+        # Log-probabilities only decrease, so the best score an alive beam
+        # can reach is bounded by its current log-probability divided by
+        # the extreme length penalty over the remaining lengths.
+        best_alive = alive_log_probs[:, 0]
+        best_possible = jnp.maximum(
+            best_alive / _length_penalty(num_generated_tokens, length_penalty),
+            best_alive / _length_penalty(max_generated_tokens, length_penalty),
+        )
+        done = (
+            done
+            | (best_alive == -jnp.inf)
+            | (~in_prompt & (finished_scores[:, -1] >= best_possible))
+        )
+        return {
+            "step": state["step"] + 1,
+            "alive_seqs": alive_seqs,
+            "alive_log_probs": alive_log_probs,
+            "alive_lengths": alive_lengths,
+            "finished_seqs": finished_seqs,
+            "finished_scores": finished_scores,
+            "finished_lengths": finished_lengths,
+            "cache": cache,
+            "next_token_logits": next_token_logits,
+            "done": done,
+        }
+
+    state = jax.lax.while_loop(cond, body, state)
+
+    # Rows without finished hypotheses return their best alive beam.
+    has_finished = state["finished_scores"][:, 0] > -jnp.inf
+    best_seqs = jnp.where(
+        has_finished[:, None], state["finished_seqs"][:, 0], state["alive_seqs"][:, 0]
+    )
+    best_lengths = jnp.where(
+        has_finished, state["finished_lengths"][:, 0], state["alive_lengths"]
+    )
+    alive_scores = state["alive_log_probs"][:, 0] / _length_penalty(
+        state["alive_lengths"] - prompt_lengths, length_penalty
+    )
+    best_scores = jnp.where(has_finished, state["finished_scores"][:, 0], alive_scores)
+    best_padding_mask = (jnp.arange(seq_len)[None, :] < best_lengths[:, None]).astype(
+        padding_mask.dtype
+    )
+    return best_seqs, best_padding_mask, best_scores
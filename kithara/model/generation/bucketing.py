@@ -0,0 +1,65 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Shape bucketing for generation. Padding batch size and prompt length up
+to a small set of bucket sizes lets repeated `generate()` calls with slightly
+different inputs reuse the same compiled executables."""
+
+from typing import Optional
+
+
+def next_power_of_two(n: int) -> int:
+    """Returns the smallest power of two that is greater or equal to `n`."""
+    if n <= 1:
+        return 1
+    return 1 << (n - 1).bit_length()
+
+
+def get_bucket_size(
+    n: int,
+    multiple_of: int = 1,
+    min_size: int = 1,
+    max_size: Optional[int] = None,
+) -> int:
+    """Round `n` up to the next power of two, then up to a multiple of
+    `multiple_of`, clipped to the range [`min_size`, `max_size`].
+
+    Args:
+        n (int): The size to bucket.
+        multiple_of (int, optional): The bucket size must be a multiple of this
+            value, e.g. the number of devices the batch is sharded over.
+        min_size (int, optional): Minimum bucket size.
+        max_size (int, optional): Maximum bucket size. `n` must not exceed it.
+
+    Returns:
+        int: The bucket size.
+
+    Example:
+        >>> get_bucket_size(5)
+        8
+        >>> get_bucket_size(5, multiple_of=6)
+        12
+        >>> get_bucket_size(100, min_size=16, max_size=64)
+        Traceback (most recent call last):
+        ValueError: ...
+    """
+    if max_size is not None and n > max_size:
+        raise ValueError(f"Size {n} exceeds the maximum bucket size {max_size}.")
+    bucket = max(next_power_of_two(n), min_size)
+    bucket = -(-bucket // multiple_of) * multiple_of
+    if max_size is not None:
+        bucket = min(bucket, max_size)
+    return bucket
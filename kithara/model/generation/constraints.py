@@ -0,0 +1,627 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Constrained decoding with token-level automata.
+
+A regular expression is compiled into a character-level automaton, which is
+then walked along the tokenizer vocabulary to build an automaton over token
+ids. Every state stores the bitmask of tokens that keep the output a valid
+prefix of a match, so that decoding steps only need to gather one bitmask
+row and mask the logits on device.
+
+Transitions are stored compactly: every state has a default next state, and
+only tokens leading elsewhere are listed in a sorted exception table that is
+searched on device.
+"""
+
+import collections
+import json
+import re
+import jax
+import jax.numpy as jnp
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Union
+from kithara.model.generation.bucketing import get_bucket_size
+
+_ANY = None
+
+
+class _CharSet:
+    """A set of characters given by single characters, inclusive ranges and
+    nested sets, optionally negated."""
+
+    def __init__(self, chars="", ranges=(), subsets=(), negated=False):
+        self.chars = frozenset(chars)
+        self.ranges = tuple(ranges)
+        self.subsets = tuple(subsets)
+        self.negated = negated
+
+    def __contains__(self, char: str) -> bool:
+        found = (
+            char in self.chars
+            or any(low <= char <= high for low, high in self.ranges)
+            or any(char in subset for subset in self.subsets)
+        )
+        return found != self.negated
+
+
+_CLASS_ESCAPES = {
+    "d": _CharSet(ranges=[("0", "9")]),
+    "w": _CharSet("_", ranges=[("a", "z"), ("A", "Z"), ("0", "9")]),
+    "s": _CharSet(" \t\n\r\f\v"),
+}
+_LITERAL_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+
+class _RegexParser:
+    """Compiles a regular expression into a Thompson NFA, whose edges are
+    labeled with a `_CharSet` or with None for epsilon edges.
+
+    Supports literals, escapes, `.`, character classes, groups, alternation
+    and the `*`, `+`, `?` and `{m,n}` quantifiers. Patterns always match the
+    whole output, so `^` and `$` are ignored."""
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.index = 0
+        self.edges: List[List[tuple]] = []
+
+    def parse(self):
+        start, end = self._alternation()
+        if self.index != len(self.pattern):
+            raise ValueError(
+                f"Unbalanced parenthesis at position {self.index} of {self.pattern!r}."
+            )
+        return start, end
+
+    def _new_state(self) -> int:
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.index] if self.index < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.index >= len(self.pattern):
+            raise ValueError(f"Unexpected end of pattern {self.pattern!r}.")
+        self.index += 1
+        return self.pattern[self.index - 1]
+
+    def _char_fragment(self, char_set: _CharSet):
+        start, end = self._new_state(), self._new_state()
+        self.edges[start].append((char_set, end))
+        return start, end
+
+    def _sequence(self, fragments):
+        if not fragments:
+            state = self._new_state()
+            return state, state
+        for (_, end), (start, _) in zip(fragments, fragments[1:]):
+            self.edges[end].append((None, start))
+        return fragments[0][0], fragments[-1][1]
+
+    def _alternation(self):
+        branches = [self._concatenation()]
+        while self._peek() == "|":
+            self.index += 1
+            branches.append(self._concatenation())
+        if len(branches) == 1:
+            return branches[0]
+        start, end = self._new_state(), self._new_state()
+        for branch_start, branch_end in branches:
+            self.edges[start].append((None, branch_start))
+            self.edges[branch_end].append((None, end))
+        return start, end
+
+    def _concatenation(self):
+        fragments = []
+        while self._peek() is not None and self._peek() not in "|)":
+            fragments.append(self._repetition(len(self.pattern)))
+        return self._sequence(fragments)
+
+    def _repetition(self, stop: int):
+        start_index = self.index
+        fragment = self._atom()
+        while self.index < stop and self._peek() is not None and self._peek() in "*+?{":
+            quantifier_index = self.index
+            low, high = self._quantifier()
+
+            def copy(start=start_index, end=quantifier_index):
+                index, self.index = self.index, start
+                fragment = self._repetition(end)
+                self.index = index
+                return fragment
+
+            fragment = self._quantify(fragment, copy, low, high)
+        return fragment
+
+    def _quantifier(self):
+        char = self._next()
+        if char == "*":
+            return 0, None
+        if char == "+":
+            return 1, None
+        if char == "?":
+            return 0, 1
+        match = re.compile(r"(\d*)(,?)(\d*)\}").match(self.pattern, self.index)
+        if match is None or not (match.group(1) or match.group(3)):
+            raise ValueError(f"Invalid quantifier at position {self.index - 1}.")
+        self.index = match.end()
+        low = int(match.group(1) or 0)
+        if not match.group(2):
+            return low, low
+        return low, int(match.group(3)) if match.group(3) else None
+
+    def _quantify(self, fragment, copy, low: int, high: Optional[int]):
+        copies = [fragment] + [copy() for _ in range(max(low - 1, 0))]
+        pieces = copies[:low]
+        if high is None:
+            repeated = fragment if low == 0 else copy()
+            start, end = self._new_state(), self._new_state()
+            self.edges[start] += [(None, repeated[0]), (None, end)]
+            self.edges[repeated[1]] += [(None, repeated[0]), (None, end)]
+            pieces.append((start, end))
+        else:
+            for i in range(high - low):
+                optional = fragment if (low == 0 and i == 0) else copy()
+                start, end = self._new_state(), self._new_state()
+                self.edges[start] += [(None, optional[0]), (None, end)]
+                self.edges[optional[1]].append((None, end))
+                pieces.append((start, end))
+        return self._sequence(pieces)
+
+    def _atom(self):
+        char = self._next()
+        if char == "(":
+            if self.pattern.startswith("?:", self.index):
+                self.index += 2
+            fragment = self._alternation()
+            if self._next() != ")":
+                raise ValueError(f"Missing ')' in {self.pattern!r}.")
+            return fragment
+        if char == "[":
+            return self._char_fragment(self._char_class())
+        if char == ".":
+            return self._char_fragment(_CharSet(negated=True))
+        if char in "^$":
+            return self._sequence([])
+        if char == "\\":
+            return self._char_fragment(self._escape())
+        if char in "*+?{":
+            raise ValueError(f"Nothing to repeat at position {self.index - 1}.")
+        return self._char_fragment(_CharSet(char))
+
+    def _escape(self) -> _CharSet:
+        char = self._next()
+        if char.lower() in _CLASS_ESCAPES:
+            char_set = _CLASS_ESCAPES[char.lower()]
+            return _CharSet(subsets=[char_set], negated=char.isupper())
+        if char in _LITERAL_ESCAPES:
+            return _CharSet(_LITERAL_ESCAPES[char])
+        if char in "xu":
+            num_digits = 2 if char == "x" else 4
+            code = self.pattern[self.index : self.index + num_digits]
+            self.index += num_digits
+            return _CharSet(chr(int(code, 16)))
+        return _CharSet(char)
+
+    def _char_class(self) -> _CharSet:
+        negated = self._peek() == "^"
+        if negated:
+            self.index += 1
+        chars, ranges, subsets = [], [], []
+        first = True
+        while first or self._peek() != "]":
+            first = False
+            char = self._next()
+            if char == "\\":
+                escaped = self._escape()
+                if escaped.subsets or escaped.negated:
+                    subsets.append(escaped)
+                    continue
+                (char,) = escaped.chars
+            if self._peek() == "-" and self.pattern[self.index + 1 : self.index + 2] not in ("]", ""):
+                self.index += 1
+                high = self._next()
+                if high == "\\":
+                    (high,) = self._escape().chars
+                ranges.append((char, high))
+            else:
+                chars.append(char)
+        self.index += 1
+        return _CharSet("".join(chars), ranges, subsets, negated)
+
+
+class _LazyDfa:
+    """Determinizes the NFA on demand, memoizing every transition."""
+
+    def __init__(self, edges, start: int, accept: int):
+        self.edges = edges
+        self.accept = accept
+        self._state_ids = {}
+        self._states = []
+        self._transitions = {}
+        self.start = self._state_id(self._closure({start}))
+
+    def _closure(self, states) -> frozenset:
+        stack, closure = list(states), set(states)
+        while stack:
+            for char_set, target in self.edges[stack.pop()]:
+                if char_set is None and target not in closure:
+                    closure.add(target)
+                    stack.append(target)
+        return frozenset(closure)
+
+    def _state_id(self, states: frozenset) -> int:
+        if states not in self._state_ids:
+            self._state_ids[states] = len(self._states)
+            self._states.append(states)
+        return self._state_ids[states]
+
+    def is_accepting(self, state: int) -> bool:
+        return self.accept in self._states[state]
+
+    def step(self, state: int, char: str) -> int:
+        """Next state after `char`, or -1 if no match can continue."""
+        key = (state, char)
+        if key not in self._transitions:
+            targets = {
+                target
+                for nfa_state in self._states[state]
+                for char_set, target in self.edges[nfa_state]
+                if char_set is not None and char in char_set
+            }
+            self._transitions[key] = (
+                self._state_id(self._closure(targets)) if targets else -1
+            )
+        return self._transitions[key]
+
+
+def _token_strings(tokenizer) -> List[Optional[str]]:
+    """The text of every token as it appears in decoded output, or None for
+    special tokens and byte tokens that are not a complete character."""
+    special_ids = set(getattr(tokenizer, "all_special_ids", []))
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    strings = []
+    for token_id, token in enumerate(tokens):
+        byte = re.fullmatch(r"<0x([0-9A-Fa-f]{2})>", token or "")
+        if token is None or token_id in special_ids:
+            strings.append(None)
+        elif byte is not None:
+            value = int(byte.group(1), 16)
+            strings.append(chr(value) if value < 0x80 else None)
+        else:
+            text = tokenizer.convert_tokens_to_string([token])
+            # Sentencepiece tokenizers drop the leading space of the first
+            # token when decoding.
+            if token.startswith("▁") and not text.startswith(" "):
+                text = " " + text
+            strings.append(text or None)
+    return strings
+
+
+def _stop_token_ids(tokenizer, stop_token_ids) -> List[int]:
+    if stop_token_ids != "auto":
+        return list(stop_token_ids)
+    stop_token_ids = []
+    for attr in ["end_token_id", "eos_token_id", "end_token2_id", "eos_token2_id"]:
+        if getattr(tokenizer, attr, None) is not None:
+            stop_token_ids.append(getattr(tokenizer, attr))
+    return stop_token_ids
+
+
+class TokenConstraint:
+    """Restricts generation to outputs matching a regular expression.
+
+    The constraint is a token-level automaton over a tokenizer vocabulary,
+    built once with `from_regex()` or `from_json_schema()`. During decoding,
+    every row tracks its automaton state, and tokens that cannot lead to a
+    match are masked out before sampling. Stop tokens are only allowed once
+    the output is a complete match.
+
+    Constraints are cached by pattern and tokenizer, and their tables are
+    transferred to device once.
+
+    Example:
+        ```
+        constraint = TokenConstraint.from_json_schema(
+            {"type": "object", "properties": {"answer": {"type": "integer"}}},
+            tokenizer,
+        )
+        model.generate(prompt, tokenizer=tokenizer, constraint=constraint)
+        ```
+    """
+
+    _cache: Dict[tuple, "TokenConstraint"] = {}
+
+    def __init__(
+        self,
+        allowed_bits: np.ndarray,
+        default_next_states: np.ndarray,
+        exception_keys: np.ndarray,
+        exception_next_states: np.ndarray,
+        vocab_size: int,
+    ):
+        self.allowed_bits = allowed_bits
+        self.default_next_states = default_next_states
+        self.exception_keys = exception_keys
+        self.exception_next_states = exception_next_states
+        self.vocab_size = vocab_size
+        self._arrays = None
+
+    @property
+    def num_states(self) -> int:
+        return self.allowed_bits.shape[0]
+
+    @classmethod
+    def from_regex(
+        cls,
+        pattern: str,
+        tokenizer,
+        stop_token_ids: Union[str | List[int]] = "auto",
+    ) -> "TokenConstraint":
+        """Build a constraint from a regular expression that the generated
+        text, excluding the prompt, must match.
+
+        Args:
+            pattern (str): The regular expression.
+            tokenizer: A HuggingFace tokenizer.
+            stop_token_ids (List[int], optional): Tokens that end generation
+                once the output matches. Defaults to "auto", which uses the
+                end token ids of the tokenizer.
+        """
+        stop_token_ids = _stop_token_ids(tokenizer, stop_token_ids)
+        key = (
+            pattern,
+            getattr(tokenizer, "name_or_path", id(tokenizer)),
+            len(tokenizer),
+            tuple(stop_token_ids),
+        )
+        if key not in cls._cache:
+            cls._cache[key] = cls.from_token_strings(
+                pattern, _token_strings(tokenizer), stop_token_ids
+            )
+        return cls._cache[key]
+
+    @classmethod
+    def from_json_schema(
+        cls,
+        schema: Union[str | Dict[str, Any]],
+        tokenizer,
+        stop_token_ids: Union[str | List[int]] = "auto",
+    ) -> "TokenConstraint":
+        """Build a constraint from a JSON schema. See `json_schema_to_regex()`
+        for the supported subset of JSON schema."""
+        return cls.from_regex(json_schema_to_regex(schema), tokenizer, stop_token_ids)
+
+    @classmethod
+    def from_token_strings(
+        cls,
+        pattern: str,
+        token_strings: Sequence[Optional[str]],
+        stop_token_ids: Sequence[int],
+    ) -> "TokenConstraint":
+        """Build a constraint from the text of every token. Tokens whose
+        text is None can only be generated if they are stop tokens."""
+        parser = _RegexParser(pattern)
+        start, accept = parser.parse()
+        dfa = _LazyDfa(parser.edges, start, accept)
+
+        # Trie of the vocabulary, so that token prefixes are only matched
+        # once per state. Every node is [children, token ids].
+        root = [{}, []]
+        for token_id, text in enumerate(token_strings):
+            if not text:
+                continue
+            node = root
+            for char in text:
+                node = node[0].setdefault(char, [{}, []])
+            node[1].append(token_id)
+
+        transitions = {}
+        queue = collections.deque([dfa.start])
+        while queue:
+            state = queue.popleft()
+            if state in transitions:
+                continue
+            transitions[state] = state_transitions = {}
+            stack = [(root, state)]
+            while stack:
+                node, node_state = stack.pop()
+                for char, child in node[0].items():
+                    next_state = dfa.step(node_state, char)
+                    if next_state < 0:
+                        continue
+                    for token_id in child[1]:
+                        state_transitions[token_id] = next_state
+                    if child[1] and next_state not in transitions:
+                        queue.append(next_state)
+                    stack.append((child, next_state))
+
+        # Only keep states from which a complete match can be reached.
+        predecessors = collections.defaultdict(set)
+        for state, state_transitions in transitions.items():
+            for next_state in state_transitions.values():
+                predecessors[next_state].add(state)
+        live = {state for state in transitions if dfa.is_accepting(state)}
+        stack = list(live)
+        while stack:
+            for state in predecessors[stack.pop()]:
+                if state not in live:
+                    live.add(state)
+                    stack.append(state)
+        if dfa.start not in live:
+            raise ValueError(
+                f"No output matching {pattern!r} can be generated with this vocabulary."
+            )
+
+        states = [dfa.start] + sorted(live - {dfa.start})
+        state_index = {state: i for i, state in enumerate(states)}
+        vocab_size = len(token_strings)
+        if len(states) * vocab_size >= 2**31:
+            raise ValueError(
+                f"The automaton of {pattern!r} has too many states ({len(states)})."
+            )
+        allowed = np.zeros((len(states), (vocab_size + 31) // 32 * 32), dtype=bool)
+        default_next_states = np.zeros(len(states), dtype=np.int32)
+        exceptions = []
+        for i, state in enumerate(states):
+            next_states = {
+                token_id: state_index[next_state]
+                for token_id, next_state in transitions[state].items()
+                if next_state in live
+            }
+            if dfa.is_accepting(state):
+                next_states.update({token_id: i for token_id in stop_token_ids})
+            if not next_states:
+                continue
+            allowed[i, list(next_states)] = True
+            default = collections.Counter(next_states.values()).most_common(1)[0][0]
+            default_next_states[i] = default
+            exceptions += [
+                (i * vocab_size + token_id, next_state)
+                for token_id, next_state in next_states.items()
+                if next_state != default
+            ]
+        exceptions.sort()
+        allowed_bits = np.packbits(allowed, axis=1, bitorder="little")
+        return cls(
+            allowed_bits=allowed_bits.view(np.uint32),
+            default_next_states=default_next_states,
+            exception_keys=np.array([k for k, _ in exceptions], dtype=np.int32),
+            exception_next_states=np.array([s for _, s in exceptions], dtype=np.int32),
+            vocab_size=vocab_size,
+        )
+
+    def to_arrays(self) -> Dict[str, jax.Array]:
+        """The automaton tables as device arrays, padded to power-of-two
+        sizes so that similar constraints share compiled functions."""
+        if self._arrays is None:
+            num_states = get_bucket_size(self.num_states)
+            num_exceptions = get_bucket_size(len(self.exception_keys) + 1)
+            pad_states = num_states - self.num_states
+            pad_exceptions = num_exceptions - len(self.exception_keys)
+            self._arrays = {
+                "allowed_bits": jnp.asarray(
+                    np.pad(self.allowed_bits, ((0, pad_states), (0, 0)))
+                ),
+                "default_next_states": jnp.asarray(
+                    np.pad(self.default_next_states, (0, pad_states))
+                ),
+                # Padding keys are larger than any real key.
+                "exception_keys": jnp.asarray(
+                    np.pad(
+                        self.exception_keys,
+                        (0, pad_exceptions),
+                        constant_values=np.iinfo(np.int32).max,
+                    )
+                ),
+                "exception_next_states": jnp.asarray(
+                    np.pad(self.exception_next_states, (0, pad_exceptions))
+                ),
+                "vocab_size": jnp.int32(self.vocab_size),
+            }
+        return self._arrays
+
+
+def allowed_token_mask(constraint: Dict[str, jax.Array], states: jax.Array, vocab_size: int) -> jax.Array:
+    """Boolean mask [B, vocab_size] of the tokens allowed in every state.
+    Tokens outside of the constraint's vocabulary are never allowed."""
+    bits = constraint["allowed_bits"][states]
+    vocab_index = jnp.arange(vocab_size)
+    words = jnp.minimum(vocab_index // 32, bits.shape[1] - 1)
+    allowed = (bits[:, words] >> (vocab_index % 32).astype(jnp.uint32)) & 1
+    return (allowed == 1) & (vocab_index < bits.shape[1] * 32)
+
+
+def apply_token_constraint(
+    logits: jax.Array, constraint: Dict[str, jax.Array], states: jax.Array
+) -> jax.Array:
+    """Mask the logits [B, V] of the tokens that are not allowed."""
+    mask = allowed_token_mask(constraint, states, logits.shape[-1])
+    return jnp.where(mask, logits, jnp.finfo(logits.dtype).min)
+
+
+def advance_token_constraint(
+    constraint: Dict[str, jax.Array], states: jax.Array, token_ids: jax.Array
+) -> jax.Array:
+    """Automaton state of every row after generating `token_ids`."""
+    keys = states * constraint["vocab_size"] + token_ids.astype(jnp.int32)
+    exception_keys = constraint["exception_keys"]
+    index = jnp.minimum(
+        jnp.searchsorted(exception_keys, keys), exception_keys.shape[0] - 1
+    )
+    return jnp.where(
+        exception_keys[index] == keys,
+        constraint["exception_next_states"][index],
+        constraint["default_next_states"][states],
+    )
+
+
+_JSON_STRING = r'"([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+_JSON_INTEGER = r"-?(0|[1-9][0-9]*)"
+_JSON_NUMBER = _JSON_INTEGER + r"(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+_WHITESPACE = r" ?"
+
+
+def json_schema_to_regex(schema: Union[str | Dict[str, Any]]) -> str:
+    """Convert a JSON schema to a regular expression matching its instances.
+
+    Supports the `object` (with `properties`, emitted in order), `array`
+    (with `items`), `string`, `integer`, `number`, `boolean` and `null`
+    types, as well as `enum`, `const`, `anyOf` and `oneOf`. Objects are
+    generated with all of their properties.
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    if "enum" in schema:
+        return "(" + "|".join(re.escape(json.dumps(v)) for v in schema["enum"]) + ")"
+    if "const" in schema:
+        return re.escape(json.dumps(schema["const"]))
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return "(" + "|".join(json_schema_to_regex(s) for s in schema[key]) + ")"
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return "(" + "|".join(
+            json_schema_to_regex({**schema, "type": t}) for t in schema_type
+        ) + ")"
+    if schema_type == "object":
+        members = [
+            re.escape(json.dumps(name)) + _WHITESPACE + ":" + _WHITESPACE
+            + json_schema_to_regex(property_schema)
+            for name, property_schema in schema.get("properties", {}).items()
+        ]
+        separator = _WHITESPACE + "," + _WHITESPACE
+        return r"\{" + _WHITESPACE + separator.join(members) + _WHITESPACE + r"\}"
+    if schema_type == "array":
+        item = json_schema_to_regex(schema.get("items", {"type": "string"}))
+        separator = _WHITESPACE + "," + _WHITESPACE
+        return (
+            r"\[" + _WHITESPACE + "(" + item + "(" + separator + item + ")*)?"
+            + _WHITESPACE + r"\]"
+        )
+    if schema_type == "string":
+        return _JSON_STRING
+    if schema_type == "integer":
+        return _JSON_INTEGER
+    if schema_type == "number":
+        return _JSON_NUMBER
+    if schema_type == "boolean":
+        return "(true|false)"
+    if schema_type == "null":
+        return "null"
+    raise ValueError(f"Unsupported JSON schema: {schema}")
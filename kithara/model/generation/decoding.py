@@ -0,0 +1,324 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""On-device autoregressive decoding loops for models that support kv caching.
+
+The functions in this module are pure and are meant to be wrapped with
+`jax.jit`. The entire token loop, including stop token detection, runs inside
+a single `jax.lax.while_loop`, so only the final tokens are transferred back
+to the host.
+"""
+
+import jax
+import jax.numpy as jnp
+from typing import Any, Dict, Optional, Tuple
+from kithara.model.generation.constraints import (
+    advance_token_constraint,
+    apply_token_constraint,
+)
+from kithara.model.generation.sampling import sample_next_tokens
+
+
+def _decode_start_index(model: "kithara.Model", prompt_lengths: jax.Array) -> jax.Array:
+    """Position of the first decoded token of every row."""
+    if model.decodes_in_lockstep:
+        real_prompt_lengths = jnp.where(
+            prompt_lengths > 0, prompt_lengths, jnp.max(prompt_lengths)
+        )
+        return jnp.full_like(prompt_lengths, jnp.min(real_prompt_lengths))
+    return prompt_lengths
+
+
+def prefill_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    prefill_inputs: Dict[str, jax.Array],
+    prompt_lengths: jax.Array,
+) -> Tuple[jax.Array, Any]:
+    """Run the prefill step of `generate_on_device()`.
+
+    Returns:
+        tuple: (logits of the first decoded token of every row [B, V], kv cache)
+    """
+    logits, cache = model.stateless_prefill(
+        trainable_variables, non_trainable_variables, prefill_inputs
+    )
+    start_index = _decode_start_index(model, prompt_lengths)
+    batch_index = jnp.arange(logits.shape[0])
+    return logits[batch_index, jnp.maximum(start_index - 1, 0)], cache
+
+
+def init_decode_state(
+    next_token_logits: jax.Array,
+    cache,
+    token_ids: jax.Array,
+    padding_mask: jax.Array,
+    prompt_lengths: jax.Array,
+    max_length: jax.Array,
+    constraint: Optional[Dict[str, jax.Array]] = None,
+) -> Dict[str, Any]:
+    """Build the loop state of `decode_steps_on_device()` from the output of
+    `prefill_on_device()`."""
+    state = {
+        "step": jnp.int32(0),
+        "token_ids": token_ids,
+        "padding_mask": padding_mask,
+        "cache": cache,
+        "next_token_logits": next_token_logits,
+        "done": (prompt_lengths == 0) | (prompt_lengths >= max_length),
+    }
+    if constraint is not None:
+        # Every row starts in the initial state of the automaton.
+        state["constraint_state"] = jnp.zeros_like(prompt_lengths, dtype=jnp.int32)
+    return state
+
+
+def decode_steps_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    state: Dict[str, Any],
+    prompt_lengths: jax.Array,
+    stop_token_ids: jax.Array,
+    max_length: jax.Array,
+    sampling_params: Dict[str, jax.Array],
+    num_steps: jax.Array,
+    constraint: Optional[Dict[str, jax.Array]] = None,
+) -> Dict[str, Any]:
+    """Run up to `num_steps` steps of the decoding loop of
+    `generate_on_device()`, stopping early once every row is done.
+
+    Args:
+        state: Loop state returned by `init_decode_state()` or a previous
+            call to this function.
+        num_steps: Scalar maximum number of steps. This is a traced value.
+        constraint: Optional tables of a `TokenConstraint`, as returned by
+            `TokenConstraint.to_arrays()`. The state must then be built with
+            the same constraint.
+        For the rest of the args, please refer to `generate_on_device()`.
+
+    Returns:
+        dict: The updated loop state.
+    """
+    batch_size, seq_len = state["token_ids"].shape
+    batch_index = jnp.arange(batch_size)
+    start_index = _decode_start_index(model, prompt_lengths)
+    end_step = jnp.minimum(state["step"] + num_steps, seq_len)
+
+    def cond(state):
+        return (state["step"] < end_step) & ~jnp.all(state["done"])
+
+    def body(state):
+        token_ids, padding_mask, done = (
+            state["token_ids"],
+            state["padding_mask"],
+            state["done"],
+        )
+        index = start_index + state["step"]
+        in_prompt = index < prompt_lengths
+        next_token_logits = state["next_token_logits"]
+        if constraint is not None:
+            next_token_logits = apply_token_constraint(
+                next_token_logits, constraint, state["constraint_state"]
+            )
+        sampled_tokens = sample_next_tokens(next_token_logits, sampling_params, index)
+        prompt_tokens = token_ids[batch_index, jnp.minimum(index, seq_len - 1)]
+        next_tokens = jnp.where(
+            in_prompt, prompt_tokens, jnp.where(done, 0, sampled_tokens)
+        ).astype(token_ids.dtype)
+        token_ids = token_ids.at[batch_index, index].set(next_tokens, mode="drop")
+        padding_mask = padding_mask.at[batch_index, index].set(
+            (in_prompt | ~done).astype(padding_mask.dtype), mode="drop"
+        )
+        generated = ~in_prompt & ~done
+        done = done | (
+            generated
+            & (jnp.isin(next_tokens, stop_token_ids) | (index + 1 >= max_length))
+        )
+
+        next_token_logits, cache = model.stateless_decode(
+            trainable_variables,
+            non_trainable_variables,
+            state["cache"],
+            next_tokens[:, None],
+            index[:, None].astype(jnp.int32),
+        )
+        next_state = {
+            "step": state["step"] + 1,
+            "token_ids": token_ids,
+            "padding_mask": padding_mask,
+            "cache": cache,
+            "next_token_logits": next_token_logits,
+            "done": done,
+        }
+        if constraint is not None:
+            next_state["constraint_state"] = jnp.where(
+                generated,
+                advance_token_constraint(
+                    constraint, state["constraint_state"], next_tokens
+                ),
+                state["constraint_state"],
+            )
+        return next_state
+
+    return jax.lax.while_loop(cond, body, state)
+
+
+def decode_chunk_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    state: Dict[str, Any],
+    prompt_lengths: jax.Array,
+    stop_token_ids: jax.Array,
+    max_length: jax.Array,
+    sampling_params: Dict[str, jax.Array],
+    num_steps: jax.Array,
+    constraint: Optional[Dict[str, jax.Array]] = None,
+) -> Tuple[Dict[str, Any], Dict[str, jax.Array]]:
+    """Streaming variant of `decode_steps_on_device()`.
+
+    Returns:
+        tuple: (updated loop state, dictionary with 'token_ids',
+            'padding_mask' and 'done'). The second output does not alias the
+            state, so it stays readable after the state is donated to the
+            next call.
+    """
+    state = decode_steps_on_device(
+        model,
+        trainable_variables,
+        non_trainable_variables,
+        state,
+        prompt_lengths,
+        stop_token_ids,
+        max_length,
+        sampling_params,
+        num_steps,
+        constraint,
+    )
+    outputs = {key: state[key] for key in ("token_ids", "padding_mask", "done")}
+    return state, outputs
+
+
+def decode_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    next_token_logits: jax.Array,
+    cache,
+    token_ids: jax.Array,
+    padding_mask: jax.Array,
+    prompt_lengths: jax.Array,
+    stop_token_ids: jax.Array,
+    max_length: jax.Array,
+    sampling_params: Dict[str, jax.Array],
+    constraint: Optional[Dict[str, jax.Array]] = None,
+) -> Tuple[jax.Array, jax.Array]:
+    """Run the decoding loop of `generate_on_device()`, starting from the
+    output of `prefill_on_device()`."""
+    state = init_decode_state(
+        next_token_logits,
+        cache,
+        token_ids,
+        padding_mask,
+        prompt_lengths,
+        max_length,
+        constraint,
+    )
+    state = decode_steps_on_device(
+        model,
+        trainable_variables,
+        non_trainable_variables,
+        state,
+        prompt_lengths,
+        stop_token_ids,
+        max_length,
+        sampling_params,
+        token_ids.shape[1],
+        constraint,
+    )
+    return state["token_ids"], state["padding_mask"]
+
+
+def generate_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    prefill_inputs: Dict[str, jax.Array],
+    token_ids: jax.Array,
+    padding_mask: jax.Array,
+    prompt_lengths: jax.Array,
+    stop_token_ids: jax.Array,
+    max_length: jax.Array,
+    sampling_params: Dict[str, jax.Array],
+    constraint: Optional[Dict[str, jax.Array]] = None,
+) -> Tuple[jax.Array, jax.Array]:
+    """Generate tokens with kv caching.
+
+    Prompts may have different lengths. If the model decodes rows at their own
+    positions, each row writes its next token right after its prompt, so a
+    batch of mixed-length prompts decodes at full batch throughput. If
+    `model.decodes_in_lockstep` is True, all rows decode the same position,
+    starting after the shortest prompt. Rows with longer prompts feed their
+    remaining prompt tokens instead of sampled tokens until their prompt ends.
+
+    Args:
+        model (kithara.Model): A model where `supports_kv_cache` is True.
+        trainable_variables: Model's trainable parameters.
+        non_trainable_variables: Model's non-trainable parameters.
+        prefill_inputs: Prompt input passed to `model.stateless_prefill()`.
+        token_ids: Token buffer of shape [B, S] holding the right-padded
+            prompts. Generated tokens are written into this buffer.
+        padding_mask: Padding mask of shape [B, S] matching `token_ids`.
+        prompt_lengths: Number of prompt tokens in each row, of shape [B].
+            Rows with length 0 are treated as batch padding and are considered
+            finished from the start.
+        stop_token_ids: Array of shape [K] with the ids that stop generation.
+        max_length: Scalar maximum total length (prompt + generated tokens) of
+            each row. This is a traced value, so changing it does not trigger
+            recompilation.
+        sampling_params: Per-row sampling arrays, as returned by
+            `SamplingParams.to_arrays()`.
+        constraint: Optional tables of a `TokenConstraint`, as returned by
+            `TokenConstraint.to_arrays()`. Generated tokens are restricted to
+            outputs matching the constraint.
+
+    Returns:
+        tuple: (token_ids [B, S], padding_mask [B, S]). Tokens after the stop
+            token of a row are masked out.
+    """
+    next_token_logits, cache = prefill_on_device(
+        model,
+        trainable_variables,
+        non_trainable_variables,
+        prefill_inputs,
+        prompt_lengths,
+    )
+    return decode_on_device(
+        model,
+        trainable_variables,
+        non_trainable_variables,
+        next_token_logits,
+        cache,
+        token_ids,
+        padding_mask,
+        prompt_lengths,
+        stop_token_ids,
+        max_length,
+        sampling_params,
+        constraint,
+    )
@@ -0,0 +1,91 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""On-device pooling of hidden states.
+
+Hidden states are pooled on device, so only one compact vector per sequence
+is transferred back to the host, never the [B, S, D] hidden states or the
+[B, S, V] logits.
+"""
+
+import jax
+import jax.numpy as jnp
+from typing import Dict, Optional
+
+POOLING_MODES = ("mean", "last")
+
+
+def pool_hidden_states(
+    hidden_states: jax.Array, padding_mask: jax.Array, pooling: str
+) -> jax.Array:
+    """Pool the hidden states of the non-padding tokens of every row.
+
+    Args:
+        hidden_states: Hidden states of shape [B, S, D].
+        padding_mask: Padding mask of shape [B, S]. Sequences must be
+            right-padded.
+        pooling: "mean" averages the hidden states of the non-padding tokens,
+            "last" takes the hidden state of the last non-padding token.
+
+    Returns:
+        jax.Array: float32 array of shape [B, D]. Rows without tokens are 0.
+    """
+    mask = padding_mask != 0
+    if pooling == "mean":
+        hidden_states = jnp.where(
+            mask[..., None], hidden_states.astype(jnp.float32), 0.0
+        )
+        num_tokens = jnp.sum(mask, axis=1, keepdims=True)
+        return jnp.sum(hidden_states, axis=1) / jnp.maximum(num_tokens, 1)
+    if pooling == "last":
+        last_index = jnp.maximum(jnp.sum(mask, axis=1) - 1, 0)
+        pooled = hidden_states[jnp.arange(hidden_states.shape[0]), last_index]
+        has_tokens = jnp.any(mask, axis=1)[:, None]
+        return jnp.where(has_tokens, pooled.astype(jnp.float32), 0.0)
+    raise ValueError(
+        f"Unsupported pooling {pooling}. Supported modes are {list(POOLING_MODES)}."
+    )
+
+
+def embed_on_device(
+    model: "kithara.Model",
+    layer: Optional[int],
+    pooling: str,
+    normalize: bool,
+    trainable_variables,
+    non_trainable_variables,
+    x: Dict[str, jax.Array],
+    padding_mask: jax.Array,
+) -> jax.Array:
+    """Compute the hidden states of `layer` with
+    `model.stateless_hidden_states()` and pool them.
+
+    Args:
+        normalize: If True, scale every embedding to unit L2 norm.
+        For the rest of the args, please refer to `pool_hidden_states()`
+        and `Model.embed()`.
+
+    Returns:
+        jax.Array: float16 embeddings of shape [B, D].
+    """
+    hidden_states = model.stateless_hidden_states(
+        trainable_variables, non_trainable_variables, x, layer
+    )
+    embeddings = pool_hidden_states(hidden_states, padding_mask, pooling)
+    if normalize:
+        norm = jnp.linalg.norm(embeddings, axis=-1, keepdims=True)
+        embeddings = embeddings / jnp.maximum(norm, 1e-12)
+    return embeddings.astype(jnp.float16)
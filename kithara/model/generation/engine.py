@@ -0,0 +1,353 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Continuous batching inference engine.
+
+The engine keeps a fixed number of decode slots on device. Every slot holds
+one request and its own region of the kv cache. A new request is prefilled on
+its own and inserted into a free slot as soon as one becomes available,
+instead of waiting for the longest request of a static batch to finish.
+"""
+
+import time
+import collections
+import jax
+import jax.numpy as jnp
+import numpy as np
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Sequence
+from jax.experimental import multihost_utils
+from kithara.model.generation.bucketing import get_bucket_size
+from kithara.model.generation.sampling import SamplingParams, sample_next_tokens
+
+
+@dataclass
+class GenerationRequest:
+    """A queued request of the `InferenceEngine`."""
+
+    request_id: int
+    prompt_token_ids: np.ndarray
+    max_new_tokens: int
+    sampling_arrays: Dict[str, np.ndarray]
+    arrival_time: float
+    first_token_time: Optional[float] = None
+    token_ids: List[int] = field(default_factory=list)
+
+
+@dataclass
+class GenerationResult:
+    """Output of a finished request.
+
+    Attributes:
+        request_id (int): Id returned by `InferenceEngine.add_request()`.
+        prompt_token_ids (np.ndarray): The prompt tokens.
+        token_ids (np.ndarray): The generated tokens, including the stop token
+            if generation stopped at a stop token.
+        time_to_first_token (float): Seconds between adding the request and
+            receiving its first generated token.
+        latency (float): Seconds between adding the request and its completion.
+    """
+
+    request_id: int
+    prompt_token_ids: np.ndarray
+    token_ids: np.ndarray
+    time_to_first_token: float
+    latency: float
+
+
+class InferenceEngine:
+    """Continuous batching engine for offline or online inference.
+
+    Requests are queued with `add_request()`. Every call to `step()` inserts
+    queued requests into free decode slots and runs `decode_steps_per_sync`
+    decode steps for all slots on device. Requests that finished are returned,
+    and their slots are reused by the next queued requests.
+
+    The model must support kv caching with per-row positions and implement
+    `insert_prefill_cache()`, which is currently the case for `MaxTextModel`.
+    Prompts must fit in `model.max_prefill_length` tokens, and at most
+    `model.max_decode_length` tokens are generated per request.
+
+    Args:
+        model (kithara.Model): The model to generate with.
+        num_slots (int): Number of requests decoded concurrently. Defaults to 8.
+        stop_token_ids (List[int], optional): Token ids that stop generation.
+        max_new_tokens (int, optional): Default maximum number of generated
+            tokens per request. Defaults to `model.max_decode_length`.
+        decode_steps_per_sync (int): Number of decode steps run on device
+            before the generated tokens are transferred to the host. Higher
+            values reduce host overhead, but finished slots are only freed
+            after the last step. Defaults to 8.
+
+    Example:
+        ```
+        engine = InferenceEngine(model, num_slots=16, stop_token_ids=[1])
+        results = engine.generate(list_of_prompt_token_ids, max_new_tokens=128)
+        ```
+    """
+
+    def __init__(
+        self,
+        model: "kithara.Model",
+        num_slots: int = 8,
+        stop_token_ids: Optional[List[int]] = None,
+        max_new_tokens: Optional[int] = None,
+        decode_steps_per_sync: int = 8,
+    ):
+        if not model.supports_kv_cache or model.decodes_in_lockstep:
+            raise ValueError(
+                f"{model.__class__.__name__} does not support continuous batching, "
+                "which requires kv caching with a separate position for every row."
+            )
+        self.model = model
+        self.num_slots = num_slots
+        self.stop_token_ids = set(stop_token_ids or [])
+        self.max_new_tokens = min(
+            max_new_tokens or model.max_decode_length, model.max_decode_length
+        )
+        self.decode_steps_per_sync = decode_steps_per_sync
+
+        self._queue: Deque[GenerationRequest] = collections.deque()
+        self._slots: List[Optional[GenerationRequest]] = [None] * num_slots
+        self._next_request_id = 0
+        self._prefill_and_insert_fn = jax.jit(
+            self._prefill_and_insert, donate_argnums=(2,)
+        )
+        self._decode_fn = jax.jit(self._decode, donate_argnums=(2,))
+        self._state = self._init_state()
+
+    def _variables(self):
+        return self.model._variable_values()
+
+    def _init_state(self):
+        """Empty slot state: zero kv cache, next token and position of every
+        slot, and per-slot sampling parameters."""
+        prefill_inputs = self.model._make_prefill_inputs(
+            np.zeros((self.num_slots, self.model.max_prefill_length), np.int32),
+            np.zeros((self.num_slots, self.model.max_prefill_length), np.int32),
+        )
+        _, cache_spec = jax.eval_shape(
+            self.model.stateless_prefill, *self._variables(), prefill_inputs
+        )
+        sampling_arrays = SamplingParams().to_arrays(self.num_slots)
+
+        @jax.jit
+        def init():
+            return {
+                "cache": jax.tree_util.tree_map(
+                    lambda x: jnp.zeros(x.shape, x.dtype), cache_spec
+                ),
+                "tokens": jnp.zeros((self.num_slots,), jnp.int32),
+                "positions": jnp.zeros((self.num_slots,), jnp.int32),
+                "sampling": sampling_arrays,
+            }
+
+        return init()
+
+    def _prefill_and_insert(
+        self,
+        trainable_variables,
+        non_trainable_variables,
+        state,
+        prefill_inputs,
+        prompt_length,
+        slot,
+        sampling_arrays,
+    ):
+        """Prefill a single prompt, sample its first token and insert it into
+        `slot`."""
+        logits, prefill_cache = self.model.stateless_prefill(
+            trainable_variables, non_trainable_variables, prefill_inputs
+        )
+        first_token = sample_next_tokens(
+            logits[:, prompt_length - 1], sampling_arrays, prompt_length[None]
+        )
+        return {
+            "cache": self.model.insert_prefill_cache(
+                state["cache"], prefill_cache, slot
+            ),
+            "tokens": state["tokens"].at[slot].set(first_token[0]),
+            "positions": state["positions"].at[slot].set(prompt_length),
+            "sampling": jax.tree_util.tree_map(
+                lambda full, row: jax.lax.dynamic_update_index_in_dim(
+                    full, row.astype(full.dtype), slot, 0
+                ),
+                state["sampling"],
+                sampling_arrays,
+            ),
+        }
+
+    def _decode(self, trainable_variables, non_trainable_variables, state):
+        """Run `decode_steps_per_sync` decode steps for every slot. Returns the
+        updated state and the tokens fed at every step, of shape [K, num_slots]."""
+
+        def decode_step(state, _):
+            logits, cache = self.model.stateless_decode(
+                trainable_variables,
+                non_trainable_variables,
+                state["cache"],
+                state["tokens"][:, None],
+                state["positions"][:, None],
+            )
+            positions = state["positions"] + 1
+            tokens = sample_next_tokens(logits, state["sampling"], positions)
+            new_state = {
+                **state,
+                "cache": cache,
+                "tokens": tokens.astype(jnp.int32),
+                "positions": positions,
+            }
+            return new_state, state["tokens"]
+
+        return jax.lax.scan(
+            decode_step, state, None, length=self.decode_steps_per_sync
+        )
+
+    def add_request(
+        self,
+        prompt_token_ids: Sequence[int],
+        max_new_tokens: Optional[int] = None,
+        sampling_params: Optional[SamplingParams] = None,
+    ) -> int:
+        """Queue a prompt for generation.
+
+        Args:
+            prompt_token_ids (Sequence[int]): Unpadded prompt tokens.
+            max_new_tokens (int, optional): Maximum number of generated tokens.
+                Defaults to the engine's `max_new_tokens`.
+            sampling_params (kithara.SamplingParams, optional): Sampling
+                parameters of this request. Defaults to greedy decoding.
+
+        Returns:
+            int: The request id.
+        """
+        prompt_token_ids = np.asarray(prompt_token_ids, dtype=np.int32)
+        if not 0 < len(prompt_token_ids) <= self.model.max_prefill_length:
+            raise ValueError(
+                f"Prompt length must be between 1 and {self.model.max_prefill_length}, "
+                f"but got {len(prompt_token_ids)}."
+            )
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        sampling_params = sampling_params or SamplingParams()
+        self._queue.append(
+            GenerationRequest(
+                request_id=request_id,
+                prompt_token_ids=prompt_token_ids,
+                max_new_tokens=min(
+                    max_new_tokens or self.max_new_tokens, self.max_new_tokens
+                ),
+                sampling_arrays=sampling_params.to_arrays(1, default_seed=request_id),
+                arrival_time=time.time(),
+            )
+        )
+        return request_id
+
+    @property
+    def num_pending_requests(self) -> int:
+        """Number of queued and running requests."""
+        return len(self._queue) + sum(r is not None for r in self._slots)
+
+    def _admit(self):
+        for slot, request in enumerate(self._slots):
+            if request is not None:
+                continue
+            if not self._queue:
+                return
+            request = self._queue.popleft()
+            prompt_length = len(request.prompt_token_ids)
+            prefill_length = get_bucket_size(
+                prompt_length, min_size=16, max_size=self.model.max_prefill_length
+            )
+            token_ids = np.zeros((1, prefill_length), np.int32)
+            token_ids[0, :prompt_length] = request.prompt_token_ids
+            padding_mask = (np.arange(prefill_length) < prompt_length)[None, :]
+            self._state = self._prefill_and_insert_fn(
+                *self._variables(),
+                self._state,
+                self.model._make_prefill_inputs(
+                    token_ids, padding_mask.astype(np.int32)
+                ),
+                np.int32(prompt_length),
+                np.int32(slot),
+                request.sampling_arrays,
+            )
+            self._slots[slot] = request
+
+    def step(self) -> List[GenerationResult]:
+        """Admit queued requests into free slots and run one round of decode
+        steps.
+
+        Returns:
+            List[GenerationResult]: Requests that finished during this step.
+        """
+        self._admit()
+        if all(request is None for request in self._slots):
+            return []
+        self._state, tokens = self._decode_fn(*self._variables(), self._state)
+        tokens = np.asarray(multihost_utils.process_allgather(tokens, tiled=True))
+        now = time.time()
+
+        finished = []
+        for slot, request in enumerate(self._slots):
+            if request is None:
+                continue
+            if request.first_token_time is None:
+                request.first_token_time = now
+            for token in tokens[:, slot]:
+                request.token_ids.append(int(token))
+                if (
+                    token in self.stop_token_ids
+                    or len(request.token_ids) >= request.max_new_tokens
+                ):
+                    finished.append(
+                        GenerationResult(
+                            request_id=request.request_id,
+                            prompt_token_ids=request.prompt_token_ids,
+                            token_ids=np.array(request.token_ids, dtype=np.int32),
+                            time_to_first_token=request.first_token_time
+                            - request.arrival_time,
+                            latency=now - request.arrival_time,
+                        )
+                    )
+                    self._slots[slot] = None
+                    break
+        return finished
+
+    def generate(
+        self,
+        prompts: List[Sequence[int]],
+        max_new_tokens: Optional[int] = None,
+        sampling_params: Optional[SamplingParams] = None,
+    ) -> List[GenerationResult]:
+        """Generate for all `prompts` and return the results in prompt order.
+
+        Args:
+            prompts (List[Sequence[int]]): Unpadded prompt tokens.
+            For the rest of the args, please refer to `add_request()`.
+
+        Returns:
+            List[GenerationResult]: One result per prompt.
+        """
+        request_ids = [
+            self.add_request(prompt, max_new_tokens, sampling_params)
+            for prompt in prompts
+        ]
+        results = {}
+        while self.num_pending_requests:
+            for result in self.step():
+                results[result.request_id] = result
+        return [results[request_id] for request_id in request_ids]
@@ -0,0 +1,213 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Reuse of the kv cache of shared prompt prefixes across generation calls.
+
+Prompts are split into blocks of `block_size` tokens. Every block is
+identified by a hash of its tokens and of all tokens before it, so a block
+hash identifies the whole prefix up to the end of the block. The kv cache of
+every full prompt block is stored on device after prefill, and prompts
+starting with stored blocks only prefill the remaining tokens.
+"""
+
+import collections
+import weakref
+import jax
+import jax.numpy as jnp
+import numpy as np
+from typing import Any, List, Optional, Sequence, Tuple
+
+
+class PrefixCache:
+    """LRU cache of kv cache blocks keyed by token prefix.
+
+    Blocks are evicted in least recently used order once their total size
+    exceeds `max_memory_bytes`. The cache is cleared whenever the model
+    variables change, as the stored keys and values are only valid for the
+    weights they were computed with.
+
+    Args:
+        block_size (int): Number of tokens per block. Only full blocks are
+            cached. Defaults to 64.
+        max_memory_bytes (int): Device memory budget for the stored blocks.
+            Defaults to 1 GiB.
+    """
+
+    def __init__(self, block_size: int = 64, max_memory_bytes: int = 1 << 30):
+        if block_size < 1:
+            raise ValueError(f"block_size must be positive, but got {block_size}.")
+        self.block_size = block_size
+        self.max_memory_bytes = max_memory_bytes
+        self._blocks = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._variable_refs = []
+        self.num_cached_tokens = 0
+        self.num_prompt_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def __contains__(self, block_hash: int) -> bool:
+        return block_hash in self._blocks
+
+    @property
+    def memory_bytes(self) -> int:
+        """Total size of the stored blocks."""
+        return self._memory_bytes
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of prompt tokens whose kv cache was reused."""
+        return self.num_cached_tokens / max(self.num_prompt_tokens, 1)
+
+    def clear(self):
+        """Drop all stored blocks."""
+        self._blocks.clear()
+        self._memory_bytes = 0
+
+    def validate_variables(self, variables: Sequence[Any]):
+        """Clear the cache if any of `variables` was assigned a new value
+        since the last call."""
+        values = [v.value for v in variables]
+        if len(values) != len(self._variable_refs) or any(
+            ref() is not value for ref, value in zip(self._variable_refs, values)
+        ):
+            self.clear()
+            self._variable_refs = [weakref.ref(value) for value in values]
+
+    def block_hashes(self, token_ids: Sequence[int]) -> List[int]:
+        """Hashes of the full blocks of `token_ids`."""
+        hashes, parent_hash = [], None
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block = tuple(int(t) for t in token_ids[start : start + self.block_size])
+            parent_hash = hash((parent_hash, block))
+            hashes.append(parent_hash)
+        return hashes
+
+    def lookup(self, block_hashes: Sequence[int]) -> List[Any]:
+        """Return the stored blocks of the longest cached prefix of
+        `block_hashes`, marking them as recently used."""
+        blocks = []
+        for block_hash in block_hashes:
+            if block_hash not in self._blocks:
+                break
+            self._blocks.move_to_end(block_hash)
+            blocks.append(self._blocks[block_hash])
+        return blocks
+
+    def insert(self, block_hash: int, block: Any):
+        """Store a block, evicting least recently used blocks to stay within
+        the memory budget. Blocks larger than the budget are not stored."""
+        if block_hash in self._blocks:
+            self._blocks.move_to_end(block_hash)
+            return
+        size = sum(x.nbytes for x in jax.tree_util.tree_leaves(block))
+        if size > self.max_memory_bytes:
+            return
+        self._blocks[block_hash] = block
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self._memory_bytes -= sum(
+                x.nbytes for x in jax.tree_util.tree_leaves(evicted)
+            )
+
+
+def build_prefix_kv_cache(
+    prefix_cache: PrefixCache,
+    token_ids: np.ndarray,
+    prompt_lengths: np.ndarray,
+    cache_axes: Tuple[int, int],
+) -> Tuple[Optional[Any], List[List[int]]]:
+    """Assemble the cached kv prefix shared by the rows of a batch.
+
+    All rows reuse the same number of blocks, which is the smallest number
+    of cached blocks of any prompt. The last token of every prompt is never
+    taken from the cache, so that prefill still produces its logits.
+
+    Args:
+        prefix_cache (PrefixCache): The block store.
+        token_ids (np.ndarray): Right-padded prompts of shape [B, S].
+        prompt_lengths (np.ndarray): Prompt length of every row. Rows of
+            length 0 are batch padding.
+        cache_axes (tuple): Batch and sequence axis of the kv cache arrays.
+
+    Returns:
+        tuple: (kv cache of the prefix with the same structure as the model's
+            kv cache, or None if no prefix is cached, block hashes of every row)
+    """
+    batch_axis, sequence_axis = cache_axes
+    block_size = prefix_cache.block_size
+    hashes = [
+        prefix_cache.block_hashes(row[:length])
+        for row, length in zip(token_ids, prompt_lengths)
+    ]
+    rows = [i for i, length in enumerate(prompt_lengths) if length > 0]
+    cached_blocks = {
+        i: prefix_cache.lookup(hashes[i][: (prompt_lengths[i] - 1) // block_size])
+        for i in rows
+    }
+    num_blocks = min((len(blocks) for blocks in cached_blocks.values()), default=0)
+    prefix_cache.num_prompt_tokens += int(np.sum(prompt_lengths))
+    prefix_cache.num_cached_tokens += num_blocks * block_size * len(rows)
+    if num_blocks == 0:
+        return None, hashes
+
+    # Rows with the same prefix share the concatenated blocks.
+    concatenated = {}
+    for i in rows:
+        key = tuple(hashes[i][:num_blocks])
+        if key not in concatenated:
+            concatenated[key] = jax.tree_util.tree_map(
+                lambda *blocks: jnp.concatenate(blocks, axis=sequence_axis),
+                *cached_blocks[i][:num_blocks],
+            )
+    # Batch padding rows get an empty prefix.
+    concatenated[None] = jax.tree_util.tree_map(
+        jnp.zeros_like, next(iter(concatenated.values()))
+    )
+    row_prefixes = [
+        concatenated[tuple(hashes[i][:num_blocks]) if i in cached_blocks else None]
+        for i in range(len(token_ids))
+    ]
+    prefix = jax.tree_util.tree_map(
+        lambda *rows: jnp.concatenate(rows, axis=batch_axis), *row_prefixes
+    )
+    return prefix, hashes
+
+
+def store_prefix_blocks(
+    prefix_cache: PrefixCache,
+    cache: Any,
+    block_hashes: List[List[int]],
+    cache_axes: Tuple[int, int],
+):
+    """Store every full prompt block of a prefilled kv cache that is not
+    cached yet. Blocks shared by several rows are stored once."""
+    batch_axis, sequence_axis = cache_axes
+    block_size = prefix_cache.block_size
+    for row, hashes in enumerate(block_hashes):
+        for i, block_hash in enumerate(hashes):
+            if block_hash in prefix_cache:
+                continue
+
+            def slice_block(x):
+                x = jax.lax.slice_in_dim(x, row, row + 1, axis=batch_axis)
+                return jax.lax.slice_in_dim(
+                    x, i * block_size, (i + 1) * block_size, axis=sequence_axis
+                )
+
+            prefix_cache.insert(block_hash, jax.tree_util.tree_map(slice_block, cache))
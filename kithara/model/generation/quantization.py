@@ -0,0 +1,106 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Weight-only quantization for inference.
+
+Kernels are stored as int8 or int4 values with one symmetric scale per output
+channel. Quantized kernels are passed to the jitted generation functions in
+place of the variable values, and are dequantized right before the model
+reads them, so XLA fuses the dequantization into the consuming matmul and
+only the quantized values are read from device memory.
+"""
+
+import jax
+import jax.numpy as jnp
+from functools import partial
+from typing import Any, Sequence
+
+QUANTIZATION_MODES = {"int8": 8, "int4": 4}
+
+
+@jax.tree_util.register_pytree_node_class
+class QuantizedArray:
+    """An array stored as `values * scale`.
+
+    Attributes:
+        values: Integer values with the shape of the original array.
+        scale: Per-channel scales, broadcastable to `values`.
+        dtype: Dtype of the dequantized array.
+    """
+
+    def __init__(self, values: jax.Array, scale: jax.Array, dtype):
+        self.values = values
+        self.scale = scale
+        self.dtype = jnp.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.values.size * jnp.iinfo(self.values.dtype).bits // 8
+            + self.scale.nbytes
+        )
+
+    def dequantize(self) -> jax.Array:
+        return (self.values.astype(self.scale.dtype) * self.scale).astype(self.dtype)
+
+    def tree_flatten(self):
+        return (self.values, self.scale), self.dtype
+
+    @classmethod
+    def tree_unflatten(cls, dtype, children):
+        return cls(*children, dtype)
+
+
+@partial(jax.jit, static_argnames=("reduce_axes", "bits"))
+def quantize_array(
+    x: jax.Array, reduce_axes: Sequence[int], bits: int = 8
+) -> QuantizedArray:
+    """Symmetric absmax quantization of `x`, with one scale for every index
+    of the axes that are not in `reduce_axes`.
+
+    Args:
+        x: Floating point array.
+        reduce_axes: Axes sharing a scale, usually the input (contracting)
+            axes of a kernel.
+        bits: 8 or 4.
+
+    Returns:
+        QuantizedArray: The quantized array. Values are stored as int8 or
+            jnp.int4.
+    """
+    if bits not in QUANTIZATION_MODES.values():
+        raise ValueError(f"Unsupported number of bits: {bits}")
+    qmax = 2 ** (bits - 1) - 1
+    x32 = x.astype(jnp.float32)
+    absmax = jnp.max(jnp.abs(x32), axis=tuple(reduce_axes), keepdims=True)
+    scale = jnp.where(absmax > 0, absmax / qmax, 1.0)
+    values = jnp.clip(jnp.round(x32 / scale), -qmax, qmax)
+    values = values.astype(jnp.int8 if bits == 8 else jnp.int4)
+    return QuantizedArray(values, scale, x.dtype)
+
+
+def dequantize_variables(values: Any) -> Any:
+    """Dequantize every `QuantizedArray` in a pytree of variable values.
+    Other leaves are returned unchanged."""
+    return jax.tree_util.tree_map(
+        lambda x: x.dequantize() if isinstance(x, QuantizedArray) else x,
+        values,
+        is_leaf=lambda x: isinstance(x, QuantizedArray),
+    )
@@ -0,0 +1,178 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Batched on-device token sampling.
+
+Every row of a batch carries its own sampling parameters and PRNG key, so
+requests with different settings can be decoded together at the same
+throughput as greedy decoding.
+"""
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+
+@dataclass
+class SamplingParams:
+    """Sampling parameters for `Model.generate()`.
+
+    Every field is either a single value that applies to all prompts, or a
+    list with one value per prompt.
+
+    Args:
+        temperature (float): Softmax temperature. A temperature of 0 selects
+            the most likely token (greedy decoding). Defaults to 0.
+        top_k (int): Only sample from the `top_k` most likely tokens. 0
+            disables top-k filtering. Defaults to 0.
+        top_p (float): Only sample from the smallest set of most likely tokens
+            whose cumulative probability is at least `top_p` (nucleus
+            sampling). Defaults to 1.0, which disables top-p filtering.
+        min_p (float): Only sample from tokens whose probability is at least
+            `min_p` times the probability of the most likely token. Defaults to
+            0, which disables min-p filtering.
+        seed (int, optional): Seed of the PRNG key. If a single seed is given,
+            a key is derived for every prompt. If None, a different seed is
+            used for every `generate()` call.
+
+    Example:
+        ```
+        model.generate(
+            prompts,
+            tokenizer_handle="hf://google/gemma-2-2b",
+            sampling_params=SamplingParams(temperature=0.7, top_p=0.9, seed=0),
+        )
+        ```
+    """
+
+    temperature: Union[float, List[float]] = 0.0
+    top_k: Union[int, List[int]] = 0
+    top_p: Union[float, List[float]] = 1.0
+    min_p: Union[float, List[float]] = 0.0
+    seed: Optional[Union[int, List[int]]] = None
+
+    def to_arrays(self, batch_size: int, default_seed: int = 0) -> Dict[str, np.ndarray]:
+        """Convert to per-row arrays consumed by `sample_next_tokens()`.
+
+        Args:
+            batch_size (int): Number of prompts.
+            default_seed (int): Seed to use if `seed` is None.
+
+        Returns:
+            dict: Arrays of shape [B] for "temperature", "top_k", "top_p" and
+                "min_p", and an array of shape [B, 2] for "rng_keys".
+        """
+
+        def per_row(value, dtype):
+            value = np.asarray(value, dtype=dtype)
+            if value.ndim == 0:
+                return np.full((batch_size,), value, dtype=dtype)
+            if value.shape != (batch_size,):
+                raise ValueError(
+                    f"Expected one sampling parameter per prompt ({batch_size}), "
+                    f"but got {value.shape[0]}."
+                )
+            return value
+
+        seed = default_seed if self.seed is None else self.seed
+        if np.ndim(seed) == 0:
+            rng_keys = jax.random.split(jax.random.PRNGKey(seed), batch_size)
+        else:
+            rng_keys = jnp.stack([jax.random.PRNGKey(s) for s in per_row(seed, np.int64)])
+
+        return {
+            "temperature": per_row(self.temperature, np.float32),
+            "top_k": per_row(self.top_k, np.int32),
+            "top_p": per_row(self.top_p, np.float32),
+            "min_p": per_row(self.min_p, np.float32),
+            "rng_keys": np.asarray(rng_keys, dtype=np.uint32),
+        }
+
+
+def filter_logits(
+    logits: jax.Array, sampling_params: Dict[str, jax.Array]
+) -> jax.Array:
+    """Apply the temperature, top-k, top-p and min-p of every row to `logits`.
+
+    Top-k filtering is applied first, top-p and min-p filtering are applied
+    to the renormalized top-k distribution. Filtered tokens get a logit of
+    -inf. The temperature of greedy rows is ignored.
+
+    Args:
+        logits: Logits of shape [B, V].
+        sampling_params: Per-row arrays, as returned by `SamplingParams.to_arrays()`.
+
+    Returns:
+        jax.Array: float32 logits of shape [B, V] defining the sampling
+            distribution of every row.
+    """
+    logits = logits.astype(jnp.float32)
+    batch_size, vocab_size = logits.shape
+    temperature = sampling_params["temperature"]
+    scaled_logits = logits / jnp.where(temperature <= 0, 1.0, temperature)[:, None]
+    sorted_logits, sorted_indices = jax.lax.top_k(scaled_logits, vocab_size)
+    ranks = jnp.arange(vocab_size)[None, :]
+
+    top_k = sampling_params["top_k"]
+    top_k = jnp.where(top_k > 0, top_k, vocab_size)
+    sorted_logits = jnp.where(ranks < top_k[:, None], sorted_logits, -jnp.inf)
+
+    probs = jax.nn.softmax(sorted_logits, axis=-1)
+    # Keep a token if the probability mass before it is below top_p,
+    # which always keeps the most likely token.
+    keep = (jnp.cumsum(probs, axis=-1) - probs) < sampling_params["top_p"][:, None]
+    keep &= probs >= sampling_params["min_p"][:, None] * probs[:, :1]
+    sorted_logits = jnp.where(keep, sorted_logits, -jnp.inf)
+
+    batch_index = jnp.arange(batch_size)[:, None]
+    return jnp.empty_like(sorted_logits).at[batch_index, sorted_indices].set(
+        sorted_logits
+    )
+
+
+def sample_next_tokens(
+    logits: jax.Array, sampling_params: Dict[str, jax.Array], positions: jax.Array
+) -> jax.Array:
+    """Sample one token per row from `logits`.
+
+    Rows with a temperature of 0 use greedy decoding, the other rows sample
+    from the distribution given by `filter_logits()`. When every row is
+    greedy, the vocabulary sort is skipped.
+
+    Args:
+        logits: Logits of shape [B, V].
+        sampling_params: Per-row arrays, as returned by `SamplingParams.to_arrays()`.
+        positions: Position of the sampled token in each row, of shape [B].
+            The PRNG key of a row is folded with its position, so that the
+            sampled sequence of a prompt does not depend on the other prompts
+            in the batch.
+
+    Returns:
+        jax.Array: Sampled token ids of shape [B].
+    """
+    is_greedy = sampling_params["temperature"] <= 0
+    greedy_tokens = jnp.argmax(logits, axis=-1)
+
+    def sample():
+        keys = jax.vmap(jax.random.fold_in)(sampling_params["rng_keys"], positions)
+        return jax.vmap(jax.random.categorical)(
+            keys, filter_logits(logits, sampling_params)
+        )
+
+    sampled_tokens = jax.lax.cond(jnp.all(is_greedy), lambda: greedy_tokens, sample)
+    return jnp.where(is_greedy, greedy_tokens, sampled_tokens)
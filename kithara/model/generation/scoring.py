@@ -0,0 +1,107 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""On-device log-likelihood scoring.
+
+The log-probabilities of the labels are gathered from the logits on device,
+so only per-token and per-sequence scores are transferred back to the host,
+never the [B, S, V] logits.
+"""
+
+import jax
+import jax.numpy as jnp
+from typing import Any, Dict, Tuple
+from kithara.model.generation.quantization import dequantize_variables
+
+
+def token_log_probs(logits: jax.Array, labels: jax.Array) -> jax.Array:
+    """Log-probability of every label, without materializing the full
+    log-softmax.
+
+    Args:
+        logits: Logits of shape [B, S, V].
+        labels: Label ids of shape [B, S].
+
+    Returns:
+        jax.Array: float32 log-probabilities of shape [B, S].
+    """
+    logits = logits.astype(jnp.float32)
+    label_logits = jnp.take_along_axis(logits, labels[..., None], axis=-1)[..., 0]
+    return label_logits - jax.nn.logsumexp(logits, axis=-1)
+
+
+def reduce_scores(
+    logits: jax.Array, labels: jax.Array, label_mask: jax.Array
+) -> Dict[str, jax.Array]:
+    """Score the labels where `label_mask` is True.
+
+    Returns:
+        dict: Dictionary containing
+            - 'log_probs': Sum of the scored log-probabilities of each row [B].
+            - 'num_tokens': Number of scored labels of each row [B].
+            - 'is_greedy': Whether every scored label is the argmax of its
+              logits [B].
+            - 'token_log_probs': Log-probability of every label, 0 where
+              unscored [B, S].
+    """
+    label_mask = label_mask.astype(bool)
+    labels = jnp.where(label_mask, labels, 0)
+    log_probs = jnp.where(label_mask, token_log_probs(logits, labels), 0.0)
+    is_greedy = (jnp.argmax(logits, axis=-1) == labels) | ~label_mask
+    return {
+        "log_probs": jnp.sum(log_probs, axis=-1),
+        "num_tokens": jnp.sum(label_mask, axis=-1, dtype=jnp.int32),
+        "is_greedy": jnp.all(is_greedy, axis=-1),
+        "token_log_probs": log_probs,
+    }
+
+
+def score_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    x: Dict[str, jax.Array],
+    labels: jax.Array,
+    label_mask: jax.Array,
+) -> Dict[str, jax.Array]:
+    """Run one forward pass and score `labels`. See `reduce_scores()`."""
+    logits, _ = model.model.stateless_call(
+        dequantize_variables(trainable_variables),
+        dequantize_variables(non_trainable_variables),
+        x,
+        training=False,
+    )
+    return reduce_scores(logits, labels, label_mask)
+
+
+def score_with_prefill_on_device(
+    model: "kithara.Model",
+    trainable_variables,
+    non_trainable_variables,
+    prefill_inputs: Dict[str, jax.Array],
+    labels: jax.Array,
+    label_mask: jax.Array,
+) -> Tuple[Dict[str, jax.Array], Any]:
+    """Score `labels` with `model.stateless_prefill()`, which may start from
+    a cached prefix. Labels within the prefix must not be scored.
+
+    Returns:
+        tuple: (scores as returned by `reduce_scores()`, kv cache)
+    """
+    logits, cache = model.stateless_prefill(
+        trainable_variables, non_trainable_variables, prefill_inputs
+    )
+    return reduce_scores(logits, labels, label_mask), cache
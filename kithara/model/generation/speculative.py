@@ -0,0 +1,263 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""On-device speculative decoding with a draft model.
+
+A small draft model proposes `num_draft_tokens` tokens, which the target
+model verifies in a single forward pass. Under greedy decoding, the output is
+identical to greedy decoding with the target model alone. Under sampling, the
+standard accept/reject scheme preserves the target model's distribution.
+"""
+
+import jax
+import jax.numpy as jnp
+from typing import Dict, Tuple
+from kithara.model.generation.sampling import filter_logits
+
+
+def _sampling_keys(sampling_params, positions, stream):
+    """PRNG keys of shape [B, 2] for `positions` of shape [B]. Different
+    `stream`s give independent keys for the same position."""
+    keys = jax.vmap(jax.random.fold_in)(sampling_params["rng_keys"], positions)
+    return jax.vmap(jax.random.fold_in, in_axes=(0, None))(keys, stream)
+
+
+def speculative_generate_on_device(
+    target: "kithara.Model",
+    draft: "kithara.Model",
+    num_draft_tokens: int,
+    target_trainable_variables,
+    target_non_trainable_variables,
+    draft_trainable_variables,
+    draft_non_trainable_variables,
+    target_prefill_inputs: Dict[str, jax.Array],
+    draft_prefill_inputs: Dict[str, jax.Array],
+    token_ids: jax.Array,
+    padding_mask: jax.Array,
+    prompt_lengths: jax.Array,
+    stop_token_ids: jax.Array,
+    max_length: jax.Array,
+    sampling_params: Dict[str, jax.Array],
+) -> Tuple[jax.Array, jax.Array]:
+    """Generate tokens with speculative decoding.
+
+    Both models must support speculative decoding: their kv cache entries
+    are indexed by position, so that entries of rejected draft tokens are
+    overwritten by later steps. All rows decode in lockstep. In every
+    iteration, the batch advances by the smallest number of accepted draft
+    tokens of any unfinished row, plus one token sampled from the target
+    model. Rows with prompts longer than the shortest prompt accept their own
+    prompt tokens as drafts until their prompt ends.
+
+    Args:
+        target (kithara.Model): The model whose output is generated.
+        draft (kithara.Model): A smaller model with the same vocabulary.
+        num_draft_tokens (int): Number of tokens proposed per iteration.
+        token_ids: Token buffer of shape [B, S] holding the right-padded
+            prompts. The last `num_draft_tokens` columns must be free, as
+            draft tokens are written up to `max_length + num_draft_tokens - 1`.
+        target_prefill_inputs, draft_prefill_inputs: Input passed to the
+            `stateless_prefill()` of each model, covering the whole buffer.
+        For the rest of the args, please refer to
+            `kithara.model.generation.generate_on_device()`.
+
+    Returns:
+        tuple: (token_ids [B, S], padding_mask [B, S]).
+    """
+    k = num_draft_tokens
+    _, target_cache = target.stateless_prefill(
+        target_trainable_variables, target_non_trainable_variables, target_prefill_inputs
+    )
+    _, draft_cache = draft.stateless_prefill(
+        draft_trainable_variables, draft_non_trainable_variables, draft_prefill_inputs
+    )
+    batch_size, seq_len = token_ids.shape
+    batch_index = jnp.arange(batch_size)
+    offsets = jnp.arange(k + 1)
+    is_greedy = sampling_params["temperature"] <= 0
+    all_greedy = jnp.all(is_greedy)
+    start_index = jnp.min(jnp.where(prompt_lengths > 0, prompt_lengths, seq_len))
+    done = (prompt_lengths == 0) | (prompt_lengths >= max_length)
+
+    def prompt_tokens_at(token_ids, positions):
+        return token_ids[batch_index, jnp.minimum(positions, seq_len - 1)]
+
+    def propose(token_ids, draft_cache, index):
+        """Run k + 1 draft steps from the last committed token at `index - 1`.
+        The last step only writes the k-th draft token into the draft cache."""
+
+        def draft_step(carry, offset):
+            draft_cache, tokens = carry
+            position = jnp.full((batch_size,), index - 1 + offset, jnp.int32)
+            logits, draft_cache = draft.stateless_decode(
+                draft_trainable_variables,
+                draft_non_trainable_variables,
+                draft_cache,
+                tokens[:, None],
+                position[:, None],
+            )
+            draft_logits = jax.lax.cond(
+                all_greedy,
+                lambda: logits.astype(jnp.float32),
+                lambda: filter_logits(logits, sampling_params),
+            )
+            sampled = jax.vmap(jax.random.categorical)(
+                _sampling_keys(sampling_params, position + 1, 0), draft_logits
+            )
+            proposals = jnp.where(is_greedy, jnp.argmax(logits, axis=-1), sampled)
+            proposals = jnp.where(
+                position + 1 < prompt_lengths,
+                prompt_tokens_at(token_ids, position + 1),
+                proposals,
+            ).astype(tokens.dtype)
+            return (draft_cache, proposals), (proposals, draft_logits)
+
+        (draft_cache, _), (proposals, draft_logits) = jax.lax.scan(
+            draft_step, (draft_cache, token_ids[:, index - 1]), offsets
+        )
+        return draft_cache, proposals.T[:, :k], jnp.swapaxes(draft_logits, 0, 1)[:, :k]
+
+    def verify(target_logits, draft_tokens, draft_logits, positions):
+        """Returns whether each draft token is accepted, of shape [B, k], and
+        the token to use at each position if the drafts up to it are accepted
+        but its own draft is rejected, of shape [B, k + 1]."""
+        greedy_tokens = jnp.argmax(target_logits, axis=-1)
+        greedy_accepted = draft_tokens == greedy_tokens[:, :k]
+
+        def sampled():
+            p = jax.nn.softmax(
+                jax.vmap(filter_logits, in_axes=(1, None), out_axes=1)(
+                    target_logits, sampling_params
+                ),
+                axis=-1,
+            )
+            q = jax.nn.softmax(draft_logits, axis=-1)
+            p_draft = jnp.take_along_axis(p[:, :k], draft_tokens[..., None], -1)[..., 0]
+            q_draft = jnp.take_along_axis(q, draft_tokens[..., None], -1)[..., 0]
+            keys = jax.vmap(
+                lambda pos: _sampling_keys(sampling_params, pos, 1), out_axes=1
+            )(positions.T[:k])
+            u = jax.vmap(jax.vmap(jax.random.uniform))(keys)
+            accepted = u * q_draft < p_draft
+
+            # A rejected draft is replaced by a sample from max(p - q, 0). If
+            # every draft is accepted, the bonus token is sampled from p.
+            residual = jnp.maximum(p[:, :k] - q, 0)
+            residual = jnp.where(
+                jnp.sum(residual, axis=-1, keepdims=True) > 0, residual, p[:, :k]
+            )
+            corrections = jnp.concatenate([residual, p[:, k:]], axis=1)
+            keys = jax.vmap(
+                lambda pos: _sampling_keys(sampling_params, pos, 2), out_axes=1
+            )(positions.T)
+            tokens = jax.vmap(jax.vmap(jax.random.categorical))(
+                keys, jnp.log(corrections)
+            )
+            return (
+                jnp.where(is_greedy[:, None], greedy_accepted, accepted),
+                jnp.where(is_greedy[:, None], greedy_tokens, tokens),
+            )
+
+        return jax.lax.cond(
+            all_greedy, lambda: (greedy_accepted, greedy_tokens), sampled
+        )
+
+    def cond(state):
+        return ~jnp.all(state[-1])
+
+    def body(state):
+        index, token_ids, padding_mask, target_cache, draft_cache, done = state
+        positions = jnp.broadcast_to(index + offsets, (batch_size, k + 1))
+        in_prompt = positions < prompt_lengths[:, None]
+
+        draft_cache, draft_tokens, draft_logits = propose(token_ids, draft_cache, index)
+        target_logits, target_cache = target.stateless_extend(
+            target_trainable_variables,
+            target_non_trainable_variables,
+            target_cache,
+            jnp.concatenate(
+                [jax.lax.dynamic_slice_in_dim(token_ids, index - 1, 1, axis=1), draft_tokens],
+                axis=1,
+            ),
+            positions - 1,
+        )
+        if target_logits.shape[-1] != draft_logits.shape[-1]:
+            raise ValueError(
+                "The draft model must have the same vocabulary as the target model, "
+                f"but got {draft_logits.shape[-1]} and {target_logits.shape[-1]} tokens."
+            )
+        accepted, corrections = verify(
+            target_logits, draft_tokens, draft_logits, positions
+        )
+        accepted |= in_prompt[:, :k]
+        corrections = jnp.where(
+            in_prompt,
+            jax.vmap(lambda pos: prompt_tokens_at(token_ids, pos), out_axes=1)(
+                positions.T
+            ),
+            corrections,
+        )
+
+        # The batch advances by the smallest number of accepted drafts.
+        num_accepted = jnp.sum(jnp.cumprod(accepted, axis=1), axis=1)
+        num_accepted = jnp.min(jnp.where(done, k, num_accepted))
+        # Rows that also accepted the draft at `num_accepted` keep it, the
+        # others use the correction token sampled from the target model.
+        committed = offsets <= num_accepted
+        padded_drafts = jnp.pad(draft_tokens, ((0, 0), (0, 1)))
+        padded_accepted = jnp.pad(accepted, ((0, 0), (0, 1)))
+        last_tokens = jnp.where(
+            padded_accepted[:, num_accepted],
+            padded_drafts[:, num_accepted],
+            corrections[:, num_accepted],
+        )
+        candidates = jnp.where(
+            offsets < num_accepted, padded_drafts, last_tokens[:, None]
+        ).astype(token_ids.dtype)
+
+        is_generated = committed & ~in_prompt
+        hit_stop = is_generated & jnp.isin(candidates, stop_token_ids)
+        finished_before = (
+            done[:, None]
+            | (jnp.cumsum(hit_stop, axis=1) - hit_stop > 0)
+            | (positions >= max_length)
+        )
+        write = committed & ~finished_before
+
+        current_tokens = jax.lax.dynamic_slice(
+            token_ids, (0, index), (batch_size, k + 1)
+        )
+        current_mask = jax.lax.dynamic_slice(
+            padding_mask, (0, index), (batch_size, k + 1)
+        )
+        token_ids = jax.lax.dynamic_update_slice(
+            token_ids, jnp.where(write, candidates, current_tokens), (0, index)
+        )
+        padding_mask = jax.lax.dynamic_update_slice(
+            padding_mask,
+            jnp.where(write, 1, current_mask).astype(padding_mask.dtype),
+            (0, index),
+        )
+        index = index + num_accepted + 1
+        done = done | jnp.any(hit_stop & write, axis=1) | (index >= max_length)
+        return index, token_ids, padding_mask, target_cache, draft_cache, done
+
+    _, token_ids, padding_mask, *_ = jax.lax.while_loop(
+        cond,
+        body,
+        (start_index, token_ids, padding_mask, target_cache, draft_cache, done),
+    )
+    return token_ids, padding_mask
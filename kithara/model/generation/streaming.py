@@ -0,0 +1,52 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Incremental detokenization of streamed tokens."""
+
+import numpy as np
+from typing import List, Sequence
+
+
+class IncrementalDetokenizer:
+    """Turns the tokens of one sequence, received a few at a time, into text
+    deltas. Decoding tokens one by one drops the spaces and merges that
+    depend on neighbouring tokens, so the generated tokens are decoded
+    together and only the text that was not emitted yet is returned. Text
+    ending in an incomplete multi-byte character is held back until the
+    character is complete.
+
+    Args:
+        tokenizer: A HuggingFace tokenizer.
+        skip_special_tokens (bool): Whether to drop special tokens from the
+            text. Defaults to True.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self.text = ""
+
+    def update(self, token_ids: Sequence[int]) -> str:
+        """Add new tokens and return the newly decoded text."""
+        self.token_ids.extend(int(t) for t in np.asarray(token_ids).reshape(-1))
+        text = self.tokenizer.decode(
+            self.token_ids, skip_special_tokens=self.skip_special_tokens
+        )
+        if text.endswith("\ufffd"):
+            return ""
+        delta, self.text = text[len(self.text) :], text
+        return delta
@@ -74,3 +74,48 @@ MODEL_CONFIGS = {
     supported_models.GEMMA2_9B: gemma2_9b_config,
     supported_models.GEMMA2_27B: gemma2_27b_config,
 }
+
+
+def estimate_training_flops_per_token(model_name: str, seq_len: int) -> float:
+    """Estimate the model FLOPs of one training step, per token, for sequences
+    of `seq_len` tokens.
+
+    This counts the matmuls of the forward pass, i.e. 2 FLOPs per weight of the
+    attention, MLP and output layers plus the attention scores and values of
+    every attended position, and twice as many FLOPs in the backward pass. Like
+    the model FLOPs of MFU, it does not count rematerialization. Attention is
+    counted over the full (sliding) window, without savings from causal masking.
+
+    Args:
+        model_name (str): One of the models in `MODEL_CONFIGS`.
+        seq_len (int): Length of the training sequences.
+
+    Returns:
+        float: Estimated training FLOPs per token.
+    """
+    if model_name not in MODEL_CONFIGS:
+        raise ValueError(
+            f"Unsupported model: {model_name}. Supported: {list(MODEL_CONFIGS.keys())}"
+        )
+    config = MODEL_CONFIGS[model_name]
+    hidden_size = config.hidden_size
+    query_size = config.num_attention_heads * config.head_dim
+    key_value_size = config.num_key_value_heads * config.head_dim
+
+    # q, k, v and output projections, and the gated MLP.
+    layer_weights = hidden_size * (2 * query_size + 2 * key_value_size)
+    layer_weights += 3 * hidden_size * config.intermediate_size
+    # The output layer shares its weights with the embedding lookup.
+    weights = config.num_hidden_layers * layer_weights + hidden_size * config.vocab_size
+
+    # Gemma2 alternates sliding window and global attention layers.
+    num_sliding_window_layers = config.num_hidden_layers // 2
+    num_global_layers = config.num_hidden_layers - num_sliding_window_layers
+    attended_positions = num_global_layers * seq_len
+    sliding_window = min(seq_len, config.sliding_window)
+    attended_positions += num_sliding_window_layers * sliding_window
+    # Query-key scores and weighted values.
+    attention_flops = 2 * 2 * query_size * attended_positions
+
+    forward_flops = 2 * weights + attention_flops
+    return 3 * forward_flops
@@ -165,6 +165,10 @@ LORA_B_SUFFIX = "lora_kernel_b"
 
 LORA_BASE_SUFFIX = "kernel"
 
+# Stacked adapter weights of `KerasHubModel.enable_multi_lora()`
+MULTI_LORA_A_SUFFIX = "multi_lora_a"
+MULTI_LORA_B_SUFFIX = "multi_lora_b"
+
 # HF LORA A shape is [lora_r, dim1]
 HF_LORA_A_SUFFIX = ".lora_A.weight"
 # HF LORA B Shape is [dim2, lora_r]
@@ -32,6 +32,8 @@ from kithara.model.kerashub.ckpt_compatibility.param_mapping import (
     LORA_A_SUFFIX,
     LORA_B_SUFFIX,
     LORA_BASE_SUFFIX,
+    MULTI_LORA_A_SUFFIX,
+    MULTI_LORA_B_SUFFIX,
     HF_LORA_A_SUFFIX,
     HF_LORA_B_SUFFIX,
     HOOK_FNS,
@@ -76,7 +78,9 @@ def _save_checkpoint(
     # Process regular model weights
     if not only_save_adapters:
         for variable in model.weights:
-            if variable.path.endswith((LORA_A_SUFFIX, LORA_B_SUFFIX)):
+            if variable.path.endswith(
+                (LORA_A_SUFFIX, LORA_B_SUFFIX, MULTI_LORA_A_SUFFIX, MULTI_LORA_B_SUFFIX)
+            ):
                 continue
             weight_arrays.update(process_weight(variable, mappings))
 
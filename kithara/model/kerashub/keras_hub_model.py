@@ -15,12 +15,20 @@
  """
 
 from typing import Optional, Dict, List, Union
+import keras
+import jax
+import jax.numpy as jnp
 import numpy as np
 from transformers import AutoTokenizer
 from keras_hub.models import CausalLM
 from kithara.distributed.sharding import ShardingStrategy, PredefinedShardingStrategy
 from kithara.dataset.utils import initialize_tokenizer
-from kithara.model.hf_compatibility import get_model_name_from_preset_handle
+from kithara.model.hf_compatibility import (
+    get_model_name_from_preset_handle,
+    MODEL_CONFIGS,
+    SHAPE_MAPPING,
+)
+from kithara.model.generation import SamplingParams, TokenConstraint
 from kithara.model.model import (
     Model,
     set_precision,
@@ -31,6 +39,14 @@ from kithara.model.model import (
 from kithara.model.kerashub.ckpt_compatibility.to_huggingface import (
     save_kerashub_model_in_hf_format,
 )
+from kithara.model.kerashub.ckpt_compatibility.param_mapping import PARAM_MAPPING
+from kithara.model.kerashub.multi_lora import (
+    MULTI_LORA_A_SUFFIX,
+    MULTI_LORA_B_SUFFIX,
+    hf_module_to_layer_paths,
+    load_lora_adapter,
+    multi_lora_scope,
+)
 
 
 class KerasHubModel(Model):
@@ -50,6 +66,19 @@ class KerasHubModel(Model):
         model = KerasHubModel.from_preset("hf://google/gemma-2-2b", lora_rank=4)
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set by `enable_multi_lora()`. Maps HuggingFace module names to the
+        # layers holding the stacked adapter weights.
+        self._adapter_layers = None
+        self._max_adapters = None
+        self._max_adapter_rank = None
+        # Maps adapter ids to the handle they were loaded from.
+        self._adapters = {}
+        # Functional models returning the output of a transformer layer,
+        # keyed by layer index. See `_hidden_state_model()`.
+        self._hidden_state_models = {}
+
     @classmethod
     def from_preset(
         cls,
@@ -112,32 +141,347 @@ class KerasHubModel(Model):
             lora_rank=lora_rank,
         )
 
+    @property
+    def supports_kv_cache(self) -> bool:
+        return True
+
+    @property
+    def decodes_in_lockstep(self) -> bool:
+        # `CausalLM.call_with_cache()` takes a single cache index for the batch.
+        return True
+
+    @property
+    def prefix_cache_axes(self):
+        # The kv cache has shape [batch, layers, 2, seq_len, heads, head_dim].
+        return (0, 3)
+
+    def stateless_prefill(self, trainable_variables, non_trainable_variables, x):
+        """Seed a kv cache covering the full length of `x["token_ids"]`.
+        Follows `CausalLM._build_cache()`, but also returns the logits.
+        If `x["prefix_cache"]` is provided, it is copied to the start of the
+        cache and only the tokens after it run the forward pass. The logits
+        of the prefix positions are zero."""
+        token_ids = x["token_ids"]
+        prefix_cache = x.get("prefix_cache")
+        # Every token of a row has the same adapter id.
+        adapter_ids = x["adapter_ids"][:, 0] if "adapter_ids" in x else None
+        with self._stateless_scope(
+            trainable_variables, non_trainable_variables
+        ), multi_lora_scope(self._active_adapter_layers(adapter_ids), adapter_ids):
+            cache_spec = jax.eval_shape(
+                lambda t: self.model._build_cache(t)[1], token_ids
+            )
+            cache = jnp.zeros(cache_spec.shape, cache_spec.dtype)
+            if prefix_cache is None:
+                logits, _, cache = self.model.call_with_cache(token_ids, cache, 0)
+                return logits, self._wrap_cache(cache, adapter_ids)
+            prefix_length = prefix_cache.shape[3]
+            cache = jax.lax.dynamic_update_slice_in_dim(
+                cache, prefix_cache.astype(cache.dtype), 0, axis=3
+            )
+            logits, _, cache = self.model.call_with_cache(
+                token_ids[:, prefix_length:], cache, prefix_length
+            )
+        logits = jnp.pad(logits, ((0, 0), (prefix_length, 0), (0, 0)))
+        return logits, cache
+
+    @property
+    def supports_speculative_decoding(self) -> bool:
+        return True
+
+    def stateless_extend(
+        self, trainable_variables, non_trainable_variables, cache, token_ids, positions
+    ):
+        """Every row must decode the same positions, see `decodes_in_lockstep`."""
+        cache, adapter_ids = self._unwrap_cache(cache)
+        with self._stateless_scope(
+            trainable_variables, non_trainable_variables
+        ), multi_lora_scope(self._active_adapter_layers(adapter_ids), adapter_ids):
+            logits, _, cache = self.model.call_with_cache(
+                token_ids, cache, positions[0, 0]
+            )
+        return logits, self._wrap_cache(cache, adapter_ids)
+
+    def stateless_decode(
+        self, trainable_variables, non_trainable_variables, cache, token_ids, positions
+    ):
+        """Every row must decode the same position, see `decodes_in_lockstep`."""
+        logits, cache = self.stateless_extend(
+            trainable_variables, non_trainable_variables, cache, token_ids, positions
+        )
+        return logits[:, -1, :], cache
+
+    def stateless_hidden_states(
+        self, trainable_variables, non_trainable_variables, x, layer=None
+    ):
+        with self._stateless_scope(trainable_variables, non_trainable_variables):
+            if layer is None:
+                return self.model.backbone(x)
+            return self._hidden_state_model(layer)(x)
+
+    def output_head_variables(self):
+        return list(self.model.backbone.token_embedding.variables)
+
+    def stateless_output_head(self, head_values, hidden_states):
+        """Follows the output layer of `CausalLM`, which projects the hidden
+        states with the reversed token embedding."""
+        mapping = zip(self.output_head_variables(), head_values)
+        with keras.StatelessScope(state_mapping=mapping):
+            return self.model.backbone.token_embedding(hidden_states, reverse=True)
+
+    def _hidden_state_model(self, layer: int) -> keras.Model:
+        """A functional model sharing the backbone's weights, which returns
+        the output of transformer layer `layer`."""
+        backbone = self.model.backbone
+        num_layers = len(backbone.transformer_layers)
+        if not -num_layers <= layer < num_layers:
+            raise ValueError(
+                f"Layer {layer} is out of range for a model with {num_layers} layers."
+            )
+        layer = layer % num_layers
+        if layer not in self._hidden_state_models:
+            self._hidden_state_models[layer] = keras.Model(
+                backbone.inputs, backbone.transformer_layers[layer].output
+            )
+        return self._hidden_state_models[layer]
+
+    def reorder_kv_cache(self, cache, indices):
+        return jax.tree_util.tree_map(lambda x: jnp.take(x, indices, axis=0), cache)
+
+    def _quantization_reduce_axes(self):
+        """Quantize the kernels of the Dense and EinsumDense layers. LoRA
+        weights and embeddings are left in full precision."""
+        reduce_axes = {}
+        for layer in self.model._flatten_layers(include_self=False):
+            if isinstance(layer, keras.layers.Dense):
+                reduce_axes[layer._kernel.path] = (0,)
+            elif isinstance(layer, keras.layers.EinsumDense):
+                input_spec, kernel_spec = layer.equation.split("->")[0].split(",")
+                reduce_axes[layer._kernel.path] = tuple(
+                    i for i, axis in enumerate(kernel_spec) if axis in input_spec
+                )
+        return reduce_axes
+
+    @property
+    def supports_multi_lora(self) -> bool:
+        return True
+
+    def enable_multi_lora(
+        self,
+        max_adapters: int,
+        max_rank: int,
+        target_modules: Optional[List[str]] = None,
+    ):
+        """Reserve memory for up to `max_adapters` LoRA adapters, which are
+        loaded with `load_adapter()` and selected per prompt with the
+        `adapter_ids` argument of `generate()`. All adapters share the base
+        model weights, and a batch may mix prompts of different adapters.
+
+        Args:
+            max_adapters (int): Maximum number of adapters loaded at once.
+            max_rank (int): Maximum rank of the adapters.
+            target_modules (List[str], optional): Names of the HuggingFace
+                modules that adapters may target, e.g. "q_proj" or "down_proj".
+                Defaults to ["q_proj", "v_proj"], which matches the adapters
+                trained with `lora_rank`.
+
+        Example:
+            ```
+            model.enable_multi_lora(max_adapters=8, max_rank=16)
+            french = model.load_adapter("gs://bucket/adapters/french")
+            german = model.load_adapter("gs://bucket/adapters/german")
+            model.generate(["hello", "hello"], tokenizer=tokenizer, adapter_ids=[french, german])
+            ```
+        """
+        if self.model_name not in PARAM_MAPPING:
+            raise ValueError(
+                f"Multi-LoRA inference is not supported for {self.model_name}."
+            )
+        if self._adapter_layers is not None:
+            raise ValueError("Multi-LoRA inference is already enabled.")
+        target_modules = target_modules or ["q_proj", "v_proj"]
+        config = MODEL_CONFIGS[self.model_name].to_dict()
+        shapes = SHAPE_MAPPING[self.model_name](config)
+        module_paths = hf_module_to_layer_paths(PARAM_MAPPING[self.model_name](config))
+        layers = {}
+        for layer in self.model._flatten_layers(include_self=False):
+            kernel = getattr(layer, "_kernel", None)
+            if kernel is not None:
+                layers[kernel.path[: -len("/kernel")]] = layer
+
+        self._adapter_layers = {}
+        for module, path in module_paths.items():
+            if module.rsplit(".", 1)[-1] not in target_modules:
+                continue
+            out_features, in_features = shapes[module + ".weight"]
+            layer = layers[path]
+            layer._tracker.unlock()
+            for name, shape in [
+                (MULTI_LORA_A_SUFFIX, (max_adapters + 1, max_rank, in_features)),
+                (MULTI_LORA_B_SUFFIX, (max_adapters + 1, out_features, max_rank)),
+            ]:
+                setattr(
+                    layer,
+                    name,
+                    layer.add_weight(
+                        name=name, shape=shape, initializer="zeros", trainable=False
+                    ),
+                )
+            layer._tracker.lock()
+            self._adapter_layers[module] = layer
+        self._max_adapters = max_adapters
+        self._max_adapter_rank = max_rank
+        # The compiled functions take the model variables as arguments.
+        self.clear_compiled_generate_fns()
+
+    def load_adapter(self, preset_handle: str) -> int:
+        """Load a LoRA adapter saved in HuggingFace's peft format, such as the
+        adapters written by `save_in_hf_format(only_save_adapters=True)`.
+        Requires `enable_multi_lora()`.
+
+        Args:
+            preset_handle (str): Local directory, "hf://" or "gs://" path
+                containing `adapter_config.json` and `adapter_model.safetensors`.
+
+        Returns:
+            int: The adapter id to pass to `generate()`.
+        """
+        if self._adapter_layers is None:
+            raise ValueError("Please call `enable_multi_lora()` first.")
+        free_ids = [
+            i for i in range(1, self._max_adapters + 1) if i not in self._adapters
+        ]
+        if not free_ids:
+            raise ValueError(
+                f"All {self._max_adapters} adapter slots are in use, please call "
+                "`unload_adapter()` first."
+            )
+        weights, rank = load_lora_adapter(preset_handle)
+        unsupported = set(weights) - set(self._adapter_layers)
+        if unsupported:
+            raise ValueError(
+                f"Adapter {preset_handle} targets modules that were not enabled "
+                f"in `enable_multi_lora()`: {sorted(unsupported)}."
+            )
+        if rank > self._max_adapter_rank:
+            raise ValueError(
+                f"Adapter {preset_handle} has rank {rank}, but the maximum rank is "
+                f"{self._max_adapter_rank}."
+            )
+        adapter_id = free_ids[0]
+        self._set_adapter_weights(adapter_id, weights)
+        self._adapters[adapter_id] = preset_handle
+        return adapter_id
+
+    def unload_adapter(self, adapter_id: int):
+        """Free the slot of a loaded adapter."""
+        if adapter_id not in self._adapters:
+            raise ValueError(f"No adapter is loaded with id {adapter_id}.")
+        self._set_adapter_weights(adapter_id, {})
+        del self._adapters[adapter_id]
+
+    @property
+    def adapters(self) -> Dict[int, str]:
+        """The handles of the loaded adapters, keyed by adapter id."""
+        return dict(self._adapters)
+
+    def _set_adapter_weights(self, adapter_id: int, weights: Dict[str, tuple]):
+        """Write the weights of one adapter, padded to the maximum rank.
+        Modules that the adapter does not target are set to zero."""
+        for module, layer in self._adapter_layers.items():
+            variable_a = getattr(layer, MULTI_LORA_A_SUFFIX)
+            variable_b = getattr(layer, MULTI_LORA_B_SUFFIX)
+            weight_a = np.zeros(variable_a.shape[1:], dtype=np.float32)
+            weight_b = np.zeros(variable_b.shape[1:], dtype=np.float32)
+            if module in weights:
+                rank = weights[module][0].shape[0]
+                weight_a[:rank] = weights[module][0]
+                weight_b[:, :rank] = weights[module][1]
+            variable_a.assign(variable_a.value.at[adapter_id].set(weight_a))
+            variable_b.assign(variable_b.value.at[adapter_id].set(weight_b))
+
+    def _active_adapter_layers(self, adapter_ids) -> list:
+        """The layers that apply adapters, or none without adapter ids."""
+        if adapter_ids is None:
+            return []
+        return list(self._adapter_layers.values())
+
+    @staticmethod
+    def _wrap_cache(cache, adapter_ids):
+        """With adapters, the adapter id of every row is carried along with
+        the kv cache, so that decoding steps apply the same adapters."""
+        if adapter_ids is None:
+            return cache
+        return {"kv": cache, "adapter_ids": adapter_ids}
+
+    @staticmethod
+    def _unwrap_cache(cache):
+        if isinstance(cache, dict):
+            return cache["kv"], cache["adapter_ids"]
+        return cache, None
+
     def _generate(
         self,
         model_input,
-        stop_token_ids=None,
-        strip_prompt=False,
+        max_length: int = None,
+        stop_token_ids: Optional[List] = None,
+        strip_prompt: bool = False,
+        sampling_params: Optional[SamplingParams] = None,
+        draft_model: Optional[Model] = None,
+        num_draft_tokens: int = 4,
+        steps_per_chunk: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        constraint: Optional[TokenConstraint] = None,
+        adapter_ids: Optional[np.ndarray] = None,
         **kwargs,
     ) -> Dict[str, np.ndarray]:
-        """Fall back to https://github.com/keras-team/keras-hub/blob/master/keras_hub/src/models/causal_lm.py"""
-
-        # stop_token_ids cannot be an empty list
-        stop_token_ids = stop_token_ids if stop_token_ids else None
+        """Generate tokens with kv caching, running the whole decoding loop on
+        device. Prompts in a batch may have different lengths. The prompt is
+        processed with a single prefill step over the token buffer, after which
+        every new token only runs the forward pass for one position, or with
+        a draft model, every `num_draft_tokens` tokens run one verification
+        pass of this model.
+        """
+        if stop_token_ids is None:
+            stop_token_ids = []
+        if max_length is not None and max_length < 1:
+            raise ValueError("Please either a positive max_length.")
 
-        tokens = self.model.generate(
-            model_input,
+        token_ids = np.asarray(model_input["token_ids"])
+        padding_mask = np.asarray(model_input["padding_mask"])
+        seq_len = token_ids.shape[1]
+        max_length = min(seq_len, max_length) if max_length else seq_len
+        if draft_model is not None:
+            # Drafts are written up to `num_draft_tokens` past `max_length`.
+            token_ids = np.pad(token_ids, ((0, 0), (0, num_draft_tokens)))
+            padding_mask = np.pad(padding_mask, ((0, 0), (0, num_draft_tokens)))
+        prefill_inputs = {"token_ids": token_ids, "padding_mask": padding_mask}
+        if adapter_ids is not None:
+            if self._adapter_layers is None:
+                raise ValueError(
+                    "Please call `enable_multi_lora()` before passing `adapter_ids`."
+                )
+            # Ids are given per token, so that they are sharded like the tokens.
+            prefill_inputs["adapter_ids"] = np.broadcast_to(
+                adapter_ids[:, None], token_ids.shape
+            ).astype(np.int32)
+        return self._generate_with_kv_cache(
+            prefill_inputs,
+            token_ids,
+            padding_mask,
+            max_length=max_length,
             stop_token_ids=stop_token_ids,
             strip_prompt=strip_prompt,
+            sampling_params=sampling_params,
+            draft_model=draft_model,
+            num_draft_tokens=num_draft_tokens,
+            steps_per_chunk=steps_per_chunk,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            constraint=constraint,
         )
 
-        # Return output but first stripped prompt
-        is_token = tokens["padding_mask"] == True
-        B, _ = tokens["token_ids"].shape
-        return {
-            "token_ids": tokens["token_ids"][is_token][None, :].reshape(B, -1),
-            "padding_mask": tokens["padding_mask"][is_token][None, :].reshape(B, -1),
-        }
-
     def save_in_hf_format(
         self,
         output_dir: str,
@@ -0,0 +1,140 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Batched inference with several LoRA adapters on one base model.
+
+Adapters are stored side by side in fixed-size, non-trainable variables of
+the targeted layers. Every row of a batch selects its adapter by index. The
+layer output is the base projection plus `(x @ A[i].T) @ B[i].T`, where the
+adapter weights of every row are gathered from the stacked variables.
+Adapter 0 is reserved for the base model and is always zero.
+"""
+
+import contextlib
+import jax
+import jax.numpy as jnp
+import numpy as np
+import safetensors
+from typing import Dict, List, Optional, Tuple
+from keras_hub.src.utils.preset_utils import get_file, load_json
+from kithara.utils.safetensor_utils import (
+    SAFE_TENSORS_LORA_WEIGHTS_FILE,
+    SAFE_TENSORS_PEFT_CONFIG_FILE,
+)
+from kithara.model.kerashub.ckpt_compatibility.param_mapping import (
+    MULTI_LORA_A_SUFFIX,
+    MULTI_LORA_B_SUFFIX,
+)
+
+
+def hf_module_to_layer_paths(param_mapping: Dict[str, str]) -> Dict[str, str]:
+    """Map HuggingFace module names, e.g. `model.layers.0.self_attn.q_proj`,
+    to the paths of the corresponding KerasHub layers."""
+    return {
+        hf_path[: -len(".weight")]: path[: -len("/kernel")]
+        for path, hf_path in param_mapping.items()
+        if path.endswith("/kernel") and hf_path.endswith(".weight")
+    }
+
+
+def load_lora_adapter(preset_handle: str) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], int]:
+    """Load a LoRA adapter saved in HuggingFace's peft format, e.g. by
+    `KerasHubModel.save_in_hf_format(only_save_adapters=True)`.
+
+    Args:
+        preset_handle (str): Local directory, "hf://" or "gs://" path of the
+            adapter.
+
+    Returns:
+        tuple: (dictionary mapping HuggingFace module names to the (A, B)
+            weights of shape [r, in] and [out, r], with B multiplied by the
+            LoRA scaling factor, rank of the adapter)
+    """
+    config = load_json(preset_handle, SAFE_TENSORS_PEFT_CONFIG_FILE)
+    rank = config["r"]
+    alpha = config.get("lora_alpha", rank)
+    scale = alpha / np.sqrt(rank) if config.get("use_rslora") else alpha / rank
+
+    weights = {}
+    path = get_file(preset_handle, SAFE_TENSORS_LORA_WEIGHTS_FILE)
+    with safetensors.safe_open(path, framework="flax") as file:
+        for key in file.keys():
+            if not key.endswith(".lora_A.weight"):
+                continue
+            module = key[: -len(".lora_A.weight")].removeprefix("base_model.model.")
+            weight_a = np.asarray(file.get_tensor(key), dtype=np.float32)
+            weight_b = np.asarray(
+                file.get_tensor(key.replace(".lora_A.", ".lora_B.")), dtype=np.float32
+            )
+            weights[module] = (weight_a, weight_b * scale)
+    return weights, rank
+
+
+def batched_lora_delta(
+    inputs: jax.Array, lora_a: jax.Array, lora_b: jax.Array, adapter_ids: jax.Array
+) -> jax.Array:
+    """LoRA output of every row with its own adapter.
+
+    Args:
+        inputs: Layer input of shape [B, T, ...]. Trailing dimensions are
+            flattened into the input features.
+        lora_a: Stacked A weights of shape [num_adapters, r, in].
+        lora_b: Stacked B weights of shape [num_adapters, out, r].
+        adapter_ids: Adapter index of every row, of shape [B].
+
+    Returns:
+        Array of shape [B, T, out].
+    """
+    x = inputs.reshape(inputs.shape[0], inputs.shape[1], -1)
+    lora_a = lora_a[adapter_ids].astype(x.dtype)
+    lora_b = lora_b[adapter_ids].astype(x.dtype)
+    hidden = jnp.einsum("bti,bri->btr", x, lora_a)
+    return jnp.einsum("btr,bor->bto", hidden, lora_b)
+
+
+@contextlib.contextmanager
+def multi_lora_scope(layers: List, adapter_ids: Optional[jax.Array]):
+    """Within this scope, calling one of `layers` adds the output of the
+    adapter selected by `adapter_ids` for every row. Does nothing if
+    `adapter_ids` is None."""
+    if adapter_ids is None:
+        yield
+        return
+
+    def patch(layer):
+        call = layer.call
+
+        def call_with_adapters(inputs, *args, **kwargs):
+            outputs = call(inputs, *args, **kwargs)
+            delta = batched_lora_delta(
+                inputs,
+                getattr(layer, MULTI_LORA_A_SUFFIX).value,
+                getattr(layer, MULTI_LORA_B_SUFFIX).value,
+                adapter_ids,
+            )
+            return outputs + delta.reshape(outputs.shape).astype(outputs.dtype)
+
+        # Keras layers call `self.call`, so an instance attribute overrides
+        # the method without modifying the class.
+        object.__setattr__(layer, "call", call_with_adapters)
+
+    for layer in layers:
+        patch(layer)
+    try:
+        yield
+    finally:
+        for layer in layers:
+            object.__delattr__(layer, "call")
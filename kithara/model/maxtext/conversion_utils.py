@@ -221,6 +221,10 @@ class MaxTextConversionMixin:
         maxtext_config_args["per_device_batch_size"] = per_device_batch_size
         assert "max_target_length" not in maxtext_config_args
         maxtext_config_args["max_target_length"] = seq_len
+        # Split the kv cache used during generation evenly between prompt
+        # tokens (prefill) and generated tokens (autoregressive decoding).
+        if "max_prefill_predict_length" not in maxtext_config_args:
+            maxtext_config_args["max_prefill_predict_length"] = seq_len // 2
 
         maxtext_config_args = " ".join(
             [f"{key}={value}" for key, value in maxtext_config_args.items()]
@@ -15,11 +15,19 @@
  """
 
 from typing import Optional, Union, List, Dict
+import re
+import flax
+import jax
+import jax.numpy as jnp
 import numpy as np
 from transformers import AutoTokenizer
 from kithara.dataset.utils import initialize_tokenizer
 from kithara.model.hf_compatibility import get_model_name_from_preset_handle
-from kithara.model.maxtext.conversion_utils import MaxTextConversionMixin
+from kithara.model.generation import get_bucket_size, SamplingParams, TokenConstraint
+from kithara.model.maxtext.conversion_utils import (
+    MaxTextConversionMixin,
+    MaxTextLayer,
+)
 from kithara.model.maxtext.ckpt_compatibility import (
     save_maxtext_model_in_hf_format,
     load_hf_weights_into_maxtext_model,
@@ -71,7 +79,9 @@ class MaxTextModel(Model, MaxTextConversionMixin):
             scan_layers (bool, optional): Whether to use scan layers for memory efficiency.
                 Defaults to False.
             maxtext_config_args (Optional[dict], optional): Additional configuration arguments.
-                Defaults to None.
+                Defaults to None. Set `max_prefill_predict_length` to control how many
+                prompt tokens fit in the kv cache during generation (defaults to
+                `seq_len // 2`).
 
         Returns:
             MaxTextModel: A new instance of MaxTextModel with random initialization.
@@ -123,7 +133,9 @@ class MaxTextModel(Model, MaxTextConversionMixin):
                 Defaults to "mixed_float16".
             scan_layers (bool, optional): Whether to use scan layers. Defaults to False.
             maxtext_config_args (Optional[dict], optional): Additional configuration arguments.
-                Defaults to None.
+                Defaults to None. Set `max_prefill_predict_length` to control how many
+                prompt tokens fit in the kv cache during generation (defaults to
+                `seq_len // 2`).
             **kwargs: Additional keyword arguments.
 
         Returns:
@@ -185,17 +197,321 @@ class MaxTextModel(Model, MaxTextConversionMixin):
             "positions": positions,
         }
 
+    @property
+    def maxtext_layer(self) -> MaxTextLayer:
+        """The Keras layer wrapping the underlying MaxText (Flax) module."""
+        for layer in self.model.layers:
+            if isinstance(layer, MaxTextLayer):
+                return layer
+        raise ValueError("Model does not contain a MaxTextLayer.")
+
+    @property
+    def supports_kv_cache(self) -> bool:
+        return True
+
+    @property
+    def max_prefill_length(self) -> int:
+        """Maximum number of prompt tokens that fit in the prefill kv cache.
+        Configured with `max_prefill_predict_length` in `maxtext_config_args`."""
+        return self.sharding_strategy.maxtext_config.max_prefill_predict_length
+
+    @property
+    def max_decode_length(self) -> int:
+        """Maximum number of tokens that fit in the autoregressive kv cache."""
+        config = self.sharding_strategy.maxtext_config
+        return config.max_target_length - config.max_prefill_predict_length
+
+    def _quantization_reduce_axes(self):
+        """Quantize every kernel. Kernels take the embedding or mlp features
+        along axis 0, except for the attention output kernels, which take the
+        heads and head features. With `scan_layers`, axis 1 is the layers
+        axis."""
+        reduce_axes = {}
+        for variable in self.model.variables:
+            name = variable.path.split("/")[-1]
+            if not name.endswith("-kernel"):
+                continue
+            if name.endswith("-out-kernel"):
+                reduce_axes[variable.path] = (0, 2) if self.scan_layers else (0, 1)
+            else:
+                reduce_axes[variable.path] = (0,)
+        return reduce_axes
+
+    def _get_flax_variables(self, trainable_variables, non_trainable_variables):
+        """Returns the Flax variables dictionary of the MaxText module, populated
+        with the provided variable values. Safe to call inside of jitted functions."""
+        layer = self.maxtext_layer
+
+        def unwrap_variable(variable):
+            return None if variable is None else variable.value
+
+        with self._stateless_scope(trainable_variables, non_trainable_variables):
+            params = jax.tree_util.tree_map(unwrap_variable, layer.params)
+            state = jax.tree_util.tree_map(unwrap_variable, layer.state)
+        return {**(params or {}), **(state or {})}
+
+    def _apply_maxtext_module(self, variables, *args, **kwargs):
+        config = self.sharding_strategy.maxtext_config
+        with self.sharding_strategy.jax_mesh, flax.linen.partitioning.axis_rules(
+            config.logical_axis_rules
+        ):
+            return self.maxtext_layer.module.apply(
+                variables,
+                *args,
+                enable_dropout=False,
+                rngs={"params": jax.random.PRNGKey(0)},
+                mutable=["cache"],
+                **kwargs,
+            )
+
+    def stateless_prefill(self, trainable_variables, non_trainable_variables, x):
+        """Runs MaxText in `prefill` mode. Prompt tokens must be marked with
+        segment id 1 and padding tokens with segment id 0."""
+        variables = self._get_flax_variables(
+            trainable_variables, non_trainable_variables
+        )
+        logits, new_vars = self._apply_maxtext_module(
+            variables,
+            x["tokens"],
+            x["positions"],
+            x["segment_ids"],
+            model_mode="prefill",
+        )
+        return logits, new_vars["cache"]
+
+    def stateless_decode(
+        self, trainable_variables, non_trainable_variables, cache, token_ids, positions
+    ):
+        """Runs MaxText in `autoregressive` mode."""
+        variables = self._get_flax_variables(
+            trainable_variables, non_trainable_variables
+        )
+        logits, new_vars = self._apply_maxtext_module(
+            {**variables, "cache": cache},
+            token_ids,
+            positions,
+            model_mode="autoregressive",
+        )
+        return logits[:, -1, :], new_vars["cache"]
+
+    def stateless_hidden_states(
+        self, trainable_variables, non_trainable_variables, x, layer=None
+    ):
+        """Captures the output of the final normalization layer, or of the
+        MaxText decoder block `layers_{layer}`, with Flax's
+        `capture_intermediates`. The logits are not used, so XLA removes
+        their computation."""
+        if layer is None:
+            module_name = "decoder_norm"
+        elif self.scan_layers:
+            raise ValueError(
+                "Hidden states of intermediate layers are not supported with scan_layers."
+            )
+        else:
+            num_blocks = self._num_decoder_blocks()
+            if not -num_blocks <= layer < num_blocks:
+                raise ValueError(
+                    f"Layer {layer} is out of range for a model with {num_blocks} "
+                    "decoder blocks."
+                )
+            module_name = f"layers_{layer % num_blocks}"
+
+        variables = self._get_flax_variables(
+            trainable_variables, non_trainable_variables
+        )
+        _, new_vars = self._apply_maxtext_module(
+            variables,
+            x["tokens"],
+            x["positions"],
+            x["segment_ids"],
+            capture_intermediates=lambda module, method_name: (
+                module.name == module_name and method_name == "__call__"
+            ),
+        )
+        # Decoder blocks may return a tuple of (hidden states, None).
+        return jax.tree_util.tree_leaves(new_vars["intermediates"])[0]
+
+    def output_head_variables(self):
+        config = self.sharding_strategy.maxtext_config
+        suffix = (
+            "params-token_embedder-embedding"
+            if config.logits_via_embedding
+            else "params-decoder-logits_dense-kernel"
+        )
+        return [v for v in self.model.variables if v.path.endswith(suffix)]
+
+    def stateless_output_head(self, head_values, hidden_states):
+        """Follows the output layer of the MaxText decoder, which runs after
+        `decoder_norm`."""
+        config = self.sharding_strategy.maxtext_config
+        (kernel,) = head_values
+        dtype = jnp.float32 if config.logits_dot_in_fp32 else config.dtype
+        if config.logits_via_embedding:
+            logits = jnp.dot(hidden_states, jnp.asarray(kernel, dtype).T)
+            if config.normalize_embedding_logits:
+                logits = logits / jnp.sqrt(hidden_states.shape[-1])
+            if config.final_logits_soft_cap:
+                logits = logits / config.final_logits_soft_cap
+                logits = jnp.tanh(logits) * config.final_logits_soft_cap
+        else:
+            logits = jnp.dot(hidden_states.astype(dtype), kernel.astype(dtype))
+        return logits
+
+    def _num_decoder_blocks(self) -> int:
+        block_indices = set()
+        for variable in self.model.variables:
+            match = re.search(r"-layers_(\d+)-", variable.path)
+            if match:
+                block_indices.add(int(match.group(1)))
+        return len(block_indices)
+
+    def insert_prefill_cache(self, decode_cache, prefill_cache, slot):
+        """Insert a prefill cache into row `slot` of the decode cache, the same
+        way as MaxText's MaxEngine. The autoregressive keys and values are
+        shared by all rows in a ring buffer and are not copied, previous
+        entries of the row are masked out by zeroing its segment ids. The
+        prefill cache may be shorter than `max_prefill_length`."""
+
+        def insert(path, prefill_box, decode_box):
+            name = path[-1].key
+            if name == "cache_ar_index" or name.startswith("cached_ar_"):
+                return decode_box
+            decode_value = decode_box.value
+            batch_axis = next(
+                i for i, axis in enumerate(decode_box.names) if axis and "batch" in axis
+            )
+            start = [0] * decode_value.ndim
+            start[batch_axis] = slot
+            if name.endswith("segment_id"):
+                row_shape = list(decode_value.shape)
+                row_shape[batch_axis] = 1
+                decode_value = jax.lax.dynamic_update_slice(
+                    decode_value, jnp.zeros(row_shape, decode_value.dtype), start
+                )
+            if name != "cache_ar_segment_id":
+                decode_value = jax.lax.dynamic_update_slice(
+                    decode_value, prefill_box.value.astype(decode_value.dtype), start
+                )
+            return decode_box.replace_boxed(decode_value)
+
+        return jax.tree_util.tree_map_with_path(
+            insert,
+            prefill_cache,
+            decode_cache,
+            is_leaf=lambda x: isinstance(x, flax.linen.LogicallyPartitioned),
+        )
+
+    def reorder_kv_cache(self, cache, indices):
+        """Gather the rows of every cache variable with a batch axis. The ring
+        buffer index is shared by all rows and is kept as is."""
+
+        def reorder(box):
+            batch_axis = next(
+                (i for i, axis in enumerate(box.names) if axis and "batch" in axis),
+                None,
+            )
+            if batch_axis is None:
+                return box
+            return box.replace_boxed(jnp.take(box.value, indices, axis=batch_axis))
+
+        return jax.tree_util.tree_map(
+            reorder,
+            cache,
+            is_leaf=lambda x: isinstance(x, flax.linen.LogicallyPartitioned),
+        )
+
+    def _make_prefill_inputs(self, token_ids, padding_mask):
+        positions = np.broadcast_to(
+            np.arange(token_ids.shape[1], dtype=np.int32), token_ids.shape
+        )
+        return {"tokens": token_ids, "positions": positions, "segment_ids": padding_mask}
+
     def _generate(
         self,
         inputs,
+        max_length: int = None,
+        stop_token_ids: Optional[List] = None,
+        strip_prompt: bool = False,
+        sampling_params: Optional[SamplingParams] = None,
+        steps_per_chunk: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        constraint: Optional[TokenConstraint] = None,
         **kwargs,
     ):
-        """Note: Currently running inference MaxText models is slow
-        since it does not perform kv caching. This should improve with integration
-        with MaxEngine.
+        """Generate tokens with kv caching. The prompt is processed with a single
+        prefill step, after which every new token only runs the forward pass
+        for one position. Prompts in a batch may have different lengths, every
+        row decodes from the end of its own prompt. The whole decoding loop
+        runs on device. Falls back to
+        running the full forward pass for every new token when the prompt or the
+        number of new tokens does not fit in the kv cache.
         """
-        return super()._generate(
-            inputs, **kwargs, tokens_key="tokens", padding_mask_key="segment_ids"
+        if stop_token_ids is None:
+            stop_token_ids = []
+        if max_length is not None and max_length < 1:
+            raise ValueError("Please either a positive max_length.")
+
+        tokens = inputs["tokens"]
+        segment_ids = inputs["segment_ids"]
+        prompt_lengths = self._get_prompt_lengths(segment_ids)
+        longest_prompt = int(np.max(prompt_lengths))
+        seq_len = segment_ids.shape[1]
+        max_length = min(seq_len, max_length) if max_length else seq_len
+        # Rows decode in parallel, so the row with the shortest prompt
+        # determines how many autoregressive steps are needed.
+        generate_steps = max_length - int(np.min(prompt_lengths))
+
+        if (
+            longest_prompt > self.max_prefill_length
+            or generate_steps > self.max_decode_length
+        ):
+            if steps_per_chunk is not None or num_beams > 1 or constraint is not None:
+                raise ValueError(
+                    f"Prompt length ({longest_prompt}) or number of new tokens "
+                    f"({generate_steps}) exceeds the kv cache capacity "
+                    f"({self.max_prefill_length} prompt tokens, {self.max_decode_length} "
+                    "new tokens), which is required for streaming, beam search and "
+                    "constrained decoding."
+                )
+            print(
+                f"Prompt length ({longest_prompt}) or number of new tokens ({generate_steps}) "
+                f"exceeds the kv cache capacity ({self.max_prefill_length} prompt tokens, "
+                f"{self.max_decode_length} new tokens). Falling back to generation "
+                "without kv caching, which is significantly slower. Set "
+                "`max_prefill_predict_length` in `maxtext_config_args` to change "
+                "the kv cache capacity."
+            )
+            return super()._generate(
+                inputs,
+                max_length=max_length,
+                stop_token_ids=stop_token_ids,
+                strip_prompt=strip_prompt,
+                tokens_key="tokens",
+                padding_mask_key="segment_ids",
+                sampling_params=sampling_params,
+            )
+
+        # Only prefill up to the bucketed prompt length, so that prompts of
+        # similar length share the same compiled executable.
+        prefill_length = get_bucket_size(
+            longest_prompt, min_size=16, max_size=self.max_prefill_length
+        )
+        prefill_inputs = {
+            key: value[:, :prefill_length] for key, value in inputs.items()
+        }
+        return self._generate_with_kv_cache(
+            prefill_inputs,
+            tokens,
+            segment_ids,
+            max_length=max_length,
+            stop_token_ids=stop_token_ids,
+            strip_prompt=strip_prompt,
+            sampling_params=sampling_params,
+            steps_per_chunk=steps_per_chunk,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            constraint=constraint,
         )
 
     def save_in_hf_format(
@@ -16,9 +16,12 @@
 
 import keras
 import jax
+import itertools
+import os
+import concurrent.futures
 import numpy as np
 from abc import ABC, abstractmethod
-from typing import Optional, Any, List, Union, Dict
+from typing import Optional, Any, List, Union, Dict, Iterator
 from keras.src.backend.common import global_state
 from keras.distribution import set_distribution
 from kithara.distributed.sharding import ShardingStrategy
@@ -32,6 +35,35 @@ import time
 from enum import Enum
 from transformers import AutoTokenizer
 from kithara.dataset.utils import initialize_tokenizer
+from kithara.dataset.dataset import Dataset
+from kithara.dataset.dataloader import Dataloader
+from kithara.model.generation import (
+    generate_on_device,
+    prefill_on_device,
+    decode_on_device,
+    decode_chunk_on_device,
+    init_decode_state,
+    IncrementalDetokenizer,
+    speculative_generate_on_device,
+    beam_search_on_device,
+    TokenConstraint,
+    score_on_device,
+    score_with_prefill_on_device,
+    embed_on_device,
+    POOLING_MODES,
+    PrefixCache,
+    build_prefix_kv_cache,
+    store_prefix_blocks,
+    get_bucket_size,
+    SamplingParams,
+    sample_next_tokens,
+    QUANTIZATION_MODES,
+    quantize_array,
+    dequantize_variables,
+    ShardWriter,
+    PromptPrefetcher,
+)
+from functools import partial
 
 
 class ModelImplementationType(str, Enum):
@@ -86,9 +118,30 @@ class Model(ABC, ModelValidationMixin):
             Delegates any unknown attributes/methods to the underlying model.
         generate():
             Generate text tokens using the model based on the input prompt.
+        generate_stream():
+            Like `generate()`, but yields the new tokens as they are produced.
+        batch_generate():
+            Generate completions for every prompt of a dataset and write them
+            to shards, resuming after the shards of a previous run.
+        embed():
+            Compute pooled hidden-state embeddings of sequences.
         stateless_call():
             Runs the forward pass of the model in a stateless fashion. This
             function is handled by keras.model.stateless_call().
+        stateless_prefill():
+            Runs the forward pass over the prompt and returns the logits
+            together with the key/value cache. Only available on models where
+            `supports_kv_cache` is True.
+        stateless_decode():
+            Runs the forward pass for one new token per sequence, reading and
+            updating the key/value cache.
+        insert_prefill_cache():
+            Copies the key/value cache of a single prefilled prompt into one
+            row of a batched decode cache. Used for continuous batching.
+        stateless_extend():
+            Runs the forward pass for several new tokens per sequence,
+            returning the logits of every new token. Used for speculative
+            decoding.
     """
 
     def __init__(
@@ -112,6 +165,20 @@ class Model(ABC, ModelValidationMixin):
         # Tensorboard requires `model.optimizer`.
         # This will be automaticallyset during training.
         self._optimizer = None
+        # Compiled generation functions, keyed by function name and the
+        # shape, dtype and sharding of the data arguments.
+        self._compiled_generate_fns = {}
+        self._jitted_generate_step = None
+        self._jitted_sample_fn = None
+        # Seed used when `SamplingParams.seed` is None. It is incremented on
+        # every call, and stays identical across hosts.
+        self._default_sampling_seed = 0
+        # Set by `enable_prefix_caching()`.
+        self._prefix_cache = None
+        # Set by `quantize_for_inference()`. Quantized variable values,
+        # keyed by variable path.
+        self._quantization_mode = None
+        self._quantized_values = {}
 
     def __getattr__(self, name):
         try:
@@ -148,6 +215,320 @@ class Model(ABC, ModelValidationMixin):
             parallel_threads (int, optional): Number of parallel threads to use for saving.
         """
 
+    @property
+    def supports_kv_cache(self) -> bool:
+        """Whether this model implements `stateless_prefill()` and
+        `stateless_decode()`. Models that do not support kv caching
+        fall back to running the full forward pass for every new token."""
+        return False
+
+    @property
+    def decodes_in_lockstep(self) -> bool:
+        """Whether `stateless_decode()` requires every row to decode the same
+        position. If True, prompts of different lengths are decoded starting
+        after the shortest prompt, feeding the remaining prompt tokens of the
+        longer prompts."""
+        return False
+
+    @property
+    def supports_speculative_decoding(self) -> bool:
+        """Whether this model implements `stateless_extend()` and its kv cache
+        entries are indexed by position, so that the entries of rejected
+        draft tokens are overwritten by later decoding steps. Required for
+        both the target and the draft model of speculative decoding."""
+        return False
+
+    @property
+    def supports_multi_lora(self) -> bool:
+        """Whether several LoRA adapters can be loaded on top of this model
+        and selected per prompt with the `adapter_ids` argument of
+        `generate()`."""
+        return False
+
+    @property
+    def prefix_cache_axes(self) -> Optional[tuple]:
+        """The batch and sequence axis of every kv cache array, or None if
+        the model does not support prefix caching. Models that support it
+        accept a `prefix_cache` entry in the `stateless_prefill()` input,
+        holding the kv cache of the first tokens of every row, and only run
+        the forward pass for the remaining tokens. Their model input holds
+        the tokens under `token_ids`."""
+        return None
+
+    def enable_prefix_caching(
+        self, block_size: int = 64, max_memory_bytes: int = 1 << 30
+    ):
+        """Reuse the kv cache of shared prompt prefixes across `generate()`
+        calls. After prefill, the kv cache of every full block of
+        `block_size` prompt tokens is kept on device, and later prompts
+        starting with the same blocks skip prefill for them. Stored blocks
+        are evicted in least recently used order once they exceed
+        `max_memory_bytes`, and are dropped when the model variables change.
+
+        Speculative decoding does not use the prefix cache.
+
+        Args:
+            block_size (int): Number of tokens per cached block. Defaults to 64.
+            max_memory_bytes (int): Device memory budget of the cached blocks.
+                Defaults to 1 GiB.
+        """
+        if self.prefix_cache_axes is None:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support prefix caching."
+            )
+        self._prefix_cache = PrefixCache(block_size, max_memory_bytes)
+
+    def disable_prefix_caching(self):
+        """Stop reusing prompt prefixes and free the cached blocks."""
+        self._prefix_cache = None
+
+    @property
+    def prefix_cache(self) -> Optional[PrefixCache]:
+        """The prefix cache, or None if prefix caching is disabled."""
+        return self._prefix_cache
+
+    @property
+    def quantization_mode(self) -> Optional[str]:
+        """"int8" or "int4" after `quantize_for_inference()`, otherwise None."""
+        return self._quantization_mode
+
+    def _quantization_reduce_axes(self) -> Dict[str, tuple]:
+        """The input (contracting) axes of every kernel that
+        `quantize_for_inference()` quantizes, keyed by variable path. Kernels
+        get one scale for every index of their remaining axes."""
+        return {}
+
+    def quantize_for_inference(self, mode: str = "int8"):
+        """Quantize the dense kernels of the model to int8 or int4 with
+        per-channel scales, for faster and lighter generation.
+
+        Kernels are dequantized right before every matmul inside of the
+        compiled generation functions, so only the quantized kernels are
+        kept in device memory. Embeddings, normalization weights and LoRA
+        weights stay in full precision. The full precision kernels are
+        freed, so a quantized model can be used with `generate()`,
+        `generate_stream()`, `score()` and `InferenceEngine`, but can no
+        longer be trained or saved.
+
+        Args:
+            mode (str): "int8" or "int4". Defaults to "int8".
+
+        Example:
+            ```
+            model.quantize_for_inference("int8")
+            model.generate(prompt, tokenizer=tokenizer)
+            ```
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(
+                f"Unsupported quantization mode {mode}. "
+                f"Supported modes are {list(QUANTIZATION_MODES)}."
+            )
+        if self._quantization_mode is not None:
+            raise ValueError(
+                f"Model is already quantized to {self._quantization_mode}."
+            )
+        reduce_axes = self._quantization_reduce_axes()
+        for variable in self.model.variables:
+            if variable.path not in reduce_axes:
+                continue
+            value = variable.value
+            self._quantized_values[variable.path] = quantize_array(
+                value, reduce_axes[variable.path], QUANTIZATION_MODES[mode]
+            )
+            value.delete()
+        self._quantization_mode = mode
+        self.clear_compiled_generate_fns()
+        if self._prefix_cache is not None:
+            self._prefix_cache.clear()
+
+    def _variable_values(self):
+        """The (trainable, non-trainable) variable values passed to the
+        compiled generation functions. Quantized kernels are passed as
+        `QuantizedArray`s in place of their freed full precision values."""
+        return tuple(
+            [self._quantized_values.get(v.path, v.value) for v in variables]
+            for variables in (
+                self.model.trainable_variables,
+                self.model.non_trainable_variables,
+            )
+        )
+
+    def _stateless_scope(self, trainable_variables, non_trainable_variables):
+        """Returns a `keras.StatelessScope` in which the model variables
+        read the provided values instead of their current values. This allows
+        calling model methods other than `stateless_call()` inside of jitted
+        functions. Quantized values are dequantized."""
+        mapping = itertools.chain(
+            zip(
+                self.model.trainable_variables,
+                dequantize_variables(trainable_variables),
+            ),
+            zip(
+                self.model.non_trainable_variables,
+                dequantize_variables(non_trainable_variables),
+            ),
+        )
+        return keras.StatelessScope(state_mapping=mapping)
+
+    def stateless_prefill(
+        self, trainable_variables, non_trainable_variables, x: Dict[str, jax.Array]
+    ):
+        """Run the forward pass over the prompt and build the key/value cache.
+
+        Args:
+            trainable_variables: Model's trainable parameters.
+            non_trainable_variables: Model's non-trainable parameters.
+            x: Prompt input in the same format expected by `stateless_call()`.
+
+        Returns:
+            tuple: (logits of shape [B, S, V], kv cache pytree)
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support kv caching."
+        )
+
+    def stateless_decode(
+        self,
+        trainable_variables,
+        non_trainable_variables,
+        cache,
+        token_ids: jax.Array,
+        positions: jax.Array,
+    ):
+        """Run the forward pass for one new token per sequence.
+
+        Args:
+            trainable_variables: Model's trainable parameters.
+            non_trainable_variables: Model's non-trainable parameters.
+            cache: The kv cache returned by `stateless_prefill()` or a previous
+                call to `stateless_decode()`.
+            token_ids: Token ids of shape [B, 1].
+            positions: Position of each new token, of shape [B, 1].
+
+        Returns:
+            tuple: (logits of shape [B, V], updated kv cache pytree)
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support kv caching."
+        )
+
+    def stateless_extend(
+        self,
+        trainable_variables,
+        non_trainable_variables,
+        cache,
+        token_ids: jax.Array,
+        positions: jax.Array,
+    ):
+        """Run the forward pass for several new tokens per sequence.
+
+        Args:
+            trainable_variables: Model's trainable parameters.
+            non_trainable_variables: Model's non-trainable parameters.
+            cache: The kv cache returned by `stateless_prefill()` or a previous
+                decoding step.
+            token_ids: Token ids of shape [B, T].
+            positions: Position of each new token, of shape [B, T].
+
+        Returns:
+            tuple: (logits of shape [B, T, V], updated kv cache pytree)
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support speculative decoding."
+        )
+
+    def stateless_hidden_states(
+        self,
+        trainable_variables,
+        non_trainable_variables,
+        x: Dict[str, jax.Array],
+        layer: Optional[int] = None,
+    ) -> jax.Array:
+        """Run the forward pass and return the hidden states of one layer
+        instead of the logits.
+
+        Args:
+            trainable_variables: Model's trainable parameters.
+            non_trainable_variables: Model's non-trainable parameters.
+            x: Model input in the same format expected by `stateless_call()`.
+            layer: Index of the decoder layer whose output is returned,
+                negative indices count from the last layer. Defaults to None,
+                which returns the final hidden states after the last
+                normalization layer.
+
+        Returns:
+            jax.Array: Hidden states of shape [B, S, D].
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support hidden state extraction."
+        )
+
+    def output_head_variables(self) -> List[keras.Variable]:
+        """Variables of the output layer, which maps the final hidden states
+        to logits. See `stateless_output_head()`."""
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not expose its output layer."
+        )
+
+    def stateless_output_head(
+        self, head_values: List[jax.Array], hidden_states: jax.Array
+    ) -> jax.Array:
+        """Compute logits from the final hidden states returned by
+        `stateless_hidden_states()`. Together, both functions compute the
+        same logits as `stateless_call()`.
+
+        Args:
+            head_values: Values of `output_head_variables()`, in the same
+                order.
+            hidden_states: Final hidden states of shape [B, S, D]. Any
+                number of positions S is supported.
+
+        Returns:
+            jax.Array: Logits of shape [B, S, V].
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not expose its output layer."
+        )
+
+    def insert_prefill_cache(self, decode_cache, prefill_cache, slot: jax.Array):
+        """Insert the kv cache of a single prompt into row `slot` of a batched
+        decode cache, discarding the previous content of that row.
+
+        Args:
+            decode_cache: Batched kv cache, as used by `stateless_decode()`.
+            prefill_cache: kv cache of batch size 1 returned by
+                `stateless_prefill()`.
+            slot: Scalar index of the row to replace.
+
+        Returns:
+            The updated decode cache.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support continuous batching."
+        )
+
+    def reorder_kv_cache(self, cache, indices: jax.Array):
+        """Gather rows of a batched kv cache. Used by beam search to move the
+        cache of every selected beam to its new row.
+
+        Args:
+            cache: Batched kv cache, as used by `stateless_decode()`.
+            indices: Source row of every output row, of shape [N].
+
+        Returns:
+            The kv cache with N rows, where row i is row `indices[i]` of `cache`.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support beam search."
+        )
+
+    def _make_prefill_inputs(
+        self, token_ids: np.ndarray, padding_mask: np.ndarray
+    ) -> Dict[str, np.ndarray]:
+        """Build the `stateless_prefill()` input for right-padded prompts."""
+        return {"token_ids": token_ids, "padding_mask": padding_mask}
+
     def make_generate_step(self):
         """Create a JIT-compiled function for single-step token generation.
 
@@ -157,12 +538,127 @@ class Model(ABC, ModelValidationMixin):
 
         def fn(trainable_variables, non_trainable_variables, x):
             logits, non_trainable_variables = self.model.stateless_call(
-                trainable_variables, non_trainable_variables, x
+                dequantize_variables(trainable_variables),
+                dequantize_variables(non_trainable_variables),
+                x,
             )
             return logits
 
         return jax.jit(fn)
 
+    def make_prefill_step(self):
+        """Create a JIT-compiled function that runs `stateless_prefill()`."""
+        return jax.jit(self.stateless_prefill)
+
+    def make_decode_step(self):
+        """Create a JIT-compiled function that runs `stateless_decode()`.
+        The kv cache argument is donated so that it is updated in place."""
+        return jax.jit(self.stateless_decode, donate_argnums=(2,))
+
+    def make_on_device_generate_step(self):
+        """Create a JIT-compiled function that runs prefill and the entire
+        decoding loop on device. See `kithara.model.generation.generate_on_device()`."""
+        return jax.jit(partial(generate_on_device, self))
+
+    def make_on_device_prefill_step(self):
+        """Create a JIT-compiled function that runs the prefill step of
+        `kithara.model.generation.generate_on_device()`."""
+        return jax.jit(partial(prefill_on_device, self))
+
+    def make_on_device_decode_step(self):
+        """Create a JIT-compiled function that runs the decoding loop of
+        `kithara.model.generation.generate_on_device()`. The kv cache argument
+        is donated."""
+        return jax.jit(partial(decode_on_device, self), donate_argnums=(3,))
+
+    def make_on_device_decode_chunk_step(self):
+        """Create a JIT-compiled function that runs a chunk of decoding steps
+        for streaming. See `kithara.model.generation.decode_chunk_on_device()`.
+        The loop state argument is donated."""
+        return jax.jit(partial(decode_chunk_on_device, self), donate_argnums=(2,))
+
+    def make_speculative_generate_step(self, draft_model: "Model", num_draft_tokens: int):
+        """Create a JIT-compiled function that runs speculative decoding with
+        `draft_model` on device. See
+        `kithara.model.generation.speculative_generate_on_device()`."""
+        return jax.jit(
+            partial(speculative_generate_on_device, self, draft_model, num_draft_tokens)
+        )
+
+    def make_beam_search_step(self, num_beams: int):
+        """Create a JIT-compiled function that runs beam search with
+        `num_beams` beams on device. See
+        `kithara.model.generation.beam_search_on_device()`."""
+        return jax.jit(partial(beam_search_on_device, self, num_beams))
+
+    def make_score_step(self):
+        """Create a JIT-compiled function that scores labels with one forward
+        pass. See `kithara.model.generation.score_on_device()`."""
+        return jax.jit(partial(score_on_device, self))
+
+    def make_score_with_prefill_step(self):
+        """Create a JIT-compiled function that scores labels with
+        `stateless_prefill()`, starting from a cached prompt prefix. See
+        `kithara.model.generation.score_with_prefill_on_device()`."""
+        return jax.jit(partial(score_with_prefill_on_device, self))
+
+    def make_embed_step(self, layer: Optional[int], pooling: str, normalize: bool):
+        """Create a JIT-compiled function that computes pooled hidden states.
+        See `kithara.model.generation.embed_on_device()`."""
+        return jax.jit(partial(embed_on_device, self, layer, pooling, normalize))
+
+    def _get_compiled_fn(self, name: str, make_jitted_fn, args: tuple, data_args):
+        """Return the compiled executable of `make_jitted_fn()` for `args`,
+        compiling it ahead of time on the first call.
+
+        Executables are cached by `name` and the shape, dtype and sharding of
+        every leaf in `data_args`. Model variables are not part of the key,
+        as their shapes and shardings do not change between calls. Call
+        `clear_compiled_generate_fns()` after changing the model variables'
+        structure.
+
+        Args:
+            name (str): Name of the function.
+            make_jitted_fn (callable): Returns the `jax.jit` wrapped function.
+            args (tuple): Arguments used to lower and compile the function.
+            data_args: The subset of `args` that may change between calls.
+
+        Returns:
+            jax.stages.Compiled: The compiled executable.
+        """
+        key = (name,) + tuple(
+            (x.shape, x.dtype, getattr(x, "sharding", None))
+            for x in jax.tree_util.tree_leaves(data_args)
+        )
+        compiled = self._compiled_generate_fns.get(key)
+        if compiled is None:
+            compiled = make_jitted_fn().lower(*args).compile()
+            self._compiled_generate_fns[key] = compiled
+        return compiled
+
+    def clear_compiled_generate_fns(self):
+        """Drop all cached compiled generation functions."""
+        self._compiled_generate_fns = {}
+        self._jitted_generate_step = None
+        self._jitted_sample_fn = None
+
+    def _get_sampling_arrays(
+        self, sampling_params: Optional[SamplingParams], batch_size: int
+    ) -> Dict[str, np.ndarray]:
+        """Per-row sampling arrays for `batch_size` prompts. Greedy decoding is
+        used if `sampling_params` is None."""
+        sampling_params = sampling_params or SamplingParams()
+        arrays = sampling_params.to_arrays(
+            batch_size, default_seed=self._default_sampling_seed
+        )
+        self._default_sampling_seed += 1
+        return arrays
+
+    def _get_generation_batch_size(self, batch_size: int) -> int:
+        """Bucket the generation batch size to a power of two that is also a
+        multiple of the fsdp dimension of the data sharding mesh."""
+        return get_bucket_size(batch_size, multiple_of=self._num_data_shards())
+
     @property
     def optimizer(self):
         return self._optimizer
@@ -216,6 +712,13 @@ class Model(ABC, ModelValidationMixin):
         tokenizer_handle: Optional[str] = None,
         return_decoded: bool = True,
         skip_special_tokens: bool = True,
+        sampling_params: Optional[SamplingParams] = None,
+        draft_model: Optional["Model"] = None,
+        num_draft_tokens: int = 4,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        constraint: Optional[TokenConstraint] = None,
+        adapter_ids: Optional[Union[int | List[int]]] = None,
         **kwargs,
     ) -> Union[List[str] | Dict[str, np.ndarray]]:
         """Generate text tokens using the model.
@@ -223,7 +726,8 @@ class Model(ABC, ModelValidationMixin):
             inputs (list, dict): A single string, a list of strings, or a
                 dictionary with tokens as expected by the underlying model
                 during the forward pass. If strings are provided, one of
-                `tokenizer` and `tokenizer_handle` must be provided.
+                `tokenizer` and `tokenizer_handle` must be provided. Prompts
+                must be right-padded and may have different lengths.
             max_length (int, optional): Maximum total sequence length
                 (prompt + generated tokens). If `tokenizer` and `tokenizer_handle`
                 are `None`, `inputs` should be should be padded to the desired
@@ -238,6 +742,35 @@ class Model(ABC, ModelValidationMixin):
             return_decoded (bool, optional): If Ture, returns the decoded text using
                 the tokenizer, otherwise return the predicted tokens. Defautl to True.
                 This option must be set to False if no tokenizer is provided.
+            sampling_params (kithara.SamplingParams, optional): Temperature,
+                top-k, top-p, min-p and seed used to sample the next token,
+                either shared by all prompts or set per prompt. Defaults to
+                None, which uses greedy decoding.
+            draft_model (kithara.Model, optional): A smaller model with the
+                same tokenizer, used for speculative decoding. The draft model
+                proposes `num_draft_tokens` tokens, which this model verifies
+                in a single forward pass. Greedy decoding produces the same
+                output as without a draft model. Currently only supported
+                between KerasHub models. Defaults to None.
+            num_draft_tokens (int, optional): Number of tokens proposed by the
+                draft model per verification step. Defaults to 4.
+            num_beams (int, optional): If larger than 1, return the most likely
+                continuation found by beam search with this many beams per
+                prompt. Cannot be combined with `sampling_params` or
+                `draft_model`. Defaults to 1.
+            length_penalty (float, optional): Beam search ranks hypotheses by
+                their log-probability divided by the number of generated
+                tokens to the power of `length_penalty`. Values above 0 favor
+                longer outputs. Defaults to 1.0.
+            constraint (kithara.TokenConstraint, optional): Restricts the
+                generated tokens to outputs matching a regular expression or
+                JSON schema. Requires a model with kv caching, and cannot be
+                combined with `draft_model` or beam search. Defaults to None.
+            adapter_ids (int, List[int], optional): The LoRA adapter applied
+                to every prompt, as returned by `load_adapter()`, or a single
+                id for all prompts. Id 0 selects the base model. Requires a
+                model where `supports_multi_lora` is True. Defaults to None,
+                which does not apply adapters.
         Returns:
             A list of string if input is text, or a dictionary containing the following
                 keys if the input is tokens.
@@ -259,6 +792,20 @@ class Model(ABC, ModelValidationMixin):
             from transformers import AutoTokenizer
             tokenizer = AutoTokenizer.from_pretrained("hf://google/gemma-2-2b")
             pred_text = model.generate(prompt, max_length=100, tokenizer=tokenizer, return_decoded=True, strip_prompt=True)
+
+            # Sample with a temperature and nucleus sampling
+            pred_text = model.generate(prompt, max_length=100, tokenizer=tokenizer, sampling_params=SamplingParams(temperature=0.7, top_p=0.9))
+
+            # Speculative decoding with a smaller draft model
+            draft_model = KerasHubModel.from_preset("hf://google/gemma-2-2b")
+            pred_text = model.generate(prompt, max_length=100, tokenizer=tokenizer, draft_model=draft_model)
+
+            # Beam search with 4 beams
+            pred_text = model.generate(prompt, max_length=100, tokenizer=tokenizer, num_beams=4)
+
+            # Generate JSON matching a schema
+            constraint = TokenConstraint.from_json_schema({"type": "object", "properties": {"answer": {"type": "integer"}}}, tokenizer)
+            pred_text = model.generate(prompt, max_length=100, tokenizer=tokenizer, constraint=constraint, strip_prompt=True)
             ```
 
         """
@@ -266,36 +813,49 @@ class Model(ABC, ModelValidationMixin):
         if isinstance(inputs, str) or isinstance(inputs, list) or return_decoded:
             assert (tokenizer or tokenizer_handle) is not None
 
+        if draft_model is not None and not (
+            self.supports_speculative_decoding
+            and draft_model.supports_speculative_decoding
+        ):
+            raise ValueError(
+                "Speculative decoding requires a target and draft model that support it, "
+                f"but got {self.__class__.__name__} and {draft_model.__class__.__name__}."
+            )
+        if num_beams > 1 and not self.supports_kv_cache:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support kv caching, which "
+                "is required for beam search."
+            )
+        if num_beams > 1 and (sampling_params is not None or draft_model is not None):
+            raise ValueError(
+                "Beam search cannot be combined with sampling or speculative decoding."
+            )
+        if constraint is not None:
+            self._validate_constraint(constraint, num_beams, draft_model)
+        if adapter_ids is not None:
+            self._validate_adapter_ids()
+
         if isinstance(inputs, str) or isinstance(inputs, list):
             inputs = self._convert_text_input_to_model_input(
                 inputs, max_length, tokenizer, tokenizer_handle
             )
 
-        if stop_token_ids == "auto":
-            stop_token_ids = []
-            if tokenizer or tokenizer_handle:
-                tokenizer = (
-                    initialize_tokenizer(tokenizer_handle)
-                    if tokenizer is None
-                    else tokenizer
-                )
-
-                token_attributes = [
-                    "end_token_id",
-                    "eos_token_id",
-                    "end_token2_id",
-                    "eos_token2_id",
-                ]
-
-                for attr in token_attributes:
-                    if hasattr(tokenizer, attr):
-                        stop_token_ids.append(getattr(tokenizer, attr))
+        stop_token_ids = self._get_stop_token_ids(
+            stop_token_ids, tokenizer, tokenizer_handle
+        )
 
         tokens: Dict[str, Any] = self._generate(
             inputs,
             max_length=max_length,
             stop_token_ids=stop_token_ids,
             strip_prompt=strip_prompt,
+            sampling_params=sampling_params,
+            draft_model=draft_model,
+            num_draft_tokens=num_draft_tokens,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            constraint=constraint,
+            adapter_ids=self._get_adapter_ids(adapter_ids, inputs),
         )
         if return_decoded:
             tokenizer = (
@@ -311,6 +871,964 @@ class Model(ABC, ModelValidationMixin):
             return text
         return tokens
 
+    def generate_stream(
+        self,
+        inputs: Union[str | List[str] | Dict[str, np.ndarray]],
+        max_length: int = 100,
+        stop_token_ids: Union[str | List[int]] = "auto",
+        tokenizer: Optional[AutoTokenizer] = None,
+        tokenizer_handle: Optional[str] = None,
+        return_decoded: bool = True,
+        skip_special_tokens: bool = True,
+        sampling_params: Optional[SamplingParams] = None,
+        steps_per_chunk: int = 1,
+        constraint: Optional[TokenConstraint] = None,
+        adapter_ids: Optional[Union[int | List[int]]] = None,
+    ) -> Iterator[List[Union[str | np.ndarray]]]:
+        """Generate tokens, yielding the new tokens of every prompt as soon as
+        they are produced.
+
+        Decoding runs on device in chunks of `steps_per_chunk` steps, using
+        the same prefill and decoding steps as `generate()`. The next chunk
+        is dispatched before the tokens of the previous chunk are
+        transferred to the host and yielded, so detokenization and any work
+        done by the consumer overlap with the next device step. Requires a
+        model with kv caching.
+
+        Args:
+            steps_per_chunk (int, optional): Number of decoding steps between
+                two yields. Larger chunks reduce the host overhead per token.
+                Defaults to 1.
+            For the rest of the args, please refer to `generate()`.
+
+        Yields:
+            A list with one entry per prompt: the newly decoded text if
+                `return_decoded` is True, otherwise a numpy array of the new
+                token ids. Entries are empty for prompts without new tokens,
+                including finished prompts.
+
+        Example:
+            ```
+            for chunk in model.generate_stream(prompt, max_length=100, tokenizer=tokenizer):
+                print(chunk[0], end="", flush=True)
+            ```
+        """
+        if not self.supports_kv_cache:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support kv caching, which "
+                "is required for streaming."
+            )
+        if steps_per_chunk < 1:
+            raise ValueError(
+                f"steps_per_chunk must be positive, but got {steps_per_chunk}."
+            )
+        if constraint is not None:
+            self._validate_constraint(constraint)
+        if adapter_ids is not None:
+            self._validate_adapter_ids()
+        if isinstance(inputs, str) or isinstance(inputs, list) or return_decoded:
+            assert (tokenizer or tokenizer_handle) is not None
+        if tokenizer is None and tokenizer_handle is not None:
+            tokenizer = initialize_tokenizer(tokenizer_handle)
+
+        if isinstance(inputs, str) or isinstance(inputs, list):
+            inputs = self._convert_text_input_to_model_input(
+                inputs, max_length, tokenizer
+            )
+        stop_token_ids = self._get_stop_token_ids(stop_token_ids, tokenizer)
+
+        chunks = self._generate(
+            inputs,
+            max_length=max_length,
+            stop_token_ids=stop_token_ids,
+            sampling_params=sampling_params,
+            steps_per_chunk=steps_per_chunk,
+            constraint=constraint,
+            adapter_ids=self._get_adapter_ids(adapter_ids, inputs),
+        )
+        detokenizers = None
+        for new_token_ids in chunks:
+            if not return_decoded:
+                yield new_token_ids
+                continue
+            if detokenizers is None:
+                detokenizers = [
+                    IncrementalDetokenizer(tokenizer, skip_special_tokens)
+                    for _ in new_token_ids
+                ]
+            yield [
+                detokenizer.update(token_ids)
+                for detokenizer, token_ids in zip(detokenizers, new_token_ids)
+            ]
+
+    def batch_generate(
+        self,
+        dataset: Union[Dataset | "ray.data.Dataset"],
+        output_path: str,
+        max_length: int = 100,
+        tokenizer: Optional[AutoTokenizer] = None,
+        tokenizer_handle: Optional[str] = None,
+        prompt_column: Optional[str] = None,
+        max_prompt_length: Optional[int] = None,
+        per_device_batch_size: int = 8,
+        prompts_per_shard: int = 4096,
+        output_format: str = "jsonl",
+        prefetch_depth: int = 2,
+        stop_token_ids: Union[str | List[int]] = "auto",
+        skip_special_tokens: bool = True,
+        sampling_params: Optional[SamplingParams] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        constraint: Optional[TokenConstraint] = None,
+    ) -> List[str]:
+        """Generate completions for every prompt of a dataset and write them
+        to JSONL or Parquet shards.
+
+        Prompts are streamed from the dataset in shards of `prompts_per_shard`
+        prompts. A background thread reads and tokenizes the next shards
+        while the device generates, and sorts the prompts of every shard by
+        length, so that each batch holds prompts of similar length. Every
+        host writes its own file per shard, holding the rows whose index
+        modulo the number of hosts is its host index. Shards that were
+        already written by every host are skipped, so calling this function
+        again with the same arguments resumes an interrupted run.
+
+        All hosts run every batch, so every host must read the same prompts
+        in the same order.
+
+        Args:
+            dataset (kithara.Dataset, ray.data.Dataset): Dataset of prompts.
+                For Kithara datasets, the prompt is read after the dataset's
+                `task_transform()`, e.g. the "prompt" of an `SFTDataset` or
+                the "text" of a `TextCompletionDataset`.
+            output_path (str): Local directory or "gs://" path of the shards.
+            prompt_column (str, optional): Column holding the prompt. Defaults
+                to "prompt" if the rows have this column, otherwise "text".
+            max_prompt_length (int, optional): Prompts are truncated to this
+                number of tokens, so that at least `max_length -
+                max_prompt_length` tokens can be generated. Must be smaller
+                than `max_length`. Defaults to `max_length // 2`.
+            per_device_batch_size (int, optional): Number of prompts per
+                device in every batch. Defaults to 8.
+            prompts_per_shard (int, optional): Number of prompts per shard.
+                Must not change when resuming. Defaults to 4096.
+            output_format (str, optional): "jsonl" or "parquet". Defaults to
+                "jsonl".
+            prefetch_depth (int, optional): Maximum number of shards prepared
+                ahead of the device. Defaults to 2.
+            For the rest of the args, please refer to `generate()`.
+
+        Returns:
+            list: Paths of the shards written by this host, including the
+                shards of a previous run. Every row holds the 'index' of the
+                prompt in the dataset, the 'prompt', the generated text under
+                'generation', the number of generated tokens under
+                'num_tokens', and whether the prompt was truncated to
+                `max_prompt_length` under 'prompt_truncated'.
+
+        Example:
+            ```
+            dataset = ray.data.read_json("gs://bucket/prompts.jsonl")
+            model.batch_generate(dataset, "gs://bucket/outputs", max_length=512, tokenizer=tokenizer)
+            ```
+        """
+        assert (tokenizer or tokenizer_handle) is not None
+        if tokenizer is None:
+            tokenizer = initialize_tokenizer(tokenizer_handle)
+        task_transform = None
+        if isinstance(dataset, Dataset):
+            task_transform = getattr(dataset, "task_transform", None)
+            dataset = dataset.source
+
+        def get_prompt(row):
+            if task_transform is not None:
+                row = task_transform(row)
+            column = prompt_column or ("prompt" if "prompt" in row else "text")
+            return row[column]
+
+        host_id, num_hosts = jax.process_index(), jax.process_count()
+        writer = ShardWriter(output_path, output_format, host_id)
+        # All hosts run every batch, so they resume from the same shard.
+        first_shard = int(
+            np.min(
+                multihost_utils.process_allgather(
+                    np.int32(writer.num_completed_shards())
+                )
+            )
+        )
+        output_files = [
+            os.path.join(output_path, writer.shard_name(i)) for i in range(first_shard)
+        ]
+        stop_token_ids = self._get_stop_token_ids(stop_token_ids, tokenizer)
+        prefetcher = PromptPrefetcher(
+            dataset.iter_rows(),
+            get_prompt,
+            tokenizer,
+            prompts_per_shard,
+            per_device_batch_size * jax.device_count(),
+            max_length,
+            first_shard,
+            prefetch_depth,
+            max_prompt_length,
+        )
+
+        def write_shard(shard_index, prompts, truncated, generations):
+            rows = []
+            for i, (prompt, prompt_truncated, token_ids) in enumerate(
+                zip(prompts, truncated, generations)
+            ):
+                index = shard_index * prompts_per_shard + i
+                if index % num_hosts != host_id:
+                    continue
+                text = tokenizer.decode(
+                    token_ids, skip_special_tokens=skip_special_tokens
+                )
+                rows.append(
+                    {
+                        "index": index,
+                        "prompt": prompt,
+                        "generation": text,
+                        "num_tokens": len(token_ids),
+                        "prompt_truncated": prompt_truncated,
+                    }
+                )
+            return writer.write(shard_index, rows)
+
+        # Results are detokenized and written on a separate thread while the
+        # device generates the next shard.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+            try:
+                for shard_index, prompts, batches, truncated in prefetcher:
+                    generations = [None] * len(prompts)
+                    for indices, inputs in batches:
+                        tokens = self.generate(
+                            self._make_prefill_inputs(
+                                inputs["token_ids"], inputs["padding_mask"]
+                            ),
+                            max_length=max_length,
+                            stop_token_ids=stop_token_ids,
+                            strip_prompt=True,
+                            tokenizer=tokenizer,
+                            return_decoded=False,
+                            sampling_params=sampling_params,
+                            num_beams=num_beams,
+                            length_penalty=length_penalty,
+                            constraint=constraint,
+                        )
+                        for index, token_ids, padding_mask in zip(
+                            indices, tokens["token_ids"], tokens["padding_mask"]
+                        ):
+                            generations[index] = token_ids[padding_mask.astype(bool)]
+                    if pending is not None:
+                        output_files.append(pending.result())
+                    pending = executor.submit(
+                        write_shard, shard_index, prompts, truncated, generations
+                    )
+                if pending is not None:
+                    output_files.append(pending.result())
+            finally:
+                prefetcher.close()
+        return output_files
+
+    def _validate_constraint(
+        self,
+        constraint: TokenConstraint,
+        num_beams: int = 1,
+        draft_model: Optional["Model"] = None,
+    ):
+        """Check that a `TokenConstraint` can be used for this generation call."""
+        if not self.supports_kv_cache:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support kv caching, which "
+                "is required for constrained decoding."
+            )
+        if num_beams > 1 or draft_model is not None:
+            raise ValueError(
+                "Constrained decoding cannot be combined with beam search or "
+                "speculative decoding."
+            )
+
+    def _validate_adapter_ids(self):
+        """Check that adapters can be selected for this generation call."""
+        if not self.supports_multi_lora:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support multi-LoRA inference."
+            )
+        if self._prefix_cache is not None:
+            raise ValueError(
+                "Prefix caching cannot be combined with `adapter_ids`, as the "
+                "kv cache of a prompt depends on its adapter."
+            )
+
+    @staticmethod
+    def _get_adapter_ids(
+        adapter_ids: Optional[Union[int | List[int]]], inputs: Dict[str, np.ndarray]
+    ) -> Optional[np.ndarray]:
+        """Broadcast `adapter_ids` to one id per prompt."""
+        if adapter_ids is None:
+            return None
+        batch_size = next(iter(inputs.values())).shape[0]
+        return np.broadcast_to(np.asarray(adapter_ids, dtype=np.int32), (batch_size,))
+
+    def _get_stop_token_ids(
+        self,
+        stop_token_ids: Union[str | List[int]],
+        tokenizer: Optional[AutoTokenizer] = None,
+        tokenizer_handle: Optional[str] = None,
+    ) -> List[int]:
+        """Resolve "auto" stop token ids to the end token ids of the tokenizer."""
+        if stop_token_ids != "auto":
+            return stop_token_ids
+        stop_token_ids = []
+        if tokenizer or tokenizer_handle:
+            tokenizer = (
+                initialize_tokenizer(tokenizer_handle)
+                if tokenizer is None
+                else tokenizer
+            )
+
+            token_attributes = [
+                "end_token_id",
+                "eos_token_id",
+                "end_token2_id",
+                "eos_token2_id",
+            ]
+
+            for attr in token_attributes:
+                if hasattr(tokenizer, attr):
+                    stop_token_ids.append(getattr(tokenizer, attr))
+        return stop_token_ids
+
+    def score(
+        self,
+        inputs: Union[Dict[str, Any] | Dataset | Dataloader],
+        ignore_label_id: Optional[int] = None,
+        per_device_batch_size: int = 1,
+        return_token_log_probs: bool = False,
+    ) -> Dict[str, np.ndarray]:
+        """Compute the log-likelihood of the labels under the model.
+
+        Every batch runs one forward pass, and the log-probabilities of the
+        labels are gathered on device, so only the scores are transferred
+        back to the host. The next batch is dispatched before the scores of
+        the previous batch are fetched. If prefix caching is enabled, the kv
+        cache of prompt prefixes shared with earlier calls to `generate()` or
+        `score()` is reused up to the first scored label of each row.
+
+        Args:
+            inputs (dict, kithara.Dataset, kithara.Dataloader): Either a
+                single batch `{"x": model_input, "y": label_ids}` in the format
+                produced by Kithara datasets, which must be identical on every
+                host, or a dataset or dataloader yielding such samples. With a
+                dataloader, every host loads its own part of each global batch,
+                as during training.
+            ignore_label_id (int, optional): Labels with this id are not scored.
+                Defaults to the pad token id of the dataset's tokenizer, which
+                Kithara datasets use for unsupervised positions.
+            per_device_batch_size (int, optional): Batch size per device, used
+                when `inputs` is a dataset. Defaults to 1.
+            return_token_log_probs (bool, optional): If True, also return the
+                log-probability of every label. Defaults to False.
+
+        Returns:
+            dict: Dictionary containing the following keys, with one row per
+                sample. With a dataloader, the rows of every global batch are
+                ordered by host.
+                - 'log_probs': Sum of the log-probabilities of the scored
+                  labels (numpy.ndarray) of shape [N]
+                - 'num_tokens': Number of scored labels of shape [N]
+                - 'is_greedy': Whether every scored label is the most likely
+                  token, of shape [N]
+                - 'token_log_probs': Only if `return_token_log_probs` is True.
+                  Log-probability of every label, 0 for labels that are not
+                  scored, of shape [N, S]
+
+        Example:
+            ```
+            dataset = SFTDataset(ray_dataset, tokenizer_handle="hf://google/gemma-2-2b")
+            scores = model.score(dataset, per_device_batch_size=4)
+            mean_log_prob = scores["log_probs"] / scores["num_tokens"]
+            ```
+        """
+        if isinstance(inputs, Dataset):
+            inputs = Dataloader(inputs, per_device_batch_size=per_device_batch_size)
+        if ignore_label_id is None:
+            dataset = getattr(inputs, "dataset", None)
+            tokenizer = getattr(dataset, "tokenizer", None)
+            if tokenizer is None:
+                raise ValueError(
+                    "ignore_label_id must be provided when inputs are not a "
+                    "Kithara dataset with a tokenizer."
+                )
+            ignore_label_id = tokenizer.pad_token_id
+
+        is_global_batch = isinstance(inputs, dict)
+        batches = [inputs] if is_global_batch else inputs
+        keys = ["log_probs", "num_tokens", "is_greedy"]
+        if return_token_log_probs:
+            keys.append("token_log_probs")
+
+        def fetch(pending):
+            scores, batch_size = pending
+            return {
+                key: np.asarray(
+                    multihost_utils.process_allgather(scores[key], tiled=True)
+                )[:batch_size]
+                for key in keys
+            }
+
+        results, pending = [], None
+        for batch in batches:
+            scores = self._score_batch(batch, ignore_label_id, is_global_batch)
+            if pending is not None:
+                results.append(fetch(pending))
+            pending = scores
+        if pending is not None:
+            results.append(fetch(pending))
+        if not results:
+            return {key: np.zeros((0,)) for key in keys}
+        return {
+            key: np.concatenate([result[key] for result in results]) for key in keys
+        }
+
+    def _score_batch(
+        self, batch: Dict[str, Any], ignore_label_id: int, is_global_batch: bool
+    ) -> tuple:
+        """Dispatch the scoring step for one batch without waiting for it.
+
+        Returns:
+            tuple: (scores on device, number of real rows, or None to keep all)
+        """
+        x = batch["x"]
+        labels = np.asarray(batch["y"]).astype(np.int32)
+        targets = {"labels": labels, "label_mask": labels != ignore_label_id}
+        data_sharding = self.sharding_strategy.data_sharding
+        if is_global_batch:
+            batch_size = labels.shape[0]
+            bucket_batch_size = self._get_generation_batch_size(batch_size)
+            x = jax.device_put(
+                self._pad_batch_for_data_sharding(x, bucket_batch_size),
+                data_sharding,
+            )
+            targets = jax.device_put(
+                self._pad_batch_for_data_sharding(targets, bucket_batch_size),
+                data_sharding,
+            )
+        else:
+            # Every host provides its local rows of the global batch.
+            batch_size = None
+            x, targets = jax.tree_util.tree_map(
+                lambda array: jax.make_array_from_process_local_data(
+                    data_sharding, np.asarray(array)
+                ),
+                (x, targets),
+            )
+
+        variables = self._variable_values()
+        if self._prefix_cache is not None:
+            scores = self._score_with_prefix_cache(
+                variables, x, targets["labels"], targets["label_mask"]
+            )
+        else:
+            data_args = (x, targets["labels"], targets["label_mask"])
+            args = (*variables, *data_args)
+            score_fn = self._get_compiled_fn(
+                "score_on_device", self.make_score_step, args, data_args
+            )
+            scores = score_fn(*args)
+        return scores, batch_size
+
+    def _score_with_prefix_cache(
+        self,
+        variables: tuple,
+        x: Dict[str, jax.Array],
+        labels: jax.Array,
+        label_mask: jax.Array,
+    ) -> Dict[str, jax.Array]:
+        """Score with `stateless_prefill()`, starting from the cached kv cache
+        of the longest prefix shared by all rows, then store the new prompt
+        blocks. Only the tokens up to the first scored label of each row are
+        treated as the prompt, as the logits of every later position are
+        needed."""
+        self._prefix_cache.validate_variables(
+            self.model.trainable_variables + self.model.non_trainable_variables
+        )
+        token_ids = np.asarray(
+            multihost_utils.process_allgather(x["token_ids"], tiled=True)
+        )
+        host_label_mask = np.asarray(
+            multihost_utils.process_allgather(label_mask, tiled=True)
+        )
+        # The label at position i is predicted by the logits at position i,
+        # so the cached prefix must end at or before it.
+        context_lengths = np.where(
+            host_label_mask.any(axis=1), np.argmax(host_label_mask, axis=1) + 1, 0
+        ).astype(np.int32)
+        prefix, block_hashes = build_prefix_kv_cache(
+            self._prefix_cache, token_ids, context_lengths, self.prefix_cache_axes
+        )
+        if prefix is not None:
+            x = {**x, "prefix_cache": prefix}
+        data_args = (x, labels, label_mask)
+        args = (*variables, *data_args)
+        score_fn = self._get_compiled_fn(
+            "score_with_prefill_on_device",
+            self.make_score_with_prefill_step,
+            args,
+            data_args,
+        )
+        scores, cache = score_fn(*args)
+        store_prefix_blocks(
+            self._prefix_cache, cache, block_hashes, self.prefix_cache_axes
+        )
+        return scores
+
+    def embed(
+        self,
+        inputs: Union[str | List[str] | Dict[str, Any] | Dataset | Dataloader],
+        layer: Optional[int] = None,
+        pooling: str = "mean",
+        normalize: bool = False,
+        tokenizer: Optional[AutoTokenizer] = None,
+        tokenizer_handle: Optional[str] = None,
+        max_length: int = 512,
+        per_device_batch_size: int = 1,
+    ) -> np.ndarray:
+        """Compute one embedding per sequence by pooling the hidden states of
+        a layer over the non-padding tokens.
+
+        Hidden states are pooled on device, so only the embeddings are
+        transferred back to the host. As with `score()`, the next batch is
+        dispatched before the embeddings of the previous batch are fetched.
+
+        Args:
+            inputs (str, list, dict, kithara.Dataset, kithara.Dataloader): A
+                single string or a list of strings, which requires `tokenizer`
+                or `tokenizer_handle`, a single batch of model input, either
+                directly or under "x" as produced by Kithara datasets, which
+                must be identical on every host, or a dataset or dataloader
+                yielding such samples. With a dataloader, every host loads its
+                own part of each global batch, as during training. Sequences
+                must be right-padded, and packed sequences are not supported.
+            layer (int, optional): Index of the decoder layer whose output is
+                pooled, negative indices count from the last layer. Defaults
+                to None, which pools the final hidden states after the last
+                normalization layer. For MaxText models, the index refers to
+                the MaxText decoder blocks, which hold two attention layers
+                for Gemma 2.
+            pooling (str, optional): "mean" averages the hidden states of the
+                non-padding tokens, "last" takes the hidden state of the last
+                non-padding token. Defaults to "mean".
+            normalize (bool, optional): If True, scale every embedding to unit
+                L2 norm. Defaults to False.
+            max_length (int, optional): Strings are truncated and padded to
+                this length. Defaults to 512.
+            per_device_batch_size (int, optional): Batch size per device, used
+                when `inputs` is a dataset. Defaults to 1.
+
+        Returns:
+            numpy.ndarray: float16 embeddings of shape [N, D]. With a
+                dataloader, the rows of every global batch are ordered by
+                host.
+
+        Example:
+            ```
+            embeddings = model.embed(["what is the capital of France?", "Paris"], tokenizer=tokenizer, pooling="last")
+            ```
+        """
+        if pooling not in POOLING_MODES:
+            raise ValueError(
+                f"Unsupported pooling {pooling}. Supported modes are {list(POOLING_MODES)}."
+            )
+        if isinstance(inputs, str) or isinstance(inputs, list):
+            inputs = self._convert_text_input_to_model_input(
+                inputs, max_length, tokenizer, tokenizer_handle
+            )
+        if isinstance(inputs, Dataset):
+            inputs = Dataloader(inputs, per_device_batch_size=per_device_batch_size)
+
+        is_global_batch = isinstance(inputs, dict)
+        batches = [inputs] if is_global_batch else inputs
+
+        def fetch(pending):
+            embeddings, batch_size = pending
+            return np.asarray(
+                multihost_utils.process_allgather(embeddings, tiled=True)
+            )[:batch_size]
+
+        results, pending = [], None
+        for batch in batches:
+            x = batch.get("x", batch)
+            embeddings = self._embed_batch(
+                x, layer, pooling, normalize, is_global_batch
+            )
+            if pending is not None:
+                results.append(fetch(pending))
+            pending = embeddings
+        if pending is not None:
+            results.append(fetch(pending))
+        if not results:
+            return np.zeros((0, 0), dtype=np.float16)
+        return np.concatenate(results)
+
+    def _embed_batch(
+        self,
+        x: Dict[str, Any],
+        layer: Optional[int],
+        pooling: str,
+        normalize: bool,
+        is_global_batch: bool,
+    ) -> tuple:
+        """Dispatch the embedding step for one batch without waiting for it.
+
+        Returns:
+            tuple: (embeddings on device, number of real rows, or None to keep
+                all)
+        """
+        data_sharding = self.sharding_strategy.data_sharding
+        if is_global_batch:
+            batch_size = next(iter(x.values())).shape[0]
+            bucket_batch_size = self._get_generation_batch_size(batch_size)
+            x = jax.device_put(
+                self._pad_batch_for_data_sharding(x, bucket_batch_size),
+                data_sharding,
+            )
+        else:
+            # Every host provides its local rows of the global batch.
+            batch_size = None
+            x = jax.tree_util.tree_map(
+                lambda array: jax.make_array_from_process_local_data(
+                    data_sharding, np.asarray(array)
+                ),
+                x,
+            )
+        # KerasHub inputs hold a padding mask, MaxText inputs hold segment ids.
+        padding_mask = x["padding_mask"] if "padding_mask" in x else x["segment_ids"]
+
+        variables = self._variable_values()
+        data_args = (x, padding_mask)
+        args = (*variables, *data_args)
+        embed_fn = self._get_compiled_fn(
+            f"embed_on_device_{layer}_{pooling}_{normalize}",
+            partial(self.make_embed_step, layer, pooling, normalize),
+            args,
+            data_args,
+        )
+        return embed_fn(*args), batch_size
+
+    def _num_data_shards(self) -> int:
+        mesh = self.sharding_strategy.data_sharding.mesh
+        return mesh.shape[Axis.FSDP] if Axis.FSDP in mesh.shape else mesh.shape["fsdp"]
+
+    def _pad_batch_for_data_sharding(
+        self, inputs: Dict[str, np.ndarray], target_batch_size: Optional[int] = None
+    ) -> Dict[str, np.ndarray]:
+        """Pad the batch dimension of `inputs` to `target_batch_size` if provided,
+        otherwise to be a multiple of the fsdp dimension of the data sharding mesh.
+        Padded rows are filled with zeros."""
+        batch_size = next(iter(inputs.values())).shape[0]
+        if target_batch_size is None:
+            devices_in_data_fsdp = self._num_data_shards()
+            remainder = batch_size % devices_in_data_fsdp
+            target_batch_size = batch_size + (
+                (devices_in_data_fsdp - remainder) if remainder else 0
+            )
+        if target_batch_size != batch_size:
+            pad_size = target_batch_size - batch_size
+            inputs = {
+                key: np.pad(
+                    value,
+                    ((0, pad_size),) + ((0, 0),) * (np.ndim(value) - 1),
+                    mode="constant",
+                    constant_values=0,
+                )
+                for key, value in inputs.items()
+            }
+        return inputs
+
+    @staticmethod
+    def _get_prompt_lengths(padding_mask: np.ndarray) -> np.ndarray:
+        """Number of prompt tokens in each row of right-padded prompts."""
+        return np.sum(padding_mask != 0, axis=1).astype(np.int32)
+
+    @staticmethod
+    def _format_generate_output(
+        token_ids: np.ndarray,
+        padding_mask: np.ndarray,
+        prompt_lengths: np.ndarray,
+        strip_prompt: bool,
+    ) -> Dict[str, np.ndarray]:
+        """Trim the token buffer to the longest sequence in the batch.
+
+        Each row of `token_ids` holds its prompt followed by its generated
+        tokens. If `strip_prompt` is True, the generated tokens of each row are
+        moved to the start of the row. Rows are right-padded, as indicated by
+        the returned padding mask.
+        """
+        lengths = np.sum(padding_mask != 0, axis=1)
+        if not strip_prompt:
+            width = int(np.max(lengths, initial=0))
+            return {
+                "token_ids": token_ids[:, :width],
+                "padding_mask": padding_mask[:, :width],
+            }
+
+        num_generated = lengths - prompt_lengths
+        width = int(np.max(num_generated, initial=0))
+        stripped_token_ids = np.zeros((token_ids.shape[0], width), token_ids.dtype)
+        stripped_padding_mask = np.zeros(
+            (padding_mask.shape[0], width), padding_mask.dtype
+        )
+        for i, (start, end) in enumerate(zip(prompt_lengths, lengths)):
+            stripped_token_ids[i, : end - start] = token_ids[i, start:end]
+            stripped_padding_mask[i, : end - start] = padding_mask[i, start:end]
+        return {
+            "token_ids": stripped_token_ids,
+            "padding_mask": stripped_padding_mask,
+        }
+
+    def _generate_with_kv_cache(
+        self,
+        prefill_inputs: Dict[str, np.ndarray],
+        token_ids: np.ndarray,
+        padding_mask: np.ndarray,
+        max_length: int,
+        stop_token_ids: List[int],
+        strip_prompt: bool = False,
+        sampling_params: Optional[SamplingParams] = None,
+        draft_model: Optional["Model"] = None,
+        num_draft_tokens: int = 4,
+        steps_per_chunk: Optional[int] = None,
+        num_beams: int = 1,
+        length_penalty: float = 1.0,
+        constraint: Optional[TokenConstraint] = None,
+    ) -> Union[Dict[str, np.ndarray] | Iterator[List[np.ndarray]]]:
+        """Generate tokens with the on-device decoding loop. Only the final
+        tokens are transferred back to the host, unless `steps_per_chunk` is
+        set.
+
+        Args:
+            prefill_inputs (dict): Prompt input passed to `stateless_prefill()`.
+            token_ids (np.ndarray): Token buffer of shape [B, S] holding the
+                right-padded prompts. With a draft model, the last
+                `num_draft_tokens` columns must be free.
+            padding_mask (np.ndarray): Padding mask of shape [B, S].
+            max_length (int): Maximum total length of each row.
+            draft_model (kithara.Model, optional): If provided, generate with
+                speculative decoding. See
+                `kithara.model.generation.speculative_generate_on_device()`.
+            steps_per_chunk (int, optional): If provided, return an iterator
+                over the new tokens of every row, produced every
+                `steps_per_chunk` decoding steps. See `generate_stream()`.
+            num_beams (int, optional): If larger than 1, generate with beam
+                search. See `kithara.model.generation.beam_search_on_device()`.
+            constraint (kithara.TokenConstraint, optional): If provided, mask
+                the tokens that do not match the constraint before sampling.
+            For the rest of the args, please refer to `generate()`.
+
+        Returns:
+            dict: Dictionary containing 'token_ids' and 'padding_mask'.
+        """
+        batch_size = token_ids.shape[0]
+        bucket_batch_size = self._get_generation_batch_size(batch_size)
+        prefill_inputs = self._pad_batch_for_data_sharding(
+            prefill_inputs, bucket_batch_size
+        )
+        buffers = self._pad_batch_for_data_sharding(
+            {"token_ids": token_ids, "padding_mask": padding_mask}, bucket_batch_size
+        )
+        prompt_lengths = self._get_prompt_lengths(buffers["padding_mask"])
+        sampling_arrays = self._pad_batch_for_data_sharding(
+            self._get_sampling_arrays(sampling_params, batch_size), bucket_batch_size
+        )
+        data_sharding = self.sharding_strategy.data_sharding
+        prefill_args = (jax.device_put(prefill_inputs, data_sharding),)
+        variables = self._variable_values()
+        constraint_args = () if constraint is None else (constraint.to_arrays(),)
+        if steps_per_chunk is not None:
+            return self._stream_with_kv_cache(
+                prefill_args[0],
+                buffers,
+                prompt_lengths,
+                variables,
+                stop_token_ids,
+                max_length,
+                sampling_arrays,
+                batch_size,
+                steps_per_chunk,
+                constraint_args,
+            )
+        # Beam search takes the length penalty in place of the sampling arrays.
+        search_args = sampling_arrays
+        if num_beams > 1:
+            name = f"beam_search_on_device_{num_beams}"
+            make_jitted_fn = partial(self.make_beam_search_step, num_beams)
+            search_args = np.float32(length_penalty)
+        elif draft_model is None and self._prefix_cache is not None:
+            prefill_args = self._run_prefill(
+                prefill_args[0], buffers["token_ids"], prompt_lengths, variables
+            )
+            name = "decode_on_device"
+            make_jitted_fn = self.make_on_device_decode_step
+        elif draft_model is None:
+            name = "generate_on_device"
+            make_jitted_fn = self.make_on_device_generate_step
+        else:
+            # Draft models are part of the traced function, not of its
+            # arguments, so they are part of the cache key.
+            name = f"speculative_generate_on_device_{id(draft_model)}_{num_draft_tokens}"
+            make_jitted_fn = partial(
+                self.make_speculative_generate_step, draft_model, num_draft_tokens
+            )
+            draft_prefill_inputs = draft_model._make_prefill_inputs(
+                buffers["token_ids"], buffers["padding_mask"]
+            )
+            prefill_args += (jax.device_put(draft_prefill_inputs, data_sharding),)
+            variables += draft_model._variable_values()
+
+        data_args = (
+            *prefill_args,
+            jax.device_put(buffers["token_ids"], data_sharding),
+            jax.device_put(buffers["padding_mask"], data_sharding),
+            prompt_lengths,
+            np.array(stop_token_ids, dtype=np.int32),
+            np.int32(max_length),
+            search_args,
+            *constraint_args,
+        )
+        args = (*variables, *data_args)
+        generate_fn = self._get_compiled_fn(name, make_jitted_fn, args, data_args)
+        # Beam search also returns the score of the best hypothesis.
+        token_ids, padding_mask, *_ = generate_fn(*args)
+        token_ids = np.asarray(
+            multihost_utils.process_allgather(token_ids, tiled=True)
+        )
+        padding_mask = np.asarray(
+            multihost_utils.process_allgather(padding_mask, tiled=True)
+        )
+
+        return self._format_generate_output(
+            token_ids[:batch_size],
+            padding_mask[:batch_size],
+            prompt_lengths[:batch_size],
+            strip_prompt,
+        )
+
+    def _stream_with_kv_cache(
+        self,
+        prefill_inputs: Dict[str, jax.Array],
+        buffers: Dict[str, np.ndarray],
+        prompt_lengths: np.ndarray,
+        variables: tuple,
+        stop_token_ids: List[int],
+        max_length: int,
+        sampling_arrays: Dict[str, np.ndarray],
+        batch_size: int,
+        steps_per_chunk: int,
+        constraint_args: tuple = (),
+    ) -> Iterator[List[np.ndarray]]:
+        """Yield the new tokens of the first `batch_size` rows after every
+        `steps_per_chunk` decoding steps. The next chunk is dispatched before
+        the tokens of the previous chunk are transferred to the host."""
+        next_token_logits, cache = self._run_prefill(
+            prefill_inputs, buffers["token_ids"], prompt_lengths, variables
+        )
+        data_sharding = self.sharding_strategy.data_sharding
+        state = init_decode_state(
+            next_token_logits,
+            cache,
+            jax.device_put(buffers["token_ids"], data_sharding),
+            jax.device_put(buffers["padding_mask"], data_sharding),
+            prompt_lengths,
+            np.int32(max_length),
+            *constraint_args,
+        )
+        decode_args = (
+            prompt_lengths,
+            np.array(stop_token_ids, dtype=np.int32),
+            np.int32(max_length),
+            sampling_arrays,
+            np.int32(steps_per_chunk),
+            *constraint_args,
+        )
+
+        def dispatch(state):
+            data_args = (state, *decode_args)
+            args = (*variables, *data_args)
+            decode_fn = self._get_compiled_fn(
+                "decode_chunk_on_device",
+                self.make_on_device_decode_chunk_step,
+                args,
+                data_args,
+            )
+            return decode_fn(*args)
+
+        seq_len = buffers["token_ids"].shape[1]
+        ends = prompt_lengths[:batch_size].astype(np.int64)
+        state, outputs = dispatch(state)
+        num_steps = steps_per_chunk
+        while True:
+            next_outputs = None
+            if num_steps < seq_len:
+                state, next_outputs = dispatch(state)
+                num_steps += steps_per_chunk
+            outputs = {
+                key: np.asarray(
+                    multihost_utils.process_allgather(value, tiled=True)
+                )[:batch_size]
+                for key, value in outputs.items()
+            }
+            new_ends = self._get_prompt_lengths(outputs["padding_mask"])
+            yield [
+                outputs["token_ids"][i, ends[i] : new_ends[i]]
+                for i in range(batch_size)
+            ]
+            ends = np.maximum(ends, new_ends)
+            if next_outputs is None or np.all(outputs["done"]):
+                return
+            outputs = next_outputs
+
+    def _run_prefill(
+        self,
+        prefill_inputs: Dict[str, jax.Array],
+        token_ids: np.ndarray,
+        prompt_lengths: np.ndarray,
+        variables: tuple,
+    ) -> tuple:
+        """Run the prefill step on its own. If prefix caching is enabled,
+        prefill starts from the cached kv cache of the longest prefix shared
+        by all prompts, and the new full prompt blocks are stored.
+
+        Returns:
+            tuple: (logits of the first decoded token of every row, kv cache)
+        """
+        if self._prefix_cache is None:
+            data_args = (prefill_inputs, prompt_lengths)
+            args = (*variables, *data_args)
+            prefill_fn = self._get_compiled_fn(
+                "prefill_on_device", self.make_on_device_prefill_step, args, data_args
+            )
+            return prefill_fn(*args)
+        self._prefix_cache.validate_variables(
+            self.model.trainable_variables + self.model.non_trainable_variables
+        )
+        prefix, block_hashes = build_prefix_kv_cache(
+            self._prefix_cache, token_ids, prompt_lengths, self.prefix_cache_axes
+        )
+        if prefix is not None:
+            prefill_inputs = {**prefill_inputs, "prefix_cache": prefix}
+        data_args = (prefill_inputs, prompt_lengths)
+        args = (*variables, *data_args)
+        prefill_fn = self._get_compiled_fn(
+            "prefill_on_device", self.make_on_device_prefill_step, args, data_args
+        )
+        next_token_logits, cache = prefill_fn(*args)
+        store_prefix_blocks(
+            self._prefix_cache, cache, block_hashes, self.prefix_cache_axes
+        )
+        return next_token_logits, cache
+
     def _generate(
         self,
         inputs: Dict[str, np.ndarray],
@@ -319,9 +1837,12 @@ class Model(ABC, ModelValidationMixin):
         strip_prompt: str = False,
         tokens_key: str = "token_ids",
         padding_mask_key: str = "padding_mask",
+        sampling_params: Optional[SamplingParams] = None,
         **kwargs,
     ) -> Dict[str, np.ndarray]:
-        """Generate tokens using the model.
+        """Generate tokens using the model. This runs the full forward pass
+        for every new token. Prompts must be right-padded and may have
+        different lengths.
 
         Args:
             tokens_key (str, optional): Key in the inputs dictionary for token IDs.
@@ -337,57 +1858,46 @@ class Model(ABC, ModelValidationMixin):
         """
         if stop_token_ids is None:
             stop_token_ids = []
-        if max_length < 1:
+        if max_length is not None and max_length < 1:
             raise ValueError("Please either a positive max_length.")
-        if max_length == None and len(stop_token_ids) == 0:
-            raise ValueError("Please either specify max_length or stop_token_ids.")
 
-        jitted_generate_fn = self.make_generate_step()
+        if self._jitted_generate_step is None:
+            self._jitted_generate_step = self.make_generate_step()
+        if self._jitted_sample_fn is None:
+            self._jitted_sample_fn = jax.jit(sample_next_tokens)
+        jitted_generate_fn = self._jitted_generate_step
         batch_size = inputs[tokens_key].shape[0]
-
-        # Pad batch to be a multiple of fsdp dimension
-        mesh = self.sharding_strategy.data_sharding.mesh
-        devices_in_data_fsdp = (
-            mesh.shape[Axis.FSDP] if Axis.FSDP in mesh.shape else mesh.shape["fsdp"]
-        )
-        remainder = batch_size % devices_in_data_fsdp
-        if remainder != 0:
-            pad_size = devices_in_data_fsdp - remainder
-            for key in inputs.keys():
-                inputs[key] = np.pad(
-                    inputs[key],
-                    ((0, pad_size), (0, 0)),
-                    mode="constant",
-                    constant_values=0,
-                )
+        inputs = self._pad_batch_for_data_sharding(inputs)
+        sampling_arrays = self._pad_batch_for_data_sharding(
+            self._get_sampling_arrays(sampling_params, batch_size),
+            inputs[tokens_key].shape[0],
+        )
 
         def next_token(current_inputs):
             current_inputs = jax.device_put(
                 current_inputs, self.sharding_strategy.data_sharding
             )
-            logits = jitted_generate_fn(
-                [v.value for v in self.model.trainable_variables],
-                [v.value for v in self.model.non_trainable_variables],
-                current_inputs,
-            )
+            logits = jitted_generate_fn(*self._variable_values(), current_inputs)
             jax.block_until_ready(logits)
             return logits
 
-        tokens = inputs[tokens_key]
-        segment_ids = inputs[padding_mask_key]
-
-        # Calculate initial number of tokens (where segment_ids == 1)
-        num_tokens = int(np.sum(segment_ids[0] == 1))
+        tokens = np.array(inputs[tokens_key])
+        segment_ids = np.array(inputs[padding_mask_key])
         seq_len = segment_ids.shape[1]
 
+        # Each row writes its next token right after its own last token
+        prompt_lengths = self._get_prompt_lengths(segment_ids)
+        num_tokens = prompt_lengths.copy()
+        rows = np.arange(tokens.shape[0])
+
         # Calculate how many tokens we can/should generate
         max_length = min(seq_len, max_length) if max_length else seq_len
-        generate_steps = max_length - num_tokens
 
-        # Track which sequences have reached EOS
-        reached_eos = [False for _ in range(batch_size)]
+        # Track which sequences have reached EOS or max_length. Rows added to
+        # pad the batch are finished from the start.
+        reached_eos = (num_tokens >= max_length) | (rows >= batch_size)
 
-        for s in range(generate_steps):
+        while not np.all(reached_eos):
             current_inputs = {
                 **inputs,
                 tokens_key: tokens,
@@ -397,38 +1907,30 @@ class Model(ABC, ModelValidationMixin):
             # Get next token predictions
             logits = next_token(current_inputs)
 
-            next_token_logits = logits[:, num_tokens - 1, :]
-            next_tokens = keras.ops.argmax(next_token_logits, axis=-1)
-            next_tokens = multihost_utils.process_allgather(next_tokens)
-            # Update the tokens array with predictions
-            tokens[:, num_tokens] = next_tokens
+            next_token_logits = logits[rows, np.maximum(num_tokens - 1, 0), :]
+            next_tokens = self._jitted_sample_fn(
+                next_token_logits, sampling_arrays, num_tokens
+            )
+            next_tokens = np.asarray(
+                multihost_utils.process_allgather(next_tokens, tiled=True)
+            )
 
-            # Update attention mask (segment_ids)
-            segment_ids = np.roll(segment_ids, 1, axis=1)
-            segment_ids[:, 0] = 1
+            # Update the tokens array and attention mask for unfinished rows
+            active = ~reached_eos
+            tokens[rows[active], num_tokens[active]] = next_tokens[active]
+            segment_ids[rows[active], num_tokens[active]] = 1
+            num_tokens[active] += 1
 
-            # Increment number of tokens
-            num_tokens += 1
             # Check for EOS tokens
-            for i, token in enumerate(next_tokens.flatten()[:batch_size]):
-                if token in stop_token_ids:
-                    reached_eos[i] = True
-            if np.all(reached_eos):
-                generate_steps = s + 1
-                break
-
-        token_ids = tokens[:batch_size, :num_tokens]
-        padding_mask = segment_ids[:batch_size, :num_tokens]
-        if strip_prompt:
-            token_ids = tokens[:batch_size, num_tokens - generate_steps : num_tokens]
-            padding_mask = segment_ids[
-                :batch_size, num_tokens - generate_steps : num_tokens
-            ]
-
-        return {
-            "padding_mask": padding_mask,
-            "token_ids": token_ids,
-        }
+            reached_eos |= active & np.isin(next_tokens, stop_token_ids)
+            reached_eos |= num_tokens >= max_length
+
+        return self._format_generate_output(
+            tokens[:batch_size],
+            segment_ids[:batch_size],
+            prompt_lengths[:batch_size],
+            strip_prompt,
+        )
 
 
 def set_precision(
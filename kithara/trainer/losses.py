@@ -0,0 +1,254 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Cross entropy computed from hidden states in sequence chunks.
+
+The output projection, log-softmax and loss are computed for one chunk of
+`chunk_size` positions at a time, and recomputed chunk by chunk in the
+backward pass. Only [batch, chunk_size, vocab] logits exist at any time,
+instead of the [batch, seq_len, vocab] logits and their gradient.
+
+Positions without a label, such as the prompt of SFT samples, can be
+dropped before the output projection with `gather_supervised_positions()`.
+"""
+
+import jax
+import jax.numpy as jnp
+from functools import partial
+from typing import Any, Callable, Tuple
+
+# head_fn(trainable_head_values, frozen_head_values, hidden_states) -> logits
+HeadFn = Callable[[Any, Any, jax.Array], jax.Array]
+
+
+def _split_into_chunks(x: jax.Array, chunk_size: int) -> jax.Array:
+    """[B, S, ...] -> [S // chunk_size, B, chunk_size, ...]. The sequence
+    axis is split, so every chunk keeps the batch sharding."""
+    batch_size, seq_len = x.shape[:2]
+    x = x.reshape(batch_size, seq_len // chunk_size, chunk_size, *x.shape[2:])
+    return jnp.swapaxes(x, 0, 1)
+
+
+def _merge_chunks(x: jax.Array) -> jax.Array:
+    """Inverse of `_split_into_chunks()`."""
+    x = jnp.swapaxes(x, 0, 1)
+    return x.reshape(x.shape[0], x.shape[1] * x.shape[2], *x.shape[3:])
+
+
+def _chunk_logits(head_fn, trainable_values, frozen_values, hidden_states):
+    return head_fn(trainable_values, frozen_values, hidden_states).astype(
+        jnp.float32
+    )
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(0, 6))
+def _chunked_nll_sum(
+    head_fn, trainable_values, frozen_values, hidden_states, labels, mask, chunk_size
+):
+    total, _ = _chunked_nll_sum_fwd(
+        head_fn,
+        trainable_values,
+        frozen_values,
+        hidden_states,
+        labels,
+        mask,
+        chunk_size,
+    )
+    return total
+
+
+def _chunked_nll_sum_fwd(
+    head_fn, trainable_values, frozen_values, hidden_states, labels, mask, chunk_size
+):
+    def body(total, chunk):
+        h, chunk_labels, chunk_mask = chunk
+        logits = _chunk_logits(head_fn, trainable_values, frozen_values, h)
+        log_normalizer = jax.nn.logsumexp(logits, axis=-1)
+        label_logits = jnp.take_along_axis(
+            logits, chunk_labels[..., None], axis=-1
+        )[..., 0]
+        nll = jnp.where(chunk_mask, log_normalizer - label_logits, 0.0)
+        return total + jnp.sum(nll), log_normalizer
+
+    chunks = (
+        _split_into_chunks(hidden_states, chunk_size),
+        _split_into_chunks(labels, chunk_size),
+        _split_into_chunks(mask, chunk_size),
+    )
+    total, log_normalizers = jax.lax.scan(body, jnp.zeros((), jnp.float32), chunks)
+    residuals = (
+        trainable_values,
+        frozen_values,
+        hidden_states,
+        labels,
+        mask,
+        log_normalizers,
+    )
+    return total, residuals
+
+
+def _chunked_nll_sum_bwd(head_fn, chunk_size, residuals, g):
+    (
+        trainable_values,
+        frozen_values,
+        hidden_states,
+        labels,
+        mask,
+        log_normalizers,
+    ) = residuals
+
+    def body(trainable_grads, chunk):
+        h, chunk_labels, chunk_mask, log_normalizer = chunk
+        logits, vjp_fn = jax.vjp(
+            lambda values, h: _chunk_logits(head_fn, values, frozen_values, h),
+            trainable_values,
+            h,
+        )
+        # d(logsumexp(logits) - logits[label]) / d(logits)
+        logits_grad = jnp.exp(logits - log_normalizer[..., None])
+        logits_grad -= jax.nn.one_hot(chunk_labels, logits.shape[-1])
+        logits_grad = jnp.where(chunk_mask[..., None], logits_grad * g, 0.0)
+        values_grad, h_grad = vjp_fn(logits_grad)
+        trainable_grads = jax.tree_util.tree_map(
+            lambda acc, grad: acc + grad.astype(jnp.float32),
+            trainable_grads,
+            values_grad,
+        )
+        return trainable_grads, h_grad
+
+    chunks = (
+        _split_into_chunks(hidden_states, chunk_size),
+        _split_into_chunks(labels, chunk_size),
+        _split_into_chunks(mask, chunk_size),
+        log_normalizers,
+    )
+    initial_grads = jax.tree_util.tree_map(
+        lambda x: jnp.zeros(x.shape, jnp.float32), trainable_values
+    )
+    trainable_grads, hidden_states_grad = jax.lax.scan(body, initial_grads, chunks)
+    trainable_grads = jax.tree_util.tree_map(
+        lambda grad, x: grad.astype(x.dtype), trainable_grads, trainable_values
+    )
+    frozen_grads = jax.tree_util.tree_map(jnp.zeros_like, frozen_values)
+    return (
+        trainable_grads,
+        frozen_grads,
+        _merge_chunks(hidden_states_grad),
+        None,
+        None,
+    )
+
+
+_chunked_nll_sum.defvjp(_chunked_nll_sum_fwd, _chunked_nll_sum_bwd)
+
+
+def num_gathered_positions(batch_size: int, token_budget: int) -> int:
+    """Number of positions kept by `gather_supervised_positions()`, i.e.
+    `token_budget` rounded up to a multiple of `batch_size`."""
+    return batch_size * -(-token_budget // batch_size)
+
+
+def gather_supervised_positions(
+    hidden_states: jax.Array, labels: jax.Array, mask: jax.Array, token_budget: int
+) -> Tuple[jax.Array, jax.Array, jax.Array, jax.Array]:
+    """Gather the hidden states and labels of the positions where `mask` is
+    set, across the whole batch, into a static number of positions.
+
+    Positions are gathered in row-major order. When the batch has more masked
+    positions than the budget, the positions that are dropped are always the
+    last ones of the batch, so the last rows lose their supervision first and
+    the kept positions are not a uniform sample. The budget should cover the
+    largest number of masked positions per batch, and the number of dropped
+    positions is returned so that it can be monitored.
+
+    Args:
+        hidden_states: Final hidden states of shape [B, S, D].
+        labels: Integer labels of shape [B, S].
+        mask: Positions of shape [B, S] that contribute to the loss.
+        token_budget: Number of positions kept. It is rounded up to a
+            multiple of B. Masked positions beyond the budget are dropped.
+
+    Returns:
+        tuple: (hidden states of shape [B, K, D], labels of shape [B, K],
+            mask of shape [B, K], number of dropped positions), where
+            K = ceil(token_budget / B). Gathered positions keep their order
+            and unused positions are masked out.
+    """
+    batch_size, _, hidden_dim = hidden_states.shape
+    size = num_gathered_positions(batch_size, token_budget)
+    mask = mask.reshape(-1).astype(bool)
+    (indices,) = jnp.nonzero(mask, size=size, fill_value=0)
+    num_masked = jnp.sum(mask)
+    gathered_mask = jnp.arange(size) < num_masked
+    hidden_states = hidden_states.reshape(-1, hidden_dim)[indices]
+    labels = labels.reshape(-1)[indices]
+    return (
+        hidden_states.reshape(batch_size, -1, hidden_dim),
+        labels.reshape(batch_size, -1),
+        gathered_mask.reshape(batch_size, -1),
+        jnp.maximum(num_masked - size, 0),
+    )
+
+
+def chunked_cross_entropy(
+    head_fn: HeadFn,
+    trainable_head_values: Any,
+    frozen_head_values: Any,
+    hidden_states: jax.Array,
+    labels: jax.Array,
+    mask: jax.Array,
+    chunk_size: int,
+) -> jax.Array:
+    """Mean cross entropy of the labels at the positions where `mask` is
+    set, without materializing the logits of the full sequence.
+
+    Args:
+        head_fn: Computes logits of shape [B, C, V] from hidden states of
+            shape [B, C, D], given the trainable and frozen values of the
+            output layer.
+        trainable_head_values: Values of the output layer that receive a
+            gradient.
+        frozen_head_values: Values of the output layer that do not receive
+            a gradient.
+        hidden_states: Final hidden states of shape [B, S, D].
+        labels: Integer labels of shape [B, S].
+        mask: Positions of shape [B, S] that contribute to the loss.
+        chunk_size: Number of positions per chunk. The sequence is padded to
+            a multiple of `chunk_size`.
+
+    Returns:
+        jax.Array: Scalar float32 loss, averaged over the masked positions.
+    """
+    seq_len = hidden_states.shape[1]
+    chunk_size = min(chunk_size, seq_len)
+    padding = -seq_len % chunk_size
+    mask = mask.astype(bool)
+    if padding:
+
+        def pad(x):
+            return jnp.pad(x, [(0, 0), (0, padding)] + [(0, 0)] * (x.ndim - 2))
+
+        hidden_states, labels, mask = pad(hidden_states), pad(labels), pad(mask)
+    total = _chunked_nll_sum(
+        head_fn,
+        trainable_head_values,
+        frozen_head_values,
+        hidden_states,
+        labels,
+        mask,
+        chunk_size,
+    )
+    return total / jnp.maximum(jnp.sum(mask), 1)
@@ -18,22 +18,35 @@ import os
 
 os.environ["KERAS_BACKEND"] = "jax"
 import keras
+import itertools
 import time
 import sys
 import jax
 from kithara.distributed.sharding.utils import (
-    entire_tree_is_sharded,
-    is_not_sharded_and_is_large,
+    ShardingReport,
     get_size_in_mb,
     get_size_in_gb,
+    sharding_signature,
+    validate_sharding,
 )
 from kithara.model import Model
-from kithara.dataset import Dataloader
+from kithara.dataset import Dataloader, DevicePrefetcher
 from kithara.callbacks import Profiler, Checkpointer
+from kithara.trainer.losses import (
+    chunked_cross_entropy,
+    gather_supervised_positions,
+    num_gathered_positions,
+)
+from kithara.model.hf_compatibility.model_configs import (
+    MODEL_CONFIGS,
+    estimate_training_flops_per_token,
+)
+from kithara.utils.logging_utils import get_peak_flops_per_device
 from kithara.distributed.sharding._data_sharding import DataSharding
 from keras.src.backend.common import global_state
-from typing import Any, Union, List, Tuple
+from typing import Any, Optional, Union, List, Tuple
 import jax.tree_util as jtu
+import jax.numpy as jnp
 import numpy as np
 
 
@@ -63,6 +76,57 @@ class Trainer:
         tensorboard_dir (str, optional): The directory path for TensorBoard logs. Can be either a
             local directory or a Google Cloud Storage (GCS) path. Defaults to None.
         profiler (kithara.Profiler, optional): A profiler instance for monitoring performance metrics. Defaults to None.
+        loss_chunk_size (int, optional): If set, the output layer and the cross entropy are computed for
+            `loss_chunk_size` positions of the sequence at a time, in the forward and the backward pass,
+            so the [batch, seq_len, vocab] logits and their gradient are never materialized. The loss
+            is the per-token cross entropy ignoring padding tokens, the same as the default `loss_fn`,
+            which is not used. Requires a model that supports `stateless_hidden_states()` and
+            `stateless_output_head()`. Defaults to None, which computes the full logits.
+        loss_token_budget (int, optional): If set, only the hidden states of the positions with a
+            label, e.g. the response tokens of SFT samples, go through the output layer and the
+            cross entropy. They are gathered from the whole global batch into a static number of
+            `loss_token_budget` positions, rounded up to a multiple of the global batch size.
+            Labels beyond the budget are dropped from the loss. Positions are gathered in row-major
+            order, so the dropped labels are always those of the last rows of the batch (or
+            microbatch), which biases the loss. The budget should therefore cover the largest
+            number of labels per batch. Dropped labels are reported as `dropped_loss_tokens` in the
+            step statistics, with a warning. Like `loss_chunk_size`, the default `loss_fn` is not
+            used and the model must support `stateless_hidden_states()` and
+            `stateless_output_head()`. Can be combined with `loss_chunk_size`. Defaults to None,
+            which computes the logits of every position.
+        gradient_accumulation_steps (int, optional): Number of microbatches every global batch is
+            split into. Their gradients are computed one after another with a `jax.lax.scan` inside
+            the jitted train step and averaged, weighted by the number of non-padding labels of every
+            microbatch, before a single optimizer update. This trains with the global batch size
+            while only holding the activations of one microbatch. The batch size per device must be
+            divisible by `gradient_accumulation_steps`. Defaults to 1.
+        steps_per_dispatch (int, optional): Number of training steps run by a single jitted call,
+            as a `jax.lax.scan` over that many batches, to remove the host overhead between steps.
+            Losses of every step are still logged, and callbacks still run for every step, after
+            the whole dispatch. A dispatch ends early after the steps that evaluate or checkpoint
+            the model. Defaults to 1.
+        prefetch_depth (int, optional): Number of training batches loaded and transferred to the
+            devices ahead of time on a background thread, so that data loading overlaps with the
+            training steps. Every prefetched batch holds device memory. Set to 0 to load every
+            batch when it is needed. Defaults to 2.
+        non_blocking_metrics (bool, optional): If True, the host does not wait for every step to
+            finish. Losses stay on device and are fetched together every `log_steps_interval`
+            steps, and before the steps that evaluate or checkpoint the model, so the next steps
+            are dispatched while the previous ones run. The step time is then the average over
+            the steps since the last fetch, and `on_train_batch_end` callbacks run when the
+            losses are fetched. Defaults to False, which waits for every step.
+        lazy_state_sync (bool, optional): If True, the (trainable, non-trainable, optimizer) state
+            passed between the jitted steps is the source of truth during training, and it is only
+            written back to the Keras model and optimizer variables when they are read: before the
+            steps that save a checkpoint, before evaluation, at the end of every epoch and at the
+            end of training. This saves the per-variable assignments after every step. Callbacks
+            other than the profiler and the checkpointer, e.g. TensorBoard, may read the variables
+            at any step, so the state is written back after every step when there are any.
+            Defaults to False, which updates the variables after every step.
+        peak_flops_per_device (float, optional): Peak FLOPs per second of one device, used to
+            report the model FLOPs utilization (MFU) of the supported Gemma2 models along with
+            the throughput of non-padding tokens. Defaults to the bfloat16 peak of the device
+            kind, if it is known.
 
     Methods:
         loss_fn: Returns a JAX-compatible callable that computes the loss value from logits and labels.
@@ -88,6 +152,14 @@ class Trainer:
         tensorboard_dir=None,
         profiler: Profiler = None,
         checkpointer: Checkpointer = None,
+        loss_chunk_size: int = None,
+        loss_token_budget: int = None,
+        gradient_accumulation_steps: int = 1,
+        steps_per_dispatch: int = 1,
+        prefetch_depth: int = 2,
+        non_blocking_metrics: bool = False,
+        lazy_state_sync: bool = False,
+        peak_flops_per_device: float = None,
     ):
         if steps is None and epochs is None:
             epochs = 1
@@ -117,6 +189,27 @@ class Trainer:
         self.global_batch_size = train_dataloader.global_batch_size
         self.profiler = profiler
         self.checkpointer = checkpointer
+        self.loss_chunk_size = loss_chunk_size
+        self.loss_token_budget = loss_token_budget
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.steps_per_dispatch = steps_per_dispatch
+        self.prefetch_depth = prefetch_depth
+        self.non_blocking_metrics = non_blocking_metrics
+        self.lazy_state_sync = lazy_state_sync
+        # True when the model variables are behind the training state.
+        self._model_state_is_stale = False
+        # Input signatures whose sharding was validated, and their reports.
+        self._validated_sharding_signatures = set()
+        self.sharding_reports = []
+        self.peak_flops_per_device = (
+            peak_flops_per_device or get_peak_flops_per_device()
+        )
+        # Model FLOPs of training on one token, None for unsupported models.
+        self.flops_per_token = None
+        if model.model_name in MODEL_CONFIGS:
+            self.flops_per_token = estimate_training_flops_per_token(
+                model.model_name, train_dataloader.dataset.max_seq_len
+            )
         self._validate_setup()
 
         # Initialize optimizer and callbacks
@@ -128,7 +221,11 @@ class Trainer:
 
         # JIT compile training and evaluation steps for better performance
         self.train_step = self._make_train_step()
+        self.multi_train_step = self._make_multi_train_step()
         self.eval_step = self._make_eval_step()
+        self.count_tokens = jax.jit(self._count_tokens)
+        # Whether dropped labels of `loss_token_budget` were reported.
+        self._warned_dropped_loss_tokens = False
 
         # Configure data sharding strategy
         self.data_sharding = global_state.get_global_attribute(
@@ -168,6 +265,12 @@ class Trainer:
         Returns:
             tuple: (loss value, updated non-trainable variables)
         """
+        if self._computes_loss_from_hidden_states:
+            loss = self._compute_loss_from_hidden_states(
+                trainable_variables, non_trainable_variables, x, y
+            )
+            return loss, non_trainable_variables
+
         logits, non_trainable_variables = self.model.stateless_call(
             trainable_variables, non_trainable_variables, x
         )
@@ -175,6 +278,71 @@ class Trainer:
 
         return loss, non_trainable_variables
 
+    @property
+    def _computes_loss_from_hidden_states(self) -> bool:
+        return self.loss_chunk_size is not None or self.loss_token_budget is not None
+
+    def _compute_loss_from_hidden_states(
+        self, trainable_variables, non_trainable_variables, x, y
+    ):
+        """Per-token cross entropy computed from the final hidden states with
+        `chunked_cross_entropy()`, see `loss_chunk_size` and
+        `loss_token_budget`."""
+        hidden_states = self.model.stateless_hidden_states(
+            trainable_variables, non_trainable_variables, x
+        )
+        pad_token_id = self.train_dataloader.dataset.tokenizer.pad_token_id
+        mask = y != pad_token_id
+        if self.loss_token_budget is not None:
+            hidden_states, y, mask, _ = gather_supervised_positions(
+                hidden_states, y, mask, self.loss_token_budget
+            )
+            # Gathered positions come from any row, keep them spread over
+            # the data parallel devices.
+            hidden_states = jax.lax.with_sharding_constraint(
+                hidden_states, self.data_sharding
+            )
+            y = jax.lax.with_sharding_constraint(y, self.data_sharding)
+            mask = jax.lax.with_sharding_constraint(mask, self.data_sharding)
+        # Values of the output layer, split by whether they receive a gradient.
+        trainable_indices = {
+            id(v): i for i, v in enumerate(self.model.trainable_variables)
+        }
+        non_trainable_indices = {
+            id(v): i for i, v in enumerate(self.model.non_trainable_variables)
+        }
+        head_variables = self.model.output_head_variables()
+        is_trainable = [id(v) in trainable_indices for v in head_variables]
+        trainable_head_values = [
+            trainable_variables[trainable_indices[id(v)]]
+            for v, trainable in zip(head_variables, is_trainable)
+            if trainable
+        ]
+        frozen_head_values = [
+            non_trainable_variables[non_trainable_indices[id(v)]]
+            for v, trainable in zip(head_variables, is_trainable)
+            if not trainable
+        ]
+
+        def head_fn(trainable_values, frozen_values, hidden_states):
+            trainable_values = iter(trainable_values)
+            frozen_values = iter(frozen_values)
+            head_values = [
+                next(trainable_values) if trainable else next(frozen_values)
+                for trainable in is_trainable
+            ]
+            return self.model.stateless_output_head(head_values, hidden_states)
+
+        return chunked_cross_entropy(
+            head_fn,
+            trainable_head_values,
+            frozen_head_values,
+            hidden_states,
+            y,
+            mask,
+            self.loss_chunk_size or hidden_states.shape[1],
+        )
+
     @property
     def grad_fn(self):
         """Stateless function that returns the value and gradients from the
@@ -200,7 +368,7 @@ class Trainer:
             optimizer_variables,
         ) = state
         x, y = data["x"], data["y"]
-        (loss, non_trainable_variables), grads = self.grad_fn(
+        loss, non_trainable_variables, grads = self._compute_gradients(
             trainable_variables, non_trainable_variables, x, y
         )
         trainable_variables, optimizer_variables = self.optimizer.stateless_apply(
@@ -215,6 +383,71 @@ class Trainer:
             ),
         )
 
+    def _compute_gradients(self, trainable_variables, non_trainable_variables, x, y):
+        """Compute the loss and the gradients of a global batch, accumulated
+        over `gradient_accumulation_steps` microbatches.
+
+        Returns:
+            tuple: (loss value, updated non-trainable variables, gradients)
+        """
+        num_microbatches = self.gradient_accumulation_steps
+        if num_microbatches == 1:
+            (loss, non_trainable_variables), grads = self.grad_fn(
+                trainable_variables, non_trainable_variables, x, y
+            )
+            return loss, non_trainable_variables, grads
+
+        def split(array):
+            # Microbatch i holds rows i, i + num_microbatches, ..., so every
+            # device holds an equal part of every microbatch.
+            array = array.reshape(
+                array.shape[0] // num_microbatches, num_microbatches, *array.shape[1:]
+            )
+            return jnp.swapaxes(array, 0, 1)
+
+        def accumulate(carry, microbatch):
+            non_trainable_variables, grads_sum, loss_sum, num_tokens_sum = carry
+            x, y = jax.lax.with_sharding_constraint(microbatch, self.data_sharding)
+            (loss, non_trainable_variables), grads = self.grad_fn(
+                trainable_variables, non_trainable_variables, x, y
+            )
+            # Weight by the number of tokens, so the result is the per-token
+            # loss of the global batch. Microbatches without tokens add 0.
+            weight = self._num_loss_tokens(y).astype(jnp.float32)
+            grads_sum = jax.tree_util.tree_map(
+                lambda total, grad: total + jnp.where(weight > 0, grad * weight, 0),
+                grads_sum,
+                grads,
+            )
+            loss_sum += jnp.where(weight > 0, loss * weight, 0)
+            return (
+                non_trainable_variables,
+                grads_sum,
+                loss_sum,
+                num_tokens_sum + weight,
+            ), None
+
+        carry = (
+            non_trainable_variables,
+            jax.tree_util.tree_map(jnp.zeros_like, trainable_variables),
+            jnp.zeros((), jnp.float32),
+            jnp.zeros((), jnp.float32),
+        )
+        microbatches = jax.tree_util.tree_map(split, (x, y))
+        (non_trainable_variables, grads, loss, num_tokens), _ = jax.lax.scan(
+            accumulate, carry, microbatches
+        )
+        num_tokens = jnp.maximum(num_tokens, 1)
+        grads = jax.tree_util.tree_map(
+            lambda grad: (grad / num_tokens).astype(grad.dtype), grads
+        )
+        return loss / num_tokens, non_trainable_variables, grads
+
+    def _num_loss_tokens(self, y):
+        """Number of labels that contribute to the default loss."""
+        pad_token_id = self.train_dataloader.dataset.tokenizer.pad_token_id
+        return jnp.sum(y != pad_token_id)
+
     def train(self):
         """Execute the main training loop.
 
@@ -245,74 +478,77 @@ class Trainer:
 
             epoch_loss = 0
             batches_seen_in_epoch = 0
-
-            # Process each batch in the epoch
-            for batch_input in self.train_dataloader:
-                if self.steps and self.step_count >= self.steps:
-                    break
-                self.step_count += 1
-
-                start_time = time.time()
-                self.callbacks.on_train_batch_begin(self.step_count)
-
-                # Prepare and validate input
-                batch_input = self._prepare_batch_input_for_training(batch_input)
-                self._validate_sharding_correctness(batch_input, state)
-
-                # Execute training step
-                loss, state = self.train_step(state, batch_input)
-                epoch_loss += loss
-                batches_seen_in_epoch += 1
-
-                self._update_model_with_state(state)
-
-                # Wait for computation to complete for accurate step time
-                jax.block_until_ready(loss)
-
-                # Calculate training step statistics
-                step_time = time.time() - start_time
-
-                tokens_per_second_per_device = (
-                    self.global_batch_size
-                    * self.train_dataloader.dataset.max_seq_len
-                    / (step_time * self.device_count)
+            # Non-padding tokens and time of the logged training steps.
+            self._epoch_num_tokens = 0
+            self._epoch_train_time = 0.0
+
+            # Process the batches of the epoch, `steps_per_dispatch` at a time.
+            # Batches are transferred to the devices ahead of time.
+            batches = DevicePrefetcher(
+                self.train_dataloader,
+                self._prepare_batch_input_for_training,
+                self.prefetch_depth,
+            )
+            # Losses of the steps whose metrics were not logged yet. They
+            # stay on device until they are fetched together.
+            pending_losses = []
+            pending_token_counts = []
+            try:
+                while True:
+                    num_steps = self._num_steps_in_next_dispatch()
+                    if num_steps == 0:
+                        break
+                    batch_inputs = list(itertools.islice(batches, num_steps))
+                    if not batch_inputs:
+                        break
+
+                    if not pending_losses:
+                        start_time = time.time()
+                    first_step = self.step_count + 1
+                    for i in range(len(batch_inputs)):
+                        self.callbacks.on_train_batch_begin(first_step + i)
+
+                    # Execute training steps
+                    if len(batch_inputs) == 1:
+                        step_fn, step_input = self.train_step, batch_inputs[0]
+                    else:
+                        step_fn, step_input = self.multi_train_step, batch_inputs
+                    num_compilations = self._num_compilations(step_fn)
+                    losses, next_state = step_fn(state, step_input)
+                    pending_token_counts.append(self.count_tokens(step_input))
+                    # Validate the inputs of every newly compiled step. The
+                    # donated state arrays are deleted, but keep their
+                    # shape, dtype and sharding.
+                    if self._is_new_compilation(step_fn, num_compilations):
+                        for batch_input in batch_inputs:
+                            self._validate_sharding_correctness(batch_input, state)
+                    state = next_state
+                    self.step_count += len(batch_inputs)
+                    pending_losses.append(losses)
+
+                    if self.lazy_state_sync:
+                        self._model_state_is_stale = True
+                    else:
+                        self._update_model_with_state(state)
+
+                    if not self.non_blocking_metrics or self._needs_metrics_sync(
+                        first_step, self.step_count
+                    ):
+                        losses = self._log_train_steps(
+                            pending_losses, pending_token_counts, start_time, state
+                        )
+                        epoch_loss += sum(losses)
+                        batches_seen_in_epoch += len(losses)
+                        pending_losses = []
+                        pending_token_counts = []
+            finally:
+                batches.close()
+            if pending_losses:
+                losses = self._log_train_steps(
+                    pending_losses, pending_token_counts, start_time, state
                 )
-
-                samples_per_second = self.global_batch_size / step_time
-
-                step_stats = {
-                    "step": self.step_count,
-                    "loss": round(float(loss), 3),
-                    "step_time": round(step_time, 2),
-                    "epoch": self.epoch_count,
-                    "tokens_per_second_per_device": round(
-                        tokens_per_second_per_device, 1
-                    ),
-                    "tokens_per_second": round(
-                        tokens_per_second_per_device * self.device_count, 1
-                    ),
-                    "samples_per_second": round(samples_per_second, 2),
-                    "train_steps_per_second": round(1 / step_time, 2),
-                    "samples_seen": self.global_batch_size * self.step_count,
-                    "learning_rate": self.optimizer.learning_rate.value,
-                }
-
-                # Log progress
-                if (
-                    self.step_count == 1
-                    or self.step_count % self.log_steps_interval == 0
-                ):
-                    print(step_stats)
-
-                self.callbacks.on_train_batch_end(self.step_count, step_stats)
-
-                # Step based evaluation
-                if (
-                    (self.eval_dataloader is not None)
-                    and (self.eval_steps_interval is not None)
-                    and (self.step_count % self.eval_steps_interval == 0)
-                ):
-                    self.evaluate(state)
+                epoch_loss += sum(losses)
+                batches_seen_in_epoch += len(losses)
 
             # Compute epoch statistics
             # If no custom loss_fn is supplied, the default *step loss* calculates
@@ -320,10 +556,20 @@ class Trainer:
             # The *epoch loss* is simply the average of the step losses. It is not the exact
             # per-token loss across the epoch, but rather a proxy.
             epoch_loss = epoch_loss / batches_seen_in_epoch
-            self.callbacks.on_epoch_end(self.epoch_count, {"epoch_loss": epoch_loss})
+            epoch_stats = {"epoch_loss": epoch_loss}
+            if self._epoch_train_time > 0:
+                epoch_stats.update(
+                    self._throughput_stats(
+                        self._epoch_num_tokens / self._epoch_train_time
+                    )
+                )
+            self._sync_model_with_state(state)
+            self.callbacks.on_epoch_end(self.epoch_count, epoch_stats)
             print(
                 f"Train epoch {self.epoch_count} (epoch may be incompete) loss : {epoch_loss}"
             )
+            if self._epoch_train_time > 0:
+                print(f"Train epoch {self.epoch_count} stats: {epoch_stats}")
 
             # Epoch based evaluation
             if (
@@ -339,8 +585,216 @@ class Trainer:
             if self.epochs and self.epoch_count >= self.epochs:
                 break
 
+        self._sync_model_with_state(state)
         self.callbacks.on_train_end()
 
+    def _log_train_steps(
+        self,
+        losses: List[jax.Array],
+        token_counts: List[dict],
+        start_time: float,
+        state,
+    ):
+        """Fetch the losses of the last training steps, then log the step
+        statistics, run the `on_train_batch_end` callbacks and the step based
+        evaluation of every step.
+
+        Args:
+            losses: Loss values of the last steps, as returned by the train
+                steps, in order. The last step is `self.step_count`.
+            token_counts: Token counts of the same steps, as returned by
+                `count_tokens`.
+            start_time: Time at which the first of these steps was
+                dispatched.
+            state: Current model state.
+
+        Returns:
+            numpy.ndarray: Loss of every step.
+        """
+        # Wait for computation to complete for accurate step time
+        losses, token_counts = jax.device_get((losses, token_counts))
+        losses = np.concatenate([np.atleast_1d(loss) for loss in losses])
+        token_counts = {
+            name: np.concatenate([np.atleast_1d(c[name]) for c in token_counts])
+            for name in token_counts[0]
+        }
+        num_tokens = token_counts["num_tokens"]
+        elapsed_time = time.time() - start_time
+        step_time = elapsed_time / len(losses)
+        self._epoch_num_tokens += int(num_tokens.sum())
+        self._epoch_train_time += elapsed_time
+
+        samples_per_second = self.global_batch_size / step_time
+
+        first_step = self.step_count - len(losses) + 1
+        for i, (step, loss) in enumerate(zip(itertools.count(first_step), losses)):
+            step_stats = {
+                "step": step,
+                "loss": round(float(loss), 3),
+                "step_time": round(step_time, 2),
+                "epoch": self.epoch_count,
+                **self._throughput_stats(num_tokens[i] / step_time),
+                "samples_per_second": round(samples_per_second, 2),
+                "train_steps_per_second": round(1 / step_time, 2),
+                "samples_seen": self.global_batch_size * step,
+                "learning_rate": self._learning_rate_after_step(state, step),
+            }
+            if "num_dropped_loss_tokens" in token_counts:
+                num_dropped = int(token_counts["num_dropped_loss_tokens"][i])
+                step_stats["dropped_loss_tokens"] = num_dropped
+                if num_dropped and not self._warned_dropped_loss_tokens:
+                    print(
+                        f"Warning: Step {step}: {num_dropped} labels beyond "
+                        f"loss_token_budget={self.loss_token_budget} were dropped from "
+                        "the loss, all from the last rows of the batch. Increase "
+                        "loss_token_budget to train on every label."
+                    )
+                    self._warned_dropped_loss_tokens = True
+
+            # Log progress
+            if step == 1 or step % self.log_steps_interval == 0:
+                print(step_stats)
+
+            if self._callbacks_read_model_state() or any(
+                step % interval == 0 for interval in self._checkpoint_intervals()
+            ):
+                self._sync_model_with_state(state)
+            self.callbacks.on_train_batch_end(step, step_stats)
+
+            # Step based evaluation
+            if (
+                (self.eval_dataloader is not None)
+                and (self.eval_steps_interval is not None)
+                and (step % self.eval_steps_interval == 0)
+            ):
+                self._sync_model_with_state(state)
+                self.evaluate(state)
+        return losses
+
+    def _count_tokens(self, data) -> dict:
+        """Token counts of a batch, or of every batch of a list of batches:
+        the number of non-padding input tokens under "num_tokens" and, with
+        `loss_token_budget`, the number of labels dropped from the loss
+        under "num_dropped_loss_tokens"."""
+        if isinstance(data, list):
+            counts = [self._count_tokens(batch) for batch in data]
+            return jax.tree_util.tree_map(lambda *c: jnp.stack(c), *counts)
+        x, y = data["x"], data["y"]
+        if "padding_mask" in x:
+            num_tokens = jnp.sum(x["padding_mask"] != 0)
+        elif "segment_ids" in x:
+            num_tokens = jnp.sum(x["segment_ids"] != 0)
+        else:
+            num_tokens = jnp.asarray(jax.tree_util.tree_leaves(x)[0].size)
+        counts = {"num_tokens": num_tokens}
+        if self.loss_token_budget is not None:
+            # The budget applies to every microbatch, which holds rows
+            # i, i + num_microbatches, ... of the batch.
+            num_microbatches = self.gradient_accumulation_steps
+            pad_token_id = self.train_dataloader.dataset.tokenizer.pad_token_id
+            is_label = (y != pad_token_id).reshape(
+                y.shape[0] // num_microbatches, num_microbatches, -1
+            )
+            num_labels = jnp.sum(is_label, axis=(0, 2))
+            num_kept = num_gathered_positions(
+                y.shape[0] // num_microbatches, self.loss_token_budget
+            )
+            counts["num_dropped_loss_tokens"] = jnp.sum(
+                jnp.maximum(num_labels - num_kept, 0)
+            )
+        return counts
+
+    def _throughput_stats(self, tokens_per_second: float) -> dict:
+        """Token throughput statistics, and the model FLOPs utilization if
+        the model FLOPs and the peak FLOPs of the devices are known.
+
+        Args:
+            tokens_per_second: Non-padding training tokens per second, across
+                all devices.
+        """
+        tokens_per_second_per_device = tokens_per_second / self.device_count
+        stats = {
+            "tokens_per_second_per_device": round(
+                float(tokens_per_second_per_device), 1
+            ),
+            "tokens_per_second": round(float(tokens_per_second), 1),
+        }
+        if self.flops_per_token and self.peak_flops_per_device:
+            model_flops_per_second = tokens_per_second_per_device * self.flops_per_token
+            stats["mfu"] = round(
+                float(model_flops_per_second / self.peak_flops_per_device), 4
+            )
+        return stats
+
+    def _learning_rate_after_step(self, state, step: int):
+        """Learning rate of the optimizer after training step `step`.
+
+        Learning rate schedules are evaluated at `step`, since `state` may be
+        the state after a later step when the metrics of several steps are
+        fetched together. Does not read the optimizer variables, which may be
+        stale with `lazy_state_sync`.
+        """
+        learning_rate = self.optimizer._learning_rate
+        if isinstance(learning_rate, keras.optimizers.schedules.LearningRateSchedule):
+            return learning_rate(step)
+        optimizer_variables = state[2]
+        with keras.StatelessScope(
+            state_mapping=zip(self.optimizer.variables, optimizer_variables)
+        ):
+            learning_rate = self.optimizer.learning_rate
+            if isinstance(learning_rate, keras.Variable):
+                learning_rate = learning_rate.value
+        return learning_rate
+
+    def _callbacks_read_model_state(self) -> bool:
+        """Whether a callback may read the model or optimizer variables at
+        every step, e.g. TensorBoard reads `optimizer.iterations`. The
+        profiler does not read them, and the checkpointer only at the steps
+        given by `_checkpoint_intervals`."""
+        return any(
+            callback is not self.profiler and callback is not self.checkpointer
+            for callback in self.callbacks.callbacks
+        )
+
+    def _checkpoint_intervals(self) -> List[int]:
+        """Step intervals at which the checkpointer saves the model."""
+        if self.checkpointer and self.checkpointer.by_batch:
+            if self.checkpointer.save_interval_steps > 0:
+                return [self.checkpointer.save_interval_steps]
+        return []
+
+    def _state_read_intervals(self) -> List[int]:
+        """Step intervals at which the model state is read, by evaluation or
+        checkpointing."""
+        intervals = self._checkpoint_intervals()
+        if self.eval_dataloader is not None and self.eval_steps_interval:
+            intervals.append(self.eval_steps_interval)
+        return [interval for interval in intervals if interval > 0]
+
+    def _num_steps_in_next_dispatch(self) -> int:
+        """Number of training steps to run in the next dispatch. A dispatch
+        ends after the steps that evaluate or checkpoint the model, since
+        they read the model state."""
+        num_steps = self.steps_per_dispatch
+        if self.steps:
+            num_steps = min(num_steps, self.steps - self.step_count)
+        for interval in self._state_read_intervals():
+            num_steps = min(num_steps, interval - self.step_count % interval)
+        return num_steps
+
+    def _needs_metrics_sync(self, first_step: int, last_step: int) -> bool:
+        """With `non_blocking_metrics`, whether the losses must be fetched
+        after dispatching steps `first_step` to `last_step`: if one of them
+        is logged, or if the model state is read after the last one."""
+        if first_step == 1 or self.steps and last_step >= self.steps:
+            return True
+        logged_steps = last_step // self.log_steps_interval
+        if logged_steps > (first_step - 1) // self.log_steps_interval:
+            return True
+        return any(
+            last_step % interval == 0 for interval in self._state_read_intervals()
+        )
+
     def save_model(self, filepath):
         """Save model weights in .h5 format.
 
@@ -361,10 +815,17 @@ class Trainer:
             Data should be in the same format as expected by _train_step function.
 
         Returns:
-            tuple: (logits, loss value)
+            tuple: (logits, loss value). Logits are None if `loss_chunk_size`
+                or `loss_token_budget` is set.
         """
         (trainable_variables, non_trainable_variables, _) = state
         x, y = data["x"], data["y"]
+        if self._computes_loss_from_hidden_states:
+            # Full logits are not computed.
+            loss = self._compute_loss_from_hidden_states(
+                trainable_variables, non_trainable_variables, x, y
+            )
+            return None, loss
         logits, non_trainable_variables = self.model.stateless_call(
             trainable_variables, non_trainable_variables, x, training=False
         )
@@ -396,6 +857,7 @@ class Trainer:
         # Initialize evaluation
         self.callbacks.on_test_begin()
         eval_loss = 0
+        eval_num_tokens = 0
         eval_batches_seen = 0
         eval_start_time = time.time()
         # Process each batch in evaluation dataset
@@ -406,13 +868,17 @@ class Trainer:
             start_time = time.time()
             # Prepare and shard input
             batch_input = self._prepare_batch_input_for_training(batch_input)
-            self._validate_sharding_correctness(batch_input, state)
 
             # Eval step
+            num_compilations = self._num_compilations(self.eval_step)
             logits, loss = self.eval_step(state, batch_input)
+            if self._is_new_compilation(self.eval_step, num_compilations):
+                self._validate_sharding_correctness(batch_input, state)
+            num_tokens = self.count_tokens(batch_input)["num_tokens"]
 
             # Accumulate metrics
             eval_loss += loss
+            eval_num_tokens += num_tokens
             eval_batches_seen += 1
 
             # Logging
@@ -423,10 +889,8 @@ class Trainer:
                 step_time = time.time() - start_time
                 samples_per_second = self.global_batch_size / step_time
 
-                tokens_per_second_per_device = (
-                    self.global_batch_size
-                    * self.train_dataloader.dataset.max_seq_len
-                    / (step_time * self.device_count)
+                tokens_per_second_per_device = int(num_tokens) / (
+                    step_time * self.device_count
                 )
 
                 step_stats = {
@@ -449,14 +913,14 @@ class Trainer:
         eval_loss = eval_loss / eval_batches_seen
         eval_time = time.time() - eval_start_time
 
-        tokens_per_second_per_device = (
-            eval_batches_seen
-            * self.global_batch_size
-            * self.train_dataloader.dataset.max_seq_len
-        ) / (eval_time * self.device_count)
+        tokens_per_second_per_device = int(eval_num_tokens) / (
+            eval_time * self.device_count
+        )
 
         samples_per_second = eval_batches_seen * self.global_batch_size / eval_time
 
+        # Callbacks may read the model and optimizer variables.
+        self._sync_model_with_state(state)
         self.callbacks.on_test_end(
             {
                 "eval_loss": eval_loss,
@@ -476,6 +940,25 @@ class Trainer:
     def _make_train_step(self):
         return jax.jit(self._train_step, donate_argnums=(0,))
 
+    def _multi_train_step(self, state: Tuple[List[jax.Array]], data: List[dict]):
+        """Execute one training step for every batch of `data`, in a single
+        `jax.lax.scan`.
+
+        Returns:
+            tuple: (loss value of every step, updated state)
+        """
+        data = jax.tree_util.tree_map(lambda *arrays: jnp.stack(arrays), *data)
+
+        def step(state, data):
+            loss, state = self._train_step(state, data)
+            return state, loss
+
+        state, losses = jax.lax.scan(step, state, data)
+        return losses, state
+
+    def _make_multi_train_step(self):
+        return jax.jit(self._multi_train_step, donate_argnums=(0,))
+
     def _make_eval_step(self):
         return jax.jit(self._eval_step, donate_argnums=(0,))
 
@@ -530,6 +1013,13 @@ class Trainer:
             global_shape, self.data_sharding, local_device_buffers
         )
 
+    def _sync_model_with_state(self, state):
+        """With `lazy_state_sync`, write `state` back to the model and
+        optimizer variables if they do not hold it yet."""
+        if self._model_state_is_stale:
+            self._update_model_with_state(state)
+            self._model_state_is_stale = False
+
     def _update_model_with_state(self, state):
         """Update model internal parameters with the provided state."""
         trainable_variables, non_trainable_variables, optimizer_variables, *_ = state
@@ -594,56 +1084,60 @@ class Trainer:
 
         return keras.callbacks.CallbackList(callbacks, model=self.model)
 
-    def _validate_sharding_correctness(self, data, state):
-        """This method performs several sharding correctness checks and prints
-        warnings for any sharding issues detected.
-
-        1. Checks if data is properly sharded
-        2. Validates sharding of trainable variables
-        3. Validates sharding of non-trainable variables
-        4. Validates sharding of optimizer variables
+    @staticmethod
+    def _num_compilations(step_fn) -> Optional[int]:
+        """Number of input signatures the jitted `step_fn` was compiled for,
+        or None if JAX does not expose it."""
+        cache_size = getattr(step_fn, "_cache_size", None)
+        if cache_size is None:
+            return None
+        return cache_size()
+
+    def _is_new_compilation(self, step_fn, num_compilations: Optional[int]) -> bool:
+        """Whether `step_fn` was compiled for a new input signature since it
+        had `num_compilations`. Without a compilation count, every call is
+        treated as new, and `_validate_sharding_correctness` skips the
+        signatures it already validated."""
+        if num_compilations is None:
+            return True
+        return self._num_compilations(step_fn) > num_compilations
+
+    def _validate_sharding_correctness(self, data, state) -> Optional[ShardingReport]:
+        """Check that the input data and the model and optimizer state are
+        sharded, and print a report of the arrays that are not.
+
+        The check runs once per (shape, dtype, sharding) signature of the
+        inputs, i.e. once per compilation of a step function, and is skipped
+        for signatures that were already validated. Reports are kept in
+        `self.sharding_reports`.
 
         Args:
             data: Input batch to validate
             state: Current model state tuple
 
+        Returns:
+            ShardingReport: The report, or None if the signature was already
+                validated or the validation failed.
         """
         try:
-            if not entire_tree_is_sharded(data):
-                print(
-                    "Warning: data is not sharded",
-                    data["y"].shape,
-                    data["y"].sharding,
-                )
-            for variable, value in zip(self.model.trainable_variables, state[0]):
-                if is_not_sharded_and_is_large(value):
-                    print(
-                        f"Step {self.step_count}: trainable variable is not sharded",
-                        f"{get_size_in_mb(value)}mb",
-                        variable.path,
-                        value.shape,
-                        value.sharding,
-                    )
-            for variable, value in zip(self.model.non_trainable_variables, state[1]):
-                if is_not_sharded_and_is_large(value):
-                    print(
-                        f"Step {self.step_count}: nontrainable variable is not sharded",
-                        f"{get_size_in_mb(value)}mb",
-                        variable.path,
-                        value.shape,
-                        value.sharding,
-                    )
-            for variable, value in zip(self.optimizer.variables, state[2]):
-                if is_not_sharded_and_is_large(value):
-                    print(
-                        f"Step {self.step_count}: optimizer variable is not sharded",
-                        f"{get_size_in_mb(value)}mb",
-                        variable.path,
-                        value.shape,
-                        value.sharding,
-                    )
+            signature = sharding_signature((data, state[:3]))
+            if signature in self._validated_sharding_signatures:
+                return None
+            self._validated_sharding_signatures.add(signature)
+            report = validate_sharding(
+                data,
+                {
+                    "trainable": (self.model.trainable_variables, state[0]),
+                    "non_trainable": (self.model.non_trainable_variables, state[1]),
+                    "optimizer": (self.optimizer.variables, state[2]),
+                },
+            )
         except Exception as e:
             print(f"Error during sharding correctness validation: {e}")
+            return None
+        self.sharding_reports.append(report)
+        print(f"Step {self.step_count}: {report}")
+        return report
 
     def _validate_memory_usage(self):
         """This method checks the current HBM usage matches the expected HBM
@@ -706,3 +1200,26 @@ class Trainer:
         assert (self.eval_steps_interval is None) or (
             self.eval_epochs_interval is None
         ), "Specify either eval_steps_interval or eval_epochs_interval, not both"
+
+        assert (
+            self.model.quantization_mode is None
+        ), "Quantized models can only be used for inference"
+
+        assert (
+            self.loss_chunk_size is None or self.loss_chunk_size > 0
+        ), "loss_chunk_size must be a positive integer"
+
+        assert (
+            self.loss_token_budget is None or self.loss_token_budget > 0
+        ), "loss_token_budget must be a positive integer"
+
+        assert (
+            self.gradient_accumulation_steps >= 1
+            and (self.global_batch_size // jax.device_count())
+            % self.gradient_accumulation_steps
+            == 0
+        ), "Batch size per device must be divisible by gradient_accumulation_steps"
+
+        assert self.steps_per_dispatch >= 1, "steps_per_dispatch must be at least 1"
+
+        assert self.prefetch_depth >= 0, "prefetch_depth must not be negative"
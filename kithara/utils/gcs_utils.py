@@ -92,6 +92,26 @@ def upload_folder_to_gcs(local_folder: str, gs_bucket_path: str, num_workers: in
     print(f"Upload completed in {time.time() - start_time}s")
 
 
+def list_files_in_gcs(gs_bucket_path: str) -> list:
+    """Lists the names of the files directly under a Google Cloud Storage folder.
+
+    Args:
+        gs_bucket_path: GCS folder (e.g. "gs://my-bucket/outputs" or "my-bucket/outputs")
+
+    Returns:
+        File names relative to the folder.
+    """
+    gs_bucket_path = gs_bucket_path.removeprefix("gs://")
+    bucket_name = gs_bucket_path.split("/")[0]
+    prefix = gs_bucket_path[len(bucket_name) :].strip("/")
+    if prefix != "":
+        prefix += "/"
+
+    storage_client = Client()
+    blobs = storage_client.list_blobs(bucket_name, prefix=prefix, delimiter="/")
+    return [blob.name[len(prefix) :] for blob in blobs]
+
+
 def find_cache_root_dir():
     if "KERAS_HOME" in os.environ:
         cachdir = os.environ.get("KERAS_HOME")
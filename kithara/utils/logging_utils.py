@@ -30,3 +30,22 @@ def print_kithara_logo_and_platform_info():
         f"     --|===|--"
     )
     print(statistics)
+
+
+# Peak dense bfloat16 FLOPs per second of one device, by device kind.
+_PEAK_FLOPS_PER_DEVICE = {
+    "TPU v4": 275e12,
+    "TPU v5 lite": 197e12,
+    "TPU v5": 459e12,
+    "TPU v5p": 459e12,
+    "TPU v6 lite": 918e12,
+    "NVIDIA A100-SXM4-40GB": 312e12,
+    "NVIDIA A100-SXM4-80GB": 312e12,
+    "NVIDIA H100 80GB HBM3": 989e12,
+}
+
+
+def get_peak_flops_per_device():
+    """Peak bfloat16 FLOPs per second of the local devices, or None if the
+    device kind is unknown."""
+    return _PEAK_FLOPS_PER_DEVICE.get(jax.devices()[0].device_kind)
@@ -0,0 +1,159 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+
+"""
+Benchmark for continuous batching inference with `kithara.InferenceEngine`.
+
+This benchmark generates for requests with random prompt and output lengths
+using a tiny randomly initialized MaxText model, first with static batches
+via `model.generate()`, then with the continuous batching engine. Requests
+use a fixed number of new tokens and ignore stop tokens, so both runs produce
+the same number of tokens.
+
+Metrics: Generated tokens/s, request latency (mean, p50, p99), time to first token
+Artifact: None, results are printed to stdout
+
+Purpose: Measure the throughput gained by reusing decode slots of finished
+    requests instead of waiting for the longest request of a static batch.
+
+Launch Script: JAX_PLATFORMS=cpu python perf/continuous_batching.py
+"""
+
+import os
+
+os.environ["KERAS_BACKEND"] = "jax"
+
+import time
+import numpy as np
+
+# Run parameters
+NUM_REQUESTS = 64
+NUM_SLOTS = 8
+SEQ_LEN = 256
+MAX_PREFILL_LENGTH = 128
+PROMPT_LENGTH_RANGE = (8, 64)
+OUTPUT_LENGTH_RANGE = (4, 64)
+TINY_MODEL_CONFIG = {
+    "base_emb_dim": 128,
+    "base_num_query_heads": 4,
+    "base_num_kv_heads": 2,
+    "head_dim": 32,
+    "base_mlp_dim": 256,
+    "base_num_decoder_layers": 2,
+    "vocab_size": 1024,
+    "max_prefill_predict_length": MAX_PREFILL_LENGTH,
+}
+
+
+def make_requests(rng):
+    prompt_lengths = rng.integers(*PROMPT_LENGTH_RANGE, size=NUM_REQUESTS)
+    prompts = [
+        rng.integers(1, TINY_MODEL_CONFIG["vocab_size"], size=length)
+        for length in prompt_lengths
+    ]
+    # Output lengths are long-tailed, as is typical for chat and eval workloads.
+    output_lengths = np.clip(
+        rng.geometric(p=1 / 16, size=NUM_REQUESTS), *OUTPUT_LENGTH_RANGE
+    )
+    return prompts, output_lengths
+
+
+def run_static_batching(model, prompts, output_lengths):
+    """Generate `NUM_SLOTS` requests at a time. Every batch runs until its
+    longest request is done."""
+    latencies = []
+    start = time.time()
+    for i in range(0, len(prompts), NUM_SLOTS):
+        batch_prompts = prompts[i : i + NUM_SLOTS]
+        batch_output_lengths = output_lengths[i : i + NUM_SLOTS]
+        tokens = np.zeros((len(batch_prompts), SEQ_LEN), np.int32)
+        segment_ids = np.zeros((len(batch_prompts), SEQ_LEN), np.int32)
+        for j, prompt in enumerate(batch_prompts):
+            tokens[j, : len(prompt)] = prompt
+            segment_ids[j, : len(prompt)] = 1
+        max_length = max(
+            len(prompt) + n for prompt, n in zip(batch_prompts, batch_output_lengths)
+        )
+        model.generate(
+            model._make_prefill_inputs(tokens, segment_ids),
+            max_length=max_length,
+            stop_token_ids=[],
+            return_decoded=False,
+        )
+        latencies += [time.time() - start] * len(batch_prompts)
+    return time.time() - start, np.array(latencies), None
+
+
+def run_continuous_batching(engine, prompts, output_lengths):
+    start = time.time()
+    for prompt, n in zip(prompts, output_lengths):
+        engine.add_request(prompt, max_new_tokens=int(n))
+    results = []
+    while engine.num_pending_requests:
+        results += engine.step()
+    latencies = np.array([r.latency for r in results])
+    ttft = np.array([r.time_to_first_token for r in results])
+    return time.time() - start, latencies, ttft
+
+
+def report(name, total_time, latencies, ttft, num_tokens):
+    print(f"=== {name} ===")
+    print(f"Generated tokens/s: {num_tokens / total_time:.1f}")
+    print(
+        f"Latency (s): mean {np.mean(latencies):.3f}, "
+        f"p50 {np.percentile(latencies, 50):.3f}, p99 {np.percentile(latencies, 99):.3f}"
+    )
+    if ttft is not None:
+        print(
+            f"Time to first token (s): mean {np.mean(ttft):.3f}, "
+            f"p99 {np.percentile(ttft, 99):.3f}"
+        )
+
+
+def run_benchmark():
+    from kithara import MaxTextModel, InferenceEngine
+
+    model = MaxTextModel.from_random(
+        "gemma2-2b",
+        seq_len=SEQ_LEN,
+        precision="float32",
+        maxtext_config_args=dict(TINY_MODEL_CONFIG),
+    )
+    engine = InferenceEngine(model, num_slots=NUM_SLOTS)
+
+    prompts, output_lengths = make_requests(np.random.default_rng(0))
+    num_tokens = int(np.sum(output_lengths))
+
+    # Warm up with the same requests, so that every prompt length bucket is
+    # compiled before the measurements
+    run_static_batching(model, prompts, output_lengths)
+    run_continuous_batching(engine, prompts, output_lengths)
+
+    report(
+        "Static batching",
+        *run_static_batching(model, prompts, output_lengths),
+        num_tokens,
+    )
+    report(
+        "Continuous batching",
+        *run_continuous_batching(engine, prompts, output_lengths),
+        num_tokens,
+    )
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,87 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the device prefetcher.
+
+Run test on a single host VM: python -m unittest tests/dataset/test_prefetcher.py
+"""
+
+import threading
+import unittest
+import jax
+import numpy as np
+from kithara.dataset.prefetcher import DevicePrefetcher
+
+
+class TestDevicePrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = [{"x": np.full((2, 3), i)} for i in range(5)]
+
+    def test_yields_prepared_batches_in_order(self):
+        for depth in [0, 1, 3]:
+            prefetcher = DevicePrefetcher(self.batches, jax.device_put, depth)
+            batches = list(prefetcher)
+            # The prefetcher stays exhausted.
+            with self.assertRaises(StopIteration):
+                next(prefetcher)
+            prefetcher.close()
+            self.assertEqual(len(batches), 5)
+            for i, batch in enumerate(batches):
+                self.assertIsInstance(batch["x"], jax.Array)
+                np.testing.assert_array_equal(batch["x"], self.batches[i]["x"])
+
+    def test_prepares_batches_ahead_on_a_background_thread(self):
+        threads = []
+
+        def prepare(batch):
+            threads.append(threading.current_thread())
+            return batch
+
+        prefetcher = DevicePrefetcher(self.batches, prepare, depth=2)
+        next(prefetcher)
+        prefetcher.close()
+        self.assertNotIn(threading.current_thread(), threads)
+        # At most `depth` batches wait in the queue, and one more can be in
+        # preparation when the queue is full.
+        self.assertLessEqual(len(threads), 4)
+
+    def test_forwards_errors(self):
+        def prepare(batch):
+            if batch["x"][0, 0] == 2:
+                raise ValueError("bad batch")
+            return batch
+
+        prefetcher = DevicePrefetcher(self.batches, prepare, depth=2)
+        next(prefetcher)
+        next(prefetcher)
+        with self.assertRaises(ValueError):
+            next(prefetcher)
+        prefetcher.close()
+
+    def test_close_stops_the_background_thread(self):
+        def endless_batches():
+            while True:
+                yield {"x": np.zeros(3)}
+
+        prefetcher = DevicePrefetcher(endless_batches(), lambda batch: batch, depth=2)
+        next(prefetcher)
+        prefetcher.close()
+        self.assertFalse(prefetcher._thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
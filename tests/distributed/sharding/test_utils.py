@@ -0,0 +1,71 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the sharding validation utils.
+
+Run test on a single host VM: python -m unittest tests/distributed/sharding/test_utils.py
+"""
+
+import unittest
+import jax
+import keras
+import numpy as np
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+from kithara.distributed.sharding.utils import sharding_signature, validate_sharding
+
+
+class TestShardingValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.mesh = Mesh(np.array(jax.devices()), ("data",))
+        self.sharded = NamedSharding(self.mesh, P("data"))
+        self.replicated = NamedSharding(self.mesh, P())
+        num_devices = len(jax.devices())
+        self.x = jax.device_put(np.zeros((num_devices, 4)), self.sharded)
+        self.y = jax.device_put(np.zeros((num_devices, 4)), self.replicated)
+
+    def test_sharding_signature(self):
+        self.assertEqual(
+            sharding_signature({"x": self.x}),
+            sharding_signature({"x": jax.numpy.ones_like(self.x)}),
+        )
+        self.assertNotEqual(
+            sharding_signature({"x": self.x}), sharding_signature({"x": self.y})
+        )
+        self.assertNotEqual(
+            sharding_signature({"x": self.x}), sharding_signature({"y": self.x})
+        )
+
+    def test_report_lists_unsharded_data(self):
+        report = validate_sharding({"x": self.x, "y": self.y}, {})
+        self.assertEqual(report.num_arrays, 2)
+        self.assertFalse(report.is_sharded)
+        self.assertEqual([array.path for array in report.unsharded], ["y"])
+        self.assertEqual(report.unsharded[0].group, "data")
+        self.assertIn("1 of 2 arrays are not sharded", str(report))
+
+    def test_small_variables_may_be_replicated(self):
+        variable = keras.Variable(np.zeros((2, 4)), name="kernel")
+        report = validate_sharding(
+            {"x": self.x}, {"trainable": ([variable], [self.y])}
+        )
+        self.assertEqual(report.num_arrays, 2)
+        self.assertTrue(report.is_sharded)
+        self.assertIn("all 2 arrays are sharded", str(report))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
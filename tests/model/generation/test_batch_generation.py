@@ -0,0 +1,132 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the host-side helpers of Model.batch_generate()
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_batch_generation.py
+"""
+
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from kithara.model.generation import ShardWriter, PromptPrefetcher, bucket_prompts
+
+
+class ToyTokenizer:
+    """Maps every character to its code point."""
+
+    def __call__(self, prompts, max_length, truncation):
+        return {"input_ids": [[ord(c) for c in prompt][:max_length] for prompt in prompts]}
+
+
+class TestShardWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def test_resume_after_consecutive_shards(self):
+        writer = ShardWriter(self.output_dir, host_id=1)
+        self.assertEqual(writer.num_completed_shards(), 0)
+        path = writer.write(0, [{"index": 1, "generation": "a"}])
+        writer.write(2, [])
+        self.assertEqual(path, os.path.join(self.output_dir, "shard-000000-host-0001.jsonl"))
+        # Shard 1 is missing, so generation resumes from it.
+        self.assertEqual(writer.num_completed_shards(), 1)
+        # Shards of other hosts are not counted.
+        self.assertEqual(ShardWriter(self.output_dir, host_id=0).num_completed_shards(), 0)
+        with open(path) as f:
+            self.assertEqual([json.loads(line) for line in f], [{"index": 1, "generation": "a"}])
+        self.assertFalse(any(name.endswith(".tmp") for name in os.listdir(self.output_dir)))
+
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+
+        writer = ShardWriter(self.output_dir, output_format="parquet")
+        path = writer.write(0, [{"index": 0, "generation": "a"}, {"index": 1, "generation": "b"}])
+        self.assertEqual(pq.read_table(path).to_pylist()[1], {"index": 1, "generation": "b"})
+        self.assertEqual(writer.num_completed_shards(), 1)
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            ShardWriter(self.output_dir, output_format="csv")
+
+
+class TestPromptPrefetcher(unittest.TestCase):
+
+    def test_bucket_prompts(self):
+        prompt_token_ids = [[1, 2, 3], [4], [5, 6], [7, 8, 9, 10]]
+        batches = bucket_prompts(prompt_token_ids, batch_size=3, max_length=5)
+        self.assertEqual([list(indices) for indices, _ in batches], [[1, 2, 0], [3]])
+        indices, inputs = batches[0]
+        self.assertEqual(inputs["token_ids"].shape, (3, 5))
+        np.testing.assert_array_equal(inputs["token_ids"][2], [1, 2, 3, 0, 0])
+        np.testing.assert_array_equal(inputs["padding_mask"].sum(axis=1), [1, 2, 3])
+
+    def test_shards(self):
+        rows = [{"text": "x" * (i % 4 + 1), "id": i} for i in range(10)]
+        prefetcher = PromptPrefetcher(
+            rows,
+            lambda row: row["text"],
+            ToyTokenizer(),
+            prompts_per_shard=4,
+            batch_size=2,
+            max_length=5,
+            first_shard=1,
+            max_prompt_length=3,
+        )
+        shards = list(prefetcher)
+        # Shard 0 is skipped, and the last shard is smaller.
+        self.assertEqual([shard_index for shard_index, _, _, _ in shards], [1, 2])
+        self.assertEqual(shards[0][1], [row["text"] for row in rows[4:8]])
+        self.assertEqual(shards[1][1], [row["text"] for row in rows[8:]])
+        # Prompts are truncated to max_prompt_length and padded to max_length.
+        _, _, batches, truncated = shards[0]
+        self.assertEqual(sum(len(indices) for indices, _ in batches), 4)
+        self.assertEqual(batches[-1][1]["padding_mask"].sum(), 6)
+        self.assertEqual(batches[-1][1]["padding_mask"].shape[1], 5)
+        self.assertEqual(truncated, [False, False, False, True])
+
+    def test_prompts_leave_room_for_generation(self):
+        rows = [{"text": "x" * 10}]
+        prefetcher = PromptPrefetcher(
+            rows, lambda row: row["text"], ToyTokenizer(), 1, 1, max_length=8
+        )
+        _, _, batches, truncated = next(prefetcher)
+        prefetcher.close()
+        # Prompts are truncated to max_length // 2 by default.
+        self.assertEqual(batches[0][1]["padding_mask"].sum(), 4)
+        self.assertEqual(truncated, [True])
+        with self.assertRaises(ValueError):
+            PromptPrefetcher(
+                rows, lambda row: row["text"], ToyTokenizer(), 1, 1, 8,
+                max_prompt_length=8,
+            )
+
+    def test_errors_are_raised_by_the_consumer(self):
+        def get_prompt(row):
+            raise KeyError("text")
+
+        prefetcher = PromptPrefetcher(
+            [{}], get_prompt, ToyTokenizer(), prompts_per_shard=1, batch_size=1, max_length=3
+        )
+        with self.assertRaises(KeyError):
+            next(prefetcher)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
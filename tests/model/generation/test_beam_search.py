@@ -0,0 +1,141 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for on-device beam search, using a toy model whose logits
+depend on the sum of all previous tokens.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_beam_search.py
+"""
+
+import itertools
+import unittest
+import jax
+import jax.numpy as jnp
+import numpy as np
+from functools import partial
+from kithara.model.generation import beam_search_on_device, generate_on_device, SamplingParams
+from tests.model.generation.utils import ToyModel, make_batch
+
+VOCAB_SIZE = 4
+NUM_STATES = 7
+LOGITS = np.random.RandomState(0).normal(size=(NUM_STATES, VOCAB_SIZE)).astype(np.float32) * 2
+
+
+def table_logits(prefix_sums):
+    return jnp.asarray(LOGITS)[prefix_sums % NUM_STATES]
+
+
+def log_softmax(x):
+    return x - np.log(np.sum(np.exp(x - x.max()))) - x.max()
+
+
+def exhaustive_search(prompt, max_new_tokens, stop_token_ids, length_penalty):
+    """Score every possible continuation."""
+    best, best_score = None, -np.inf
+    for length in range(1, max_new_tokens + 1):
+        for continuation in itertools.product(range(VOCAB_SIZE), repeat=length):
+            if any(t in stop_token_ids for t in continuation[:-1]):
+                continue
+            if length < max_new_tokens and continuation[-1] not in stop_token_ids:
+                continue
+            tokens, log_prob = list(prompt), 0.0
+            for t in continuation:
+                log_prob += log_softmax(LOGITS[sum(tokens) % NUM_STATES])[t]
+                tokens.append(t)
+            score = log_prob / length**length_penalty
+            if score > best_score:
+                best, best_score = tokens, score
+    return best, best_score
+
+
+class TestBeamSearchOnDevice(unittest.TestCase):
+
+    decodes_in_lockstep = False
+
+    def _beam_search(
+        self, prompts, max_length, stop_token_ids, num_beams, length_penalty, seq_len=8
+    ):
+        model = ToyModel(
+            seq_len, table_logits, decodes_in_lockstep=self.decodes_in_lockstep
+        )
+        token_ids, padding_mask, prompt_lengths = make_batch(prompts, seq_len)
+        fn = jax.jit(partial(beam_search_on_device, model, num_beams))
+        return fn(
+            [],
+            [],
+            {"tokens": token_ids, "segment_ids": padding_mask},
+            token_ids,
+            padding_mask,
+            prompt_lengths,
+            np.array(stop_token_ids, dtype=np.int32),
+            np.int32(max_length),
+            np.float32(length_penalty),
+        )
+
+    def test_wide_beam_matches_exhaustive_search(self):
+        prompts = [[1, 2], [3], [2, 2, 1]]
+        for stop_token_ids, length_penalty in [([], 0.0), ([0], 0.0), ([0], 1.0)]:
+            token_ids, padding_mask, scores = self._beam_search(
+                prompts, 6, stop_token_ids, num_beams=VOCAB_SIZE**3, length_penalty=length_penalty
+            )
+            for i, prompt in enumerate(prompts):
+                expected, expected_score = exhaustive_search(
+                    prompt, 6 - len(prompt), stop_token_ids, length_penalty
+                )
+                self.assertEqual(int(np.sum(padding_mask[i])), len(expected))
+                np.testing.assert_array_equal(token_ids[i, : len(expected)], expected)
+                self.assertAlmostEqual(float(scores[i]), expected_score, places=4)
+
+    def test_single_beam_without_length_penalty_is_greedy(self):
+        prompts = [[1, 2], [3], [2, 2, 1]]
+        seq_len = 8
+        model = ToyModel(
+            seq_len, table_logits, decodes_in_lockstep=self.decodes_in_lockstep
+        )
+        token_ids, padding_mask, prompt_lengths = make_batch(prompts, seq_len)
+        greedy, greedy_mask = jax.jit(partial(generate_on_device, model))(
+            [],
+            [],
+            {"tokens": token_ids, "segment_ids": padding_mask},
+            token_ids,
+            padding_mask,
+            prompt_lengths,
+            np.array([0], dtype=np.int32),
+            np.int32(7),
+            SamplingParams().to_arrays(len(prompts)),
+        )
+        beam, beam_mask, _ = self._beam_search(prompts, 7, [0], 1, 0.0, seq_len)
+        np.testing.assert_array_equal(beam_mask, greedy_mask)
+        np.testing.assert_array_equal(beam * beam_mask, greedy * greedy_mask)
+
+    def test_rows_do_not_depend_on_each_other(self):
+        prompts = [[1, 2], [3], [2, 2, 1], []]
+        batched, batched_mask, batched_scores = self._beam_search(prompts, 7, [0], 3, 1.0)
+        self.assertEqual(int(np.sum(batched_mask[3])), 0)
+        for i, prompt in enumerate(prompts[:3]):
+            single, single_mask, single_scores = self._beam_search([prompt], 7, [0], 3, 1.0)
+            np.testing.assert_array_equal(batched_mask[i], single_mask[0])
+            np.testing.assert_array_equal(batched[i] * batched_mask[i], single[0] * single_mask[0])
+            self.assertAlmostEqual(float(batched_scores[i]), float(single_scores[0]), places=5)
+
+
+class TestBeamSearchOnDeviceInLockstep(TestBeamSearchOnDevice):
+
+    decodes_in_lockstep = True
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
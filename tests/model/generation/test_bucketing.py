@@ -0,0 +1,48 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for generation shape bucketing.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_bucketing.py
+"""
+
+import unittest
+from kithara.model.generation import get_bucket_size, next_power_of_two
+
+
+class TestBucketing(unittest.TestCase):
+
+    def test_next_power_of_two(self):
+        self.assertEqual(next_power_of_two(0), 1)
+        self.assertEqual(next_power_of_two(1), 1)
+        self.assertEqual(next_power_of_two(5), 8)
+        self.assertEqual(next_power_of_two(8), 8)
+
+    def test_get_bucket_size(self):
+        self.assertEqual(get_bucket_size(5), 8)
+        self.assertEqual(get_bucket_size(5, multiple_of=6), 12)
+        self.assertEqual(get_bucket_size(3, min_size=16), 16)
+        self.assertEqual(get_bucket_size(40, max_size=50), 50)
+        with self.assertRaises(ValueError):
+            get_bucket_size(51, max_size=50)
+
+    def test_similar_sizes_share_a_bucket(self):
+        buckets = {get_bucket_size(n, multiple_of=4) for n in range(5, 9)}
+        self.assertEqual(buckets, {8})
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
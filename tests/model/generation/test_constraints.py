@@ -0,0 +1,211 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for constrained decoding with token-level automata, using a
+toy vocabulary and a toy model with random logits.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_constraints.py
+"""
+
+import json
+import random
+import re
+import unittest
+import jax.numpy as jnp
+import numpy as np
+from kithara.model.generation import (
+    TokenConstraint,
+    json_schema_to_regex,
+    generate_on_device,
+    SamplingParams,
+)
+from kithara.model.generation.constraints import (
+    _LazyDfa,
+    _RegexParser,
+    advance_token_constraint,
+    allowed_token_mask,
+)
+
+EOS = 0
+TOKEN_STRINGS = [None, "a", "b", "ab", "c", "d", "bc", "x", "dd", "1", "12", "-"]
+VOCAB_SIZE = 16  # Larger than the vocabulary, like padded embeddings.
+
+
+def regex_fullmatch(pattern, text):
+    parser = _RegexParser(pattern)
+    start, accept = parser.parse()
+    dfa = _LazyDfa(parser.edges, start, accept)
+    state = dfa.start
+    for char in text:
+        state = dfa.step(state, char)
+        if state < 0:
+            return False
+    return dfa.is_accepting(state)
+
+
+class ToyTokenizer:
+    eos_token_id = EOS
+    all_special_ids = [EOS]
+    name_or_path = "toy"
+
+    def __len__(self):
+        return len(TOKEN_STRINGS)
+
+    def convert_ids_to_tokens(self, ids):
+        return [TOKEN_STRINGS[i] or "<eos>" for i in ids]
+
+    def convert_tokens_to_string(self, tokens):
+        return "".join(tokens)
+
+
+class ToyModel:
+    """Logits are random but depend on the position only."""
+
+    supports_kv_cache = True
+    decodes_in_lockstep = False
+
+    def __init__(self, seq_len):
+        self.logits = jnp.asarray(
+            np.random.RandomState(0).normal(size=(seq_len, VOCAB_SIZE)), jnp.float32
+        )
+
+    def stateless_prefill(self, trainable_variables, non_trainable_variables, x):
+        positions = jnp.broadcast_to(jnp.arange(x["tokens"].shape[1]), x["tokens"].shape)
+        return self.logits[positions], jnp.zeros(())
+
+    def stateless_decode(
+        self, trainable_variables, non_trainable_variables, cache, token_ids, positions
+    ):
+        return self.logits[positions[:, 0] + 1], cache
+
+
+class TestRegex(unittest.TestCase):
+    def test_matches_python_regex(self):
+        patterns = [
+            r"a(b|c)*d",
+            r"[a-c]{2,3}x?",
+            r"\d+(\.\d{1,2})?",
+            r"(ab|a)+",
+            r"[^ab]*b",
+            r"x{0,2}y{3}",
+            r"[\w-]+@\w+\.com",
+            r"a{2,}",
+            r"(?:ab)?c",
+        ]
+        alphabet = "abcdxy.1-@com_ 9"
+        rng = random.Random(0)
+        for pattern in patterns:
+            for _ in range(500):
+                text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 7)))
+                self.assertEqual(
+                    regex_fullmatch(pattern, text),
+                    re.fullmatch(pattern, text) is not None,
+                    (pattern, text),
+                )
+
+    def test_json_schema(self):
+        schema = {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "age": {"type": "integer"},
+                "score": {"type": ["number", "null"]},
+                "tags": {"type": "array", "items": {"enum": ["a", "b c"]}},
+            },
+        }
+        pattern = json_schema_to_regex(schema)
+        for instance in [
+            {"name": 'x"y', "age": -12, "score": 1.5e3, "tags": ["a", "b c"]},
+            {"name": "", "age": 0, "score": None, "tags": []},
+        ]:
+            self.assertTrue(regex_fullmatch(pattern, json.dumps(instance)))
+            self.assertTrue(
+                regex_fullmatch(pattern, json.dumps(instance, separators=(",", ":")))
+            )
+        self.assertFalse(
+            regex_fullmatch(pattern, '{"name": "x", "age": 01, "score": 1, "tags": []}')
+        )
+
+
+class TestTokenConstraint(unittest.TestCase):
+    def test_allowed_tokens_and_transitions(self):
+        constraint = TokenConstraint.from_token_strings(r"a(b|c)*d", TOKEN_STRINGS, [EOS])
+        arrays = constraint.to_arrays()
+
+        def allowed(states):
+            mask = np.asarray(allowed_token_mask(arrays, states, VOCAB_SIZE))[0]
+            return sorted(TOKEN_STRINGS[i] or "<eos>" for i in np.flatnonzero(mask))
+
+        states = jnp.zeros((1,), jnp.int32)
+        self.assertEqual(allowed(states), ["a", "ab"])
+        states = advance_token_constraint(arrays, states, jnp.array([3]))
+        self.assertEqual(allowed(states), ["b", "bc", "c", "d"])
+        states = advance_token_constraint(arrays, states, jnp.array([5]))
+        # Only stop tokens are allowed after a complete match.
+        self.assertEqual(allowed(states), ["<eos>"])
+        states = advance_token_constraint(arrays, states, jnp.array([EOS]))
+        self.assertEqual(allowed(states), ["<eos>"])
+
+    def test_from_regex_is_cached(self):
+        first = TokenConstraint.from_regex(r"-?\d+", ToyTokenizer())
+        second = TokenConstraint.from_regex(r"-?\d+", ToyTokenizer())
+        self.assertIs(first, second)
+        self.assertIs(first.to_arrays(), second.to_arrays())
+
+    def test_unmatchable_pattern(self):
+        with self.assertRaises(ValueError):
+            TokenConstraint.from_token_strings(r"a+z", TOKEN_STRINGS, [EOS])
+
+    def test_generate_matches_pattern(self):
+        seq_len, prompt_length = 12, 2
+        model = ToyModel(seq_len)
+        batch_size = 4
+        token_ids = np.zeros((batch_size, seq_len), np.int32)
+        token_ids[:, :prompt_length] = 7
+        padding_mask = (token_ids != 0).astype(np.int32)
+        prompt_lengths = np.full((batch_size,), prompt_length, np.int32)
+        for pattern in [r"a(b|c)*d", r"-?(0|[1-9][0-9]*)", r"(x|dd)+"]:
+            constraint = TokenConstraint.from_token_strings(pattern, TOKEN_STRINGS, [EOS])
+            for sampling_params in [
+                SamplingParams(),
+                SamplingParams(temperature=1.0, seed=0),
+            ]:
+                output, mask = generate_on_device(
+                    model,
+                    [],
+                    [],
+                    {"tokens": token_ids, "segment_ids": padding_mask},
+                    token_ids,
+                    padding_mask,
+                    prompt_lengths,
+                    jnp.array([EOS]),
+                    jnp.int32(seq_len),
+                    sampling_params.to_arrays(batch_size),
+                    constraint.to_arrays(),
+                )
+                output, mask = np.asarray(output), np.asarray(mask)
+                for row, row_mask in zip(output, mask):
+                    generated = row[prompt_length:][row_mask[prompt_length:] == 1]
+                    if generated[-1] == EOS:
+                        text = "".join(TOKEN_STRINGS[t] for t in generated[:-1])
+                        self.assertIsNotNone(re.fullmatch(pattern, text), text)
+                    else:
+                        # The output was truncated at max_length.
+                        self.assertEqual(len(generated), seq_len - prompt_length)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
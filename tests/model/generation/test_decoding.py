@@ -0,0 +1,161 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the on-device decoding loop, using a toy model with a
+deterministic next token rule.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_decoding.py
+"""
+
+import unittest
+import jax
+import numpy as np
+from functools import partial
+from kithara.model.generation import (
+    generate_on_device,
+    prefill_on_device,
+    init_decode_state,
+    decode_chunk_on_device,
+    SamplingParams,
+)
+from tests.model.generation.utils import ToyModel, make_batch, reference_generate
+
+
+class TestGenerateOnDevice(unittest.TestCase):
+
+    decodes_in_lockstep = False
+
+    def _generate(
+        self, prompts, max_length, stop_token_ids, seq_len=12, sampling_params=None
+    ):
+        model = ToyModel(seq_len, decodes_in_lockstep=self.decodes_in_lockstep)
+        sampling_params = sampling_params or SamplingParams()
+        token_ids, padding_mask, prompt_lengths = make_batch(prompts, seq_len)
+        fn = jax.jit(partial(generate_on_device, model))
+        return fn(
+            [],
+            [],
+            {"tokens": token_ids, "segment_ids": padding_mask},
+            token_ids,
+            padding_mask,
+            prompt_lengths,
+            np.array(stop_token_ids, dtype=np.int32),
+            np.int32(max_length),
+            sampling_params.to_arrays(len(prompts)),
+        )
+
+    def _assert_matches_reference(self, prompts, max_length, stop_token_ids):
+        token_ids, padding_mask = self._generate(prompts, max_length, stop_token_ids)
+        for i, prompt in enumerate(prompts):
+            expected = reference_generate(
+                prompt, max_length - len(prompt), stop_token_ids
+            )
+            np.testing.assert_array_equal(token_ids[i, : len(expected)], expected)
+            np.testing.assert_array_equal(
+                padding_mask[i], np.arange(padding_mask.shape[1]) < len(expected)
+            )
+
+    def test_matches_reference(self):
+        self._assert_matches_reference([[1, 2, 3], [2, 2, 2]], 9, [])
+
+    def test_stops_at_stop_token(self):
+        self._assert_matches_reference([[1, 2, 3], [2, 2, 2]], 9, [12])
+
+    def test_prompts_of_different_lengths(self):
+        self._assert_matches_reference([[1, 2, 3], [5], [4, 4, 4, 4, 4]], 10, [])
+        self._assert_matches_reference([[1, 2, 3], [5], [4, 4, 4, 4, 4]], 10, [7])
+
+    def test_generates_until_end_of_buffer(self):
+        self._assert_matches_reference([[1, 2, 3], [5]], 12, [])
+
+    def test_rows_without_prompt_are_ignored(self):
+        _, padding_mask = self._generate([[1, 2, 3], []], 9, [12])
+        self.assertEqual(int(np.sum(padding_mask[1])), 0)
+
+    def test_sampling_with_top_k_of_one_is_greedy(self):
+        prompts = [[1, 2, 3], [2, 2, 2]]
+        greedy, _ = self._generate(prompts, 9, [])
+        sampled, _ = self._generate(
+            prompts, 9, [], sampling_params=SamplingParams(temperature=1.0, top_k=1)
+        )
+        np.testing.assert_array_equal(greedy, sampled)
+
+    def test_sampling_does_not_depend_on_other_rows(self):
+        prompts = [[1, 2, 3], [5], [4, 4, 4, 4]]
+        params = SamplingParams(temperature=[1.0, 0.0, 2.0], seed=[7, 8, 9])
+        batched, batched_mask = self._generate(prompts, 12, [], sampling_params=params)
+        for i, prompt in enumerate(prompts):
+            single, single_mask = self._generate(
+                [prompt],
+                12,
+                [],
+                sampling_params=SamplingParams(
+                    temperature=params.temperature[i], seed=[params.seed[i]]
+                ),
+            )
+            np.testing.assert_array_equal(batched[i], single[0])
+            np.testing.assert_array_equal(batched_mask[i], single_mask[0])
+
+    def test_decoding_in_chunks_matches_decoding(self):
+        prompts = [[1, 2, 3], [5], [4, 4, 4, 4, 4]]
+        seq_len, max_length = 12, 10
+        expected, expected_mask = self._generate(prompts, max_length, [7])
+
+        model = ToyModel(seq_len, decodes_in_lockstep=self.decodes_in_lockstep)
+        token_ids, padding_mask, prompt_lengths = make_batch(prompts, seq_len)
+        next_token_logits, cache = prefill_on_device(
+            model,
+            [],
+            [],
+            {"tokens": token_ids, "segment_ids": padding_mask},
+            prompt_lengths,
+        )
+        state = init_decode_state(
+            next_token_logits,
+            cache,
+            token_ids,
+            padding_mask,
+            prompt_lengths,
+            np.int32(max_length),
+        )
+        decode_chunk = jax.jit(partial(decode_chunk_on_device, model))
+        num_tokens = [prompt_lengths]
+        for _ in range(seq_len // 3):
+            state, outputs = decode_chunk(
+                [],
+                [],
+                state,
+                prompt_lengths,
+                np.array([7], dtype=np.int32),
+                np.int32(max_length),
+                SamplingParams().to_arrays(len(prompts)),
+                np.int32(3),
+            )
+            num_tokens.append(np.sum(outputs["padding_mask"], axis=1))
+        np.testing.assert_array_equal(outputs["token_ids"], expected)
+        np.testing.assert_array_equal(outputs["padding_mask"], expected_mask)
+        self.assertTrue(np.all(outputs["done"]))
+        # Every chunk adds at most 3 tokens per row.
+        self.assertLessEqual(np.max(np.diff(num_tokens, axis=0)), 3)
+
+
+class TestGenerateOnDeviceInLockstep(TestGenerateOnDevice):
+
+    decodes_in_lockstep = True
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
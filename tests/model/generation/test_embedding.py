@@ -0,0 +1,86 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for on-device pooling of hidden states.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_embedding.py
+"""
+
+import unittest
+import jax
+import numpy as np
+from functools import partial
+from kithara.model.generation import pool_hidden_states, embed_on_device
+
+
+class ToyModel:
+    def __init__(self, hidden_states):
+        self.hidden_states = hidden_states
+
+    def stateless_hidden_states(
+        self, trainable_variables, non_trainable_variables, x, layer=None
+    ):
+        return self.hidden_states[: x["token_ids"].shape[0]]
+
+
+class TestEmbedding(unittest.TestCase):
+
+    def setUp(self):
+        self.hidden_states = (
+            np.random.RandomState(0).normal(size=(3, 4, 8)).astype(np.float32)
+        )
+        self.padding_mask = np.array(
+            [[1, 1, 1, 0], [1, 1, 1, 1], [0, 0, 0, 0]], dtype=np.int32
+        )
+
+    def test_mean_pooling_ignores_padding(self):
+        pooled = pool_hidden_states(self.hidden_states, self.padding_mask, "mean")
+        np.testing.assert_allclose(
+            pooled[0], self.hidden_states[0, :3].mean(axis=0), rtol=1e-5
+        )
+        np.testing.assert_allclose(
+            pooled[1], self.hidden_states[1].mean(axis=0), rtol=1e-5
+        )
+        np.testing.assert_array_equal(pooled[2], 0)
+
+    def test_last_pooling_takes_last_token(self):
+        pooled = pool_hidden_states(self.hidden_states, self.padding_mask, "last")
+        np.testing.assert_array_equal(pooled[0], self.hidden_states[0, 2])
+        np.testing.assert_array_equal(pooled[1], self.hidden_states[1, 3])
+        np.testing.assert_array_equal(pooled[2], 0)
+
+    def test_unsupported_pooling(self):
+        with self.assertRaises(ValueError):
+            pool_hidden_states(self.hidden_states, self.padding_mask, "max")
+
+    def test_embed_on_device_returns_normalized_float16(self):
+        model = ToyModel(self.hidden_states)
+        token_ids = np.zeros((3, 4), dtype=np.int32)
+        embeddings = jax.jit(partial(embed_on_device, model, None, "mean", True))(
+            [], [], {"token_ids": token_ids}, self.padding_mask
+        )
+        self.assertEqual(embeddings.dtype, np.float16)
+        self.assertEqual(embeddings.shape, (3, 8))
+        np.testing.assert_allclose(
+            np.linalg.norm(np.asarray(embeddings[:2], np.float32), axis=-1),
+            1.0,
+            rtol=1e-2,
+        )
+        np.testing.assert_array_equal(embeddings[2], 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
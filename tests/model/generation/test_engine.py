@@ -0,0 +1,87 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the continuous batching inference engine, using a toy model
+with a deterministic next token rule.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_engine.py
+"""
+
+import unittest
+import numpy as np
+from kithara.model.generation import InferenceEngine, SamplingParams
+from tests.model.generation.utils import ToyModel, reference_generate
+
+
+def make_model():
+    """Toy model with room for prompts of 8 tokens and 8 generated tokens."""
+    return ToyModel(16, max_prefill_length=8)
+
+
+class TestInferenceEngine(unittest.TestCase):
+
+    def test_matches_reference(self):
+        prompts = [[1, 2, 3], [5], [4, 4, 4, 4, 4], [7, 1], [2] * 8, [3, 3]]
+        max_new_tokens = [8, 3, 5, 1, 8, 6]
+        engine = InferenceEngine(
+            make_model(), num_slots=2, stop_token_ids=[9], decode_steps_per_sync=3
+        )
+        request_ids = [
+            engine.add_request(prompt, n) for prompt, n in zip(prompts, max_new_tokens)
+        ]
+        results = {}
+        while engine.num_pending_requests:
+            for result in engine.step():
+                results[result.request_id] = result
+
+        for request_id, prompt, n in zip(request_ids, prompts, max_new_tokens):
+            np.testing.assert_array_equal(
+                results[request_id].token_ids,
+                reference_generate(prompt, n, [9])[len(prompt) :],
+            )
+
+    def test_generate_returns_results_in_prompt_order(self):
+        prompts = [[1, 2, 3], [5], [4, 4, 4, 4, 4]]
+        results = InferenceEngine(make_model(), num_slots=2).generate(
+            prompts, max_new_tokens=4
+        )
+        for prompt, result in zip(prompts, results):
+            np.testing.assert_array_equal(result.prompt_token_ids, prompt)
+            np.testing.assert_array_equal(
+                result.token_ids, reference_generate(prompt, 4, [])[len(prompt) :]
+            )
+            self.assertGreaterEqual(result.latency, result.time_to_first_token)
+
+    def test_sampling_with_top_k_of_one_is_greedy(self):
+        prompts = [[1, 2, 3], [5]]
+        results = InferenceEngine(make_model(), num_slots=2).generate(
+            prompts,
+            max_new_tokens=6,
+            sampling_params=SamplingParams(temperature=1.0, top_k=1),
+        )
+        for prompt, result in zip(prompts, results):
+            np.testing.assert_array_equal(
+                result.token_ids, reference_generate(prompt, 6, [])[len(prompt) :]
+            )
+
+    def test_rejects_prompts_longer_than_prefill_cache(self):
+        engine = InferenceEngine(make_model(), num_slots=2)
+        with self.assertRaises(ValueError):
+            engine.add_request([1] * 9)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
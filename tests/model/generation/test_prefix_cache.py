@@ -0,0 +1,139 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the prefix kv cache.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_prefix_cache.py
+"""
+
+import unittest
+import jax.numpy as jnp
+import numpy as np
+from kithara.model.generation import (
+    PrefixCache,
+    build_prefix_kv_cache,
+    store_prefix_blocks,
+)
+
+# Toy kv cache of shape [B, S, 2], where position i of a row holds the
+# prompt token at i.
+CACHE_AXES = (0, 1)
+
+
+class Variable:
+    def __init__(self, value):
+        self.value = value
+
+
+def make_cache(prompts, seq_len=12):
+    cache = np.zeros((len(prompts), seq_len, 2), dtype=np.float32)
+    for i, prompt in enumerate(prompts):
+        cache[i, : len(prompt)] = np.array(prompt)[:, None]
+    return jnp.asarray(cache)
+
+
+def make_batch(prompts, seq_len=12):
+    token_ids = np.zeros((len(prompts), seq_len), dtype=np.int32)
+    for i, prompt in enumerate(prompts):
+        token_ids[i, : len(prompt)] = prompt
+    return token_ids, np.array([len(p) for p in prompts], dtype=np.int32)
+
+
+class TestPrefixCache(unittest.TestCase):
+
+    def test_block_hashes_identify_the_whole_prefix(self):
+        cache = PrefixCache(block_size=2)
+        hashes = cache.block_hashes([1, 2, 3, 4, 5])
+        self.assertEqual(len(hashes), 2)
+        self.assertEqual(hashes, cache.block_hashes([1, 2, 3, 4, 6]))
+        self.assertEqual(hashes[0], cache.block_hashes([1, 2, 9, 9])[0])
+        self.assertNotEqual(hashes[1], cache.block_hashes([1, 2, 9, 9])[1])
+        # The same block after a different prefix is a different block.
+        self.assertNotEqual(hashes[1], cache.block_hashes([0, 0, 3, 4])[1])
+
+    def test_lookup_returns_longest_cached_prefix(self):
+        cache = PrefixCache(block_size=2)
+        hashes = cache.block_hashes([1, 2, 3, 4, 5, 6])
+        cache.insert(hashes[0], jnp.zeros(1))
+        cache.insert(hashes[2], jnp.zeros(1))
+        self.assertEqual(len(cache.lookup(hashes)), 1)
+        cache.insert(hashes[1], jnp.zeros(1))
+        self.assertEqual(len(cache.lookup(hashes)), 3)
+
+    def test_evicts_least_recently_used_blocks(self):
+        cache = PrefixCache(block_size=1, max_memory_bytes=8)
+        cache.insert(1, jnp.zeros(1, jnp.float32))
+        cache.insert(2, jnp.zeros(1, jnp.float32))
+        cache.lookup([1])
+        cache.insert(3, jnp.zeros(1, jnp.float32))
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(3, cache)
+        self.assertEqual(cache.memory_bytes, 8)
+        # Blocks larger than the budget are not stored.
+        cache.insert(4, jnp.zeros(4, jnp.float32))
+        self.assertNotIn(4, cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_cleared_when_variables_change(self):
+        cache = PrefixCache(block_size=1)
+        variables = [Variable(jnp.zeros(2))]
+        cache.validate_variables(variables)
+        cache.insert(1, jnp.zeros(1))
+        cache.validate_variables(variables)
+        self.assertEqual(len(cache), 1)
+        variables[0].value = jnp.ones(2)
+        cache.validate_variables(variables)
+        self.assertEqual(len(cache), 0)
+
+    def test_store_and_build_prefix(self):
+        prefix_cache = PrefixCache(block_size=2)
+        first = [[1, 2, 3, 4, 5], [1, 2, 3, 4, 6, 7]]
+        token_ids, prompt_lengths = make_batch(first)
+        prefix, hashes = build_prefix_kv_cache(
+            prefix_cache, token_ids, prompt_lengths, CACHE_AXES
+        )
+        self.assertIsNone(prefix)
+        store_prefix_blocks(prefix_cache, make_cache(first), hashes, CACHE_AXES)
+        # [1, 2] and [3, 4] are shared, [6, 7] is only in the second prompt.
+        self.assertEqual(len(prefix_cache), 3)
+
+        second = [[1, 2, 3, 4, 9], [1, 2, 3], []]
+        token_ids, prompt_lengths = make_batch(second)
+        prefix, _ = build_prefix_kv_cache(
+            prefix_cache, token_ids, prompt_lengths, CACHE_AXES
+        )
+        # The second prompt only reuses one block, so that its last token is
+        # still prefilled. The batch padding row gets an empty prefix.
+        self.assertEqual(prefix.shape, (3, 2, 2))
+        np.testing.assert_array_equal(prefix[:, :, 0], [[1, 2], [1, 2], [0, 0]])
+
+    def test_prompts_within_one_block_are_not_cached(self):
+        prefix_cache = PrefixCache(block_size=4)
+        token_ids, prompt_lengths = make_batch([[1, 2, 3, 4]])
+        _, hashes = build_prefix_kv_cache(
+            prefix_cache, token_ids, prompt_lengths, CACHE_AXES
+        )
+        store_prefix_blocks(prefix_cache, make_cache([[1, 2, 3, 4]]), hashes, CACHE_AXES)
+        prefix, _ = build_prefix_kv_cache(
+            prefix_cache, token_ids, prompt_lengths, CACHE_AXES
+        )
+        self.assertIsNone(prefix)
+        self.assertEqual(prefix_cache.hit_rate, 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,88 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for weight-only quantization of model kernels.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_quantization.py
+"""
+
+import unittest
+import jax
+import jax.numpy as jnp
+import numpy as np
+from kithara.model.generation import (
+    QuantizedArray,
+    quantize_array,
+    dequantize_variables,
+)
+
+
+class TestQuantization(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = jax.random.normal(jax.random.PRNGKey(0), (64, 4, 8))
+
+    def test_int8_round_trip(self):
+        quantized = quantize_array(self.kernel, reduce_axes=(0,), bits=8)
+        self.assertEqual(quantized.values.dtype, jnp.int8)
+        self.assertEqual(quantized.scale.shape, (1, 4, 8))
+        self.assertEqual(quantized.shape, self.kernel.shape)
+        # Rounding error is at most half of the quantization step.
+        error = np.abs(quantized.dequantize() - self.kernel)
+        self.assertTrue(np.all(error <= quantized.scale / 2 + 1e-6))
+        self.assertEqual(quantized.dequantize().dtype, self.kernel.dtype)
+
+    def test_int4_round_trip(self):
+        quantized = quantize_array(self.kernel, reduce_axes=(0, 1), bits=4)
+        self.assertEqual(quantized.values.dtype, jnp.int4)
+        self.assertEqual(quantized.scale.shape, (1, 1, 8))
+        values = np.asarray(quantized.values.astype(jnp.int8))
+        self.assertLessEqual(np.max(np.abs(values)), 7)
+        error = np.abs(quantized.dequantize() - self.kernel)
+        self.assertTrue(np.all(error <= quantized.scale / 2 + 1e-6))
+        self.assertLess(quantized.nbytes, self.kernel.nbytes / 4)
+
+    def test_zero_channels(self):
+        kernel = self.kernel.at[:, 0, 0].set(0.0)
+        quantized = quantize_array(kernel, reduce_axes=(0,), bits=8)
+        np.testing.assert_array_equal(quantized.dequantize()[:, 0, 0], 0.0)
+        self.assertFalse(np.any(np.isnan(quantized.dequantize())))
+
+    def test_dequantize_in_jitted_matmul(self):
+        x = jax.random.normal(jax.random.PRNGKey(1), (2, 64))
+        quantized = quantize_array(self.kernel, reduce_axes=(0,), bits=8)
+        variables = ([quantized], [jnp.ones(())])
+
+        @jax.jit
+        def fn(trainable_variables, non_trainable_variables, x):
+            (kernel,), (bias,) = dequantize_variables(
+                (trainable_variables, non_trainable_variables)
+            )
+            return jnp.einsum("bd,dnh->bnh", x, kernel) + bias
+
+        expected = jnp.einsum("bd,dnh->bnh", x, quantized.dequantize()) + 1.0
+        np.testing.assert_allclose(fn(*variables, x), expected, rtol=1e-5, atol=1e-5)
+        # Leaves other than quantized arrays are unchanged.
+        self.assertIs(dequantize_variables(variables)[1][0], variables[1][0])
+        self.assertIsInstance(variables[0][0], QuantizedArray)
+
+    def test_unsupported_bits(self):
+        with self.assertRaises(ValueError):
+            quantize_array(self.kernel, reduce_axes=(0,), bits=2)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,89 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for batched on-device token sampling.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_sampling.py
+"""
+
+import unittest
+import jax
+import jax.numpy as jnp
+import numpy as np
+from kithara.model.generation import SamplingParams, sample_next_tokens
+
+PROBS = [0.5, 0.3, 0.15, 0.05]
+NUM_SAMPLES = 1000
+
+
+class TestSampleNextTokens(unittest.TestCase):
+
+    def _token_frequencies(self, sampling_params):
+        batch_size = len(sampling_params.temperature)
+        logits = jnp.log(jnp.array([PROBS] * batch_size))
+        arrays = sampling_params.to_arrays(batch_size)
+        fn = jax.jit(
+            jax.vmap(sample_next_tokens, in_axes=(None, None, 0), out_axes=1)
+        )
+        positions = jnp.arange(NUM_SAMPLES)[:, None] * jnp.ones(batch_size, jnp.int32)
+        tokens = np.asarray(fn(logits, arrays, positions))
+        return np.stack(
+            [np.bincount(row, minlength=len(PROBS)) / NUM_SAMPLES for row in tokens]
+        )
+
+    def test_greedy(self):
+        arrays = SamplingParams().to_arrays(2)
+        logits = jnp.array([[0.0, 2.0, 1.0], [3.0, 2.0, 1.0]])
+        tokens = sample_next_tokens(logits, arrays, jnp.zeros(2, jnp.int32))
+        np.testing.assert_array_equal(tokens, [1, 0])
+
+    def test_filters(self):
+        frequencies = self._token_frequencies(
+            SamplingParams(
+                temperature=[0.0, 1.0, 1.0, 1.0, 1.0],
+                top_k=[0, 0, 2, 0, 0],
+                top_p=[1.0, 1.0, 1.0, 0.7, 1.0],
+                min_p=[0.0, 0.0, 0.0, 0.0, 0.4],
+                seed=0,
+            )
+        )
+        # Greedy
+        np.testing.assert_array_equal(frequencies[0], [1, 0, 0, 0])
+        # Unfiltered sampling follows the model distribution
+        np.testing.assert_allclose(frequencies[1], PROBS, atol=0.05)
+        # Top-k, top-p and min-p all keep the two most likely tokens
+        for row in frequencies[2:]:
+            np.testing.assert_allclose(row, [0.625, 0.375, 0, 0], atol=0.05)
+
+    def test_rows_are_sampled_with_their_own_key(self):
+        logits = jnp.zeros((3, 100))
+        positions = jnp.zeros(3, jnp.int32)
+        batched = sample_next_tokens(
+            logits, SamplingParams(temperature=1.0, seed=[1, 2, 1]).to_arrays(3), positions
+        )
+        self.assertEqual(int(batched[0]), int(batched[2]))
+        single = sample_next_tokens(
+            logits[:1], SamplingParams(temperature=1.0, seed=[2]).to_arrays(1), positions[:1]
+        )
+        self.assertEqual(int(batched[1]), int(single[0]))
+
+    def test_mismatched_number_of_parameters(self):
+        with self.assertRaises(ValueError):
+            SamplingParams(temperature=[1.0, 1.0]).to_arrays(3)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,81 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for on-device log-likelihood scoring.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_scoring.py
+"""
+
+import unittest
+import jax
+import numpy as np
+from functools import partial
+from kithara.model.generation import token_log_probs, score_on_device
+
+
+class ToyKerasModel:
+    def __init__(self, logits):
+        self.logits = logits
+
+    def stateless_call(self, trainable_variables, non_trainable_variables, x, training):
+        return self.logits[: x["token_ids"].shape[0]], non_trainable_variables
+
+
+class ToyModel:
+    def __init__(self, logits):
+        self.model = ToyKerasModel(logits)
+
+
+class TestScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.logits = np.random.RandomState(0).normal(size=(2, 4, 8)).astype(np.float32)
+        self.labels = np.array([[1, 2, 3, 4], [5, 6, 7, 0]], dtype=np.int32)
+
+    def test_token_log_probs_matches_log_softmax(self):
+        expected = np.take_along_axis(
+            jax.nn.log_softmax(self.logits), self.labels[..., None], axis=-1
+        )[..., 0]
+        np.testing.assert_allclose(
+            token_log_probs(self.logits, self.labels), expected, rtol=1e-5
+        )
+
+    def test_only_scores_masked_labels(self):
+        label_mask = np.array([[0, 1, 1, 0], [1, 1, 1, 1]], dtype=bool)
+        model = ToyModel(self.logits)
+        scores = jax.jit(partial(score_on_device, model))(
+            [], [], {"token_ids": self.labels}, self.labels, label_mask
+        )
+        expected = np.where(label_mask, token_log_probs(self.logits, self.labels), 0)
+        np.testing.assert_allclose(scores["token_log_probs"], expected, rtol=1e-5)
+        np.testing.assert_allclose(scores["log_probs"], expected.sum(axis=1), rtol=1e-5)
+        np.testing.assert_array_equal(scores["num_tokens"], [2, 4])
+
+    def test_is_greedy(self):
+        labels = np.argmax(self.logits, axis=-1).astype(np.int32)
+        labels[1, 0] = (labels[1, 0] + 1) % 8
+        label_mask = np.ones_like(labels, dtype=bool)
+        model = ToyModel(self.logits)
+        scores = score_on_device(model, [], [], {"token_ids": labels}, labels, label_mask)
+        np.testing.assert_array_equal(scores["is_greedy"], [True, False])
+        # Unscored labels do not count.
+        label_mask[1, 0] = False
+        scores = score_on_device(model, [], [], {"token_ids": labels}, labels, label_mask)
+        np.testing.assert_array_equal(scores["is_greedy"], [True, True])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
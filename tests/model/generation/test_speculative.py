@@ -0,0 +1,142 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for on-device speculative decoding, using toy models with
+deterministic next token rules.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_speculative.py
+"""
+
+import unittest
+import jax
+import jax.numpy as jnp
+import numpy as np
+from functools import partial
+from kithara.model.generation import SamplingParams, speculative_generate_on_device
+from tests.model.generation.utils import (
+    VOCAB_SIZE,
+    ToyModel,
+    make_batch,
+    next_token_rule,
+    one_hot_logits,
+    reference_generate,
+)
+
+# The target model greedily predicts `next_token_rule`.
+TARGET_LOGITS = one_hot_logits(next_token_rule, scale=10.0)
+
+
+def draft_rule(prefix_sum):
+    # Agrees with the target, except when the prefix sum is a multiple of 3.
+    return jnp.where(prefix_sum % 3 == 0, prefix_sum + 2, prefix_sum + 1) % VOCAB_SIZE
+
+
+DRAFT_LOGITS = one_hot_logits(draft_rule, scale=10.0)
+
+
+class TestSpeculativeGenerateOnDevice(unittest.TestCase):
+
+    def _generate(
+        self,
+        prompts,
+        max_length,
+        stop_token_ids,
+        num_draft_tokens=3,
+        target_logits=TARGET_LOGITS,
+        draft_logits=DRAFT_LOGITS,
+        seq_len=12,
+        sampling_params=None,
+    ):
+        width = seq_len + num_draft_tokens
+        token_ids, padding_mask, prompt_lengths = make_batch(prompts, width)
+        prefill_inputs = {"tokens": token_ids, "segment_ids": padding_mask}
+        fn = jax.jit(
+            partial(
+                speculative_generate_on_device,
+                ToyModel(width, target_logits),
+                ToyModel(width, draft_logits),
+                num_draft_tokens,
+            )
+        )
+        token_ids, padding_mask = fn(
+            [],
+            [],
+            [],
+            [],
+            prefill_inputs,
+            prefill_inputs,
+            token_ids,
+            padding_mask,
+            prompt_lengths,
+            np.array(stop_token_ids, dtype=np.int32),
+            np.int32(max_length),
+            (sampling_params or SamplingParams()).to_arrays(len(prompts)),
+        )
+        return np.asarray(token_ids), np.asarray(padding_mask)
+
+    def _assert_matches_reference(self, prompts, max_length, stop_token_ids, **kwargs):
+        token_ids, padding_mask = self._generate(
+            prompts, max_length, stop_token_ids, **kwargs
+        )
+        for i, prompt in enumerate(prompts):
+            expected = reference_generate(
+                prompt, max_length - len(prompt), stop_token_ids
+            )
+            np.testing.assert_array_equal(token_ids[i, : len(expected)], expected)
+            np.testing.assert_array_equal(
+                padding_mask[i], np.arange(padding_mask.shape[1]) < len(expected)
+            )
+
+    def test_greedy_matches_target_model(self):
+        self._assert_matches_reference([[1, 2, 3], [2, 2, 2]], 12, [])
+
+    def test_stops_at_stop_token(self):
+        self._assert_matches_reference([[1, 2, 3], [2, 2, 2]], 12, [7])
+
+    def test_prompts_of_different_lengths(self):
+        self._assert_matches_reference([[1, 2, 3], [5], [4, 4, 4, 4, 4]], 11, [])
+        self._assert_matches_reference([[1, 2, 3], [5], [4, 4, 4, 4, 4]], 11, [9])
+
+    def test_draft_identical_to_target(self):
+        self._assert_matches_reference(
+            [[1, 2, 3], [5]], 12, [], draft_logits=TARGET_LOGITS, num_draft_tokens=4
+        )
+
+    def test_sampling_preserves_target_distribution(self):
+        def uniform_logits(prefix_sums):
+            """Samples uniformly from the tokens {0, 1, 2, 3}."""
+            logits = jnp.where(jnp.arange(VOCAB_SIZE) < 4, 0.0, -1e9)
+            return jnp.broadcast_to(logits, prefix_sums.shape + (VOCAB_SIZE,))
+
+        num_rows = 2000
+        token_ids, _ = self._generate(
+            [[1]] * num_rows,
+            4,
+            [],
+            target_logits=uniform_logits,
+            sampling_params=SamplingParams(
+                temperature=1.0, seed=list(range(num_rows))
+            ),
+        )
+        for position in range(1, 4):
+            frequencies = np.bincount(token_ids[:, position], minlength=VOCAB_SIZE)
+            np.testing.assert_allclose(
+                frequencies / num_rows, [0.25] * 4 + [0] * 12, atol=0.04
+            )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
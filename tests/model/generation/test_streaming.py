@@ -0,0 +1,67 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for incremental detokenization.
+
+Run test on a single host VM: python -m unittest tests/model/generation/test_streaming.py
+"""
+
+import unittest
+from kithara.model.generation import IncrementalDetokenizer
+
+
+class ToyTokenizer:
+    """Token i decodes to byte i. Token 0 is a special token."""
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        if skip_special_tokens:
+            token_ids = [t for t in token_ids if t != 0]
+        return bytes(token_ids).decode("utf-8", errors="replace")
+
+
+class TestIncrementalDetokenizer(unittest.TestCase):
+
+    def test_text_deltas_add_up_to_decoded_text(self):
+        token_ids = list("hello world".encode("utf-8"))
+        detokenizer = IncrementalDetokenizer(ToyTokenizer())
+        deltas = [detokenizer.update(token_ids[i : i + 3]) for i in range(0, 11, 3)]
+        self.assertEqual("".join(deltas), "hello world")
+        self.assertEqual(deltas[0], "hel")
+
+    def test_holds_back_incomplete_characters(self):
+        token_ids = list("é!".encode("utf-8"))
+        detokenizer = IncrementalDetokenizer(ToyTokenizer())
+        self.assertEqual(detokenizer.update(token_ids[:1]), "")
+        self.assertEqual(detokenizer.update(token_ids[1:2]), "é")
+        self.assertEqual(detokenizer.update(token_ids[2:]), "!")
+
+    def test_skip_special_tokens(self):
+        token_ids = [0] + list(b"hi")
+        self.assertEqual(IncrementalDetokenizer(ToyTokenizer()).update(token_ids), "hi")
+        self.assertEqual(
+            IncrementalDetokenizer(ToyTokenizer(), skip_special_tokens=False).update(
+                token_ids
+            ),
+            "\x00hi",
+        )
+
+    def test_empty_update(self):
+        detokenizer = IncrementalDetokenizer(ToyTokenizer())
+        self.assertEqual(detokenizer.update([]), "")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
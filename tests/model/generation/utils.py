@@ -0,0 +1,127 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Toy kv-cached model and reference decoder shared by the generation tests."""
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+VOCAB_SIZE = 16
+
+
+def next_token_rule(prefix_sum):
+    """The next token is (sum of all previous tokens + 1) % VOCAB_SIZE."""
+    return (prefix_sum + 1) % VOCAB_SIZE
+
+
+def one_hot_logits(rule=next_token_rule, scale=1.0):
+    """Logits that always predict `rule(prefix_sum)`."""
+
+    def logits_fn(prefix_sums):
+        return jax.nn.one_hot(rule(prefix_sums), VOCAB_SIZE) * scale
+
+    return logits_fn
+
+
+class ToyModel:
+    """Toy model whose logits at a position are `logits_fn(sum of the tokens
+    up to that position)`. The kv cache of shape [B, seq_len] stores the token
+    history, entries after the current position are ignored.
+
+    Args:
+        seq_len: Length of the kv cache.
+        logits_fn: Maps prefix sums of shape [...] to logits of shape
+            [..., vocab_size]. Defaults to greedily predicting
+            `next_token_rule`.
+        decodes_in_lockstep: Whether all rows decode at the same position.
+        max_prefill_length: Longest prompt, for the inference engine. The
+            remaining positions are used for decoding.
+    """
+
+    supports_kv_cache = True
+
+    def __init__(
+        self, seq_len, logits_fn=None, decodes_in_lockstep=False, max_prefill_length=None
+    ):
+        self.seq_len = seq_len
+        self.logits_fn = logits_fn or one_hot_logits()
+        self.decodes_in_lockstep = decodes_in_lockstep
+        self.max_prefill_length = max_prefill_length or seq_len
+        self.max_decode_length = seq_len - self.max_prefill_length
+
+    def _variable_values(self):
+        return [], []
+
+    def _make_prefill_inputs(self, token_ids, padding_mask):
+        return {"tokens": token_ids, "segment_ids": padding_mask}
+
+    def _logits(self, cache, positions):
+        prefix_sums = jnp.take_along_axis(
+            jnp.cumsum(cache, axis=1), positions, axis=1, mode="clip"
+        )
+        return self.logits_fn(prefix_sums)
+
+    def stateless_prefill(self, trainable_variables, non_trainable_variables, x):
+        tokens = x["tokens"] * x["segment_ids"]
+        cache = jnp.zeros((tokens.shape[0], self.seq_len), tokens.dtype)
+        cache = cache.at[:, : tokens.shape[1]].set(tokens)
+        positions = jnp.broadcast_to(jnp.arange(tokens.shape[1]), tokens.shape)
+        return self._logits(cache, positions), cache
+
+    def stateless_extend(
+        self, trainable_variables, non_trainable_variables, cache, token_ids, positions
+    ):
+        batch_index = jnp.arange(cache.shape[0])[:, None]
+        cache = cache.at[batch_index, positions].set(token_ids, mode="drop")
+        return self._logits(cache, positions), cache
+
+    def stateless_decode(
+        self, trainable_variables, non_trainable_variables, cache, token_ids, positions
+    ):
+        logits, cache = self.stateless_extend(
+            trainable_variables, non_trainable_variables, cache, token_ids, positions
+        )
+        return logits[:, -1], cache
+
+    def reorder_kv_cache(self, cache, indices):
+        return jnp.take(cache, indices, axis=0)
+
+    def insert_prefill_cache(self, decode_cache, prefill_cache, slot):
+        decode_cache = decode_cache.at[slot].set(0)
+        return jax.lax.dynamic_update_slice(decode_cache, prefill_cache, (slot, 0))
+
+
+def make_batch(prompts, seq_len):
+    """Right-padded token ids, padding mask and prompt lengths of `prompts`."""
+    token_ids = np.zeros((len(prompts), seq_len), dtype=np.int32)
+    padding_mask = np.zeros((len(prompts), seq_len), dtype=np.int32)
+    for i, prompt in enumerate(prompts):
+        token_ids[i, : len(prompt)] = prompt
+        padding_mask[i, : len(prompt)] = 1
+    prompt_lengths = np.array([len(p) for p in prompts], dtype=np.int32)
+    return token_ids, padding_mask, prompt_lengths
+
+
+def reference_generate(prompt, max_new_tokens, stop_token_ids, rule=next_token_rule):
+    """Greedy generation of the toy model, one token at a time. Returns the
+    prompt followed by the generated tokens."""
+    tokens = list(prompt)
+    for _ in range(max_new_tokens):
+        tokens.append(int(rule(sum(tokens))))
+        if tokens[-1] in stop_token_ids:
+            break
+    return tokens
@@ -0,0 +1,66 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the model FLOPs estimator.
+
+Run test on a single host VM: python -m unittest tests/model/hf_compatibility/test_model_configs.py
+"""
+
+import unittest
+from kithara.model import supported_models
+from kithara.model.hf_compatibility.model_configs import (
+    MODEL_CONFIGS,
+    estimate_training_flops_per_token,
+)
+
+
+class TestEstimateTrainingFlops(unittest.TestCase):
+
+    def test_gemma2_2b_weight_flops(self):
+        # Without attention, training costs 6 FLOPs per weight, and Gemma2 2B
+        # has 2.6B weights.
+        flops = estimate_training_flops_per_token(supported_models.GEMMA2_2B, 0)
+        self.assertAlmostEqual(flops / 6 / 1e9, 2.61, places=2)
+
+    def test_sliding_window_layers_attend_to_the_window(self):
+        config = MODEL_CONFIGS[supported_models.GEMMA2_9B]
+        query_size = config.num_attention_heads * config.head_dim
+        num_global_layers = config.num_hidden_layers // 2
+
+        def flops(seq_len):
+            return estimate_training_flops_per_token(
+                supported_models.GEMMA2_9B, seq_len
+            )
+
+        window = config.sliding_window
+        # Below the window, all layers attend to the full sequence.
+        self.assertAlmostEqual(
+            flops(window) - flops(window // 2),
+            12 * query_size * config.num_hidden_layers * window // 2,
+        )
+        # Beyond the window, only global layers attend to more positions.
+        self.assertAlmostEqual(
+            flops(2 * window) - flops(window),
+            12 * query_size * num_global_layers * window,
+        )
+
+    def test_unsupported_model(self):
+        with self.assertRaises(ValueError):
+            estimate_training_flops_per_token("unknown", 1024)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
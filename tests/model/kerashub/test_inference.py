@@ -21,9 +21,14 @@ Run test on a TPU VM: python -m unittest tests/model/kerashub/test_inference.py
 Note: This test suite will take around 300s in total to complete. 
 """
 import unittest
+import jax
 import numpy as np
 from transformers import AutoTokenizer
-from kithara import KerasHubModel
+from kithara import KerasHubModel, Model, SamplingParams, TokenConstraint
+import json
+import ray
+import re
+import tempfile
 import time
 import unittest.result
 from tests.test_utils import timeout
@@ -159,7 +164,313 @@ class TestModelGeneration(unittest.TestCase):
             return_decoded=True
         )
         self.assertIsInstance(pred[0], str)
-    
+
+    @timeout(200)
+    def test_generate_with_kv_cache_matches_full_forward_pass(self):
+        model_input = {
+            "token_ids": np.array([[2, 10, 20, 30, 0, 0, 0, 0, 0, 0], [2, 11, 0, 0, 0, 0, 0, 0, 0, 0]]),
+            "padding_mask": np.array([[1, 1, 1, 1, 0, 0, 0, 0, 0, 0], [1, 1, 0, 0, 0, 0, 0, 0, 0, 0]]),
+        }
+        cached = self.model._generate(model_input, max_length=8)
+        uncached = Model._generate(self.model, model_input, max_length=8)
+        np.testing.assert_array_equal(cached["token_ids"], uncached["token_ids"])
+        np.testing.assert_array_equal(cached["padding_mask"], uncached["padding_mask"])
+
+    @timeout(200)
+    def test_generate_with_sampling_params(self):
+        def sample(seed):
+            return self.model.generate(
+                [self.test_prompt, "what is the capital of France?"],
+                max_length=20,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+                sampling_params=SamplingParams(temperature=[1.0, 0.0], top_p=0.9, seed=seed),
+            )
+
+        greedy = self.model.generate(
+            "what is the capital of France?",
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+        )
+        first, second = sample(seed=0), sample(seed=0)
+        np.testing.assert_array_equal(first["token_ids"], second["token_ids"])
+        num_tokens = greedy["token_ids"].shape[1]
+        np.testing.assert_array_equal(first["token_ids"][1, :num_tokens], greedy["token_ids"][0])
+
+    @timeout(300)
+    def test_speculative_decoding_matches_greedy_decoding(self):
+        prompts = [self.test_prompt, "what is the capital of France?"]
+        kwargs = dict(
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+        )
+        expected = self.model.generate(prompts, **kwargs)
+        # The model is its own draft model, so every draft is accepted.
+        speculative = self.model.generate(
+            prompts, draft_model=self.model, num_draft_tokens=3, **kwargs
+        )
+        np.testing.assert_array_equal(speculative["token_ids"], expected["token_ids"])
+        np.testing.assert_array_equal(
+            speculative["padding_mask"], expected["padding_mask"]
+        )
+
+    @timeout(300)
+    def test_generate_with_prefix_caching_matches_generate(self):
+        system_prompt = "You are a helpful assistant. Answer in one sentence. "
+        prompts = [system_prompt + "hello world", system_prompt + "what is 1+1?"]
+        kwargs = dict(
+            max_length=40,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+        )
+        expected = self.model.generate(prompts, **kwargs)
+        self.model.enable_prefix_caching(block_size=4)
+        try:
+            for _ in range(2):
+                pred = self.model.generate(prompts, **kwargs)
+                np.testing.assert_array_equal(pred["token_ids"], expected["token_ids"])
+                np.testing.assert_array_equal(
+                    pred["padding_mask"], expected["padding_mask"]
+                )
+            # The second call reuses the shared system prompt.
+            self.assertGreater(self.model.prefix_cache.num_cached_tokens, 0)
+        finally:
+            self.model.disable_prefix_caching()
+
+    @timeout(200)
+    def test_generate_stream_matches_generate(self):
+        prompts = ["hello world", "what is the capital of France?"]
+        expected = self.model.generate(
+            prompts,
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+            strip_prompt=True,
+        )
+        chunks = list(
+            self.model.generate_stream(
+                prompts,
+                max_length=20,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+                steps_per_chunk=4,
+            )
+        )
+        self.assertGreater(len(chunks), 1)
+        for i in range(len(prompts)):
+            streamed = np.concatenate([chunk[i] for chunk in chunks])
+            num_tokens = int(np.sum(expected["padding_mask"][i]))
+            np.testing.assert_array_equal(
+                streamed, expected["token_ids"][i, :num_tokens]
+            )
+
+        text = self.model.generate(
+            prompts[0], max_length=20, tokenizer=self.tokenizer, strip_prompt=True
+        )
+        streamed_text = "".join(
+            chunk[0]
+            for chunk in self.model.generate_stream(
+                prompts[0], max_length=20, tokenizer=self.tokenizer
+            )
+        )
+        self.assertEqual(streamed_text, text[0])
+
+    @timeout(300)
+    def test_beam_search(self):
+        prompts = ["hello world", "what is the capital of France?"]
+        kwargs = dict(
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+        )
+        batched = self.model.generate(prompts, num_beams=4, **kwargs)
+        self.assertEqual(batched["token_ids"].shape[0], len(prompts))
+        # Beams are part of the batch, so prompts do not affect each other.
+        for i, prompt in enumerate(prompts):
+            single = self.model.generate(prompt, num_beams=4, **kwargs)
+            num_tokens = int(np.sum(single["padding_mask"][0]))
+            np.testing.assert_array_equal(
+                batched["token_ids"][i, :num_tokens], single["token_ids"][0, :num_tokens]
+            )
+
+        with self.assertRaises(ValueError):
+            self.model.generate(
+                prompts, num_beams=4, sampling_params=SamplingParams(temperature=1.0), **kwargs
+            )
+
+    def _make_scoring_batch(self):
+        token_ids = np.array(
+            [[2, 10, 20, 30, 40, 50, 0, 0], [2, 10, 20, 30, 41, 0, 0, 0]]
+        )
+        padding_mask = (token_ids != 0).astype(np.int32)
+        # Score the continuation after the shared prefix [2, 10, 20, 30].
+        labels = np.roll(token_ids, -1, axis=1)
+        labels[:, :3] = 0
+        labels[:, -1] = 0
+        return {
+            "x": {"token_ids": token_ids, "padding_mask": padding_mask},
+            "y": labels,
+        }
+
+    @timeout(200)
+    def test_score_matches_full_forward_pass(self):
+        batch = self._make_scoring_batch()
+        scores = self.model.score(
+            batch, ignore_label_id=0, return_token_log_probs=True
+        )
+        logits, _ = self.model.stateless_call(
+            [v.value for v in self.model.trainable_variables],
+            [v.value for v in self.model.non_trainable_variables],
+            batch["x"],
+        )
+        log_probs = jax.nn.log_softmax(np.asarray(logits, dtype=np.float32))
+        labels = batch["y"]
+        expected = np.take_along_axis(log_probs, labels[..., None], axis=-1)[..., 0]
+        expected = np.where(labels != 0, expected, 0)
+        np.testing.assert_allclose(
+            scores["token_log_probs"], expected, rtol=1e-3, atol=1e-3
+        )
+        np.testing.assert_allclose(
+            scores["log_probs"], expected.sum(axis=1), rtol=1e-3, atol=1e-3
+        )
+        np.testing.assert_array_equal(scores["num_tokens"], [2, 1])
+
+    @timeout(300)
+    def test_score_with_prefix_caching_matches_score(self):
+        batch = self._make_scoring_batch()
+        expected = self.model.score(batch, ignore_label_id=0)
+        self.model.enable_prefix_caching(block_size=2)
+        try:
+            for _ in range(2):
+                scores = self.model.score(batch, ignore_label_id=0)
+                np.testing.assert_allclose(
+                    scores["log_probs"], expected["log_probs"], rtol=1e-3, atol=1e-3
+                )
+            self.assertGreater(self.model.prefix_cache.num_cached_tokens, 0)
+        finally:
+            self.model.disable_prefix_caching()
+
+    @timeout(200)
+    def test_embed_matches_backbone_outputs(self):
+        x = {
+            "token_ids": np.array([[2, 651, 6037, 576], [2, 25566, 0, 0]]),
+            "padding_mask": np.array([[1, 1, 1, 1], [1, 1, 0, 0]]),
+        }
+        hidden_states = np.asarray(
+            self.model.model.backbone(x), dtype=np.float32
+        )
+        embeddings = self.model.embed(x)
+        self.assertEqual(embeddings.dtype, np.float16)
+        expected = np.stack(
+            [hidden_states[0].mean(axis=0), hidden_states[1, :2].mean(axis=0)]
+        )
+        np.testing.assert_allclose(embeddings, expected, rtol=1e-2, atol=1e-2)
+
+        embeddings = self.model.embed(x, pooling="last", normalize=True)
+        expected = np.stack([hidden_states[0, 3], hidden_states[1, 1]])
+        expected /= np.linalg.norm(expected, axis=-1, keepdims=True)
+        np.testing.assert_allclose(embeddings, expected, rtol=1e-2, atol=1e-2)
+
+        # Intermediate layers, selected from the start or the end.
+        num_layers = len(self.model.model.backbone.transformer_layers)
+        np.testing.assert_array_equal(
+            self.model.embed(x, layer=num_layers - 2),
+            self.model.embed(x, layer=-2),
+        )
+        with self.assertRaises(ValueError):
+            self.model.embed(x, layer=num_layers)
+
+    @timeout(200)
+    def test_embed_with_string_input(self):
+        embeddings = self.model.embed(
+            [self.test_prompt, "what is the capital of France?"],
+            tokenizer=self.tokenizer,
+            max_length=16,
+        )
+        self.assertEqual(embeddings.shape, (2, self.model.model.backbone.hidden_dim))
+        # Padding does not change the embedding.
+        np.testing.assert_allclose(
+            self.model.embed(self.test_prompt, tokenizer=self.tokenizer, max_length=8),
+            embeddings[:1],
+            rtol=1e-2,
+            atol=1e-2,
+        )
+
+    @timeout(600)
+    def test_generate_with_constraint(self):
+        prompts = ["hello world", "what is the capital of France?"]
+        schema = {
+            "type": "object",
+            "properties": {"city": {"type": "string"}, "population": {"type": "integer"}},
+        }
+        constraint = TokenConstraint.from_json_schema(schema, self.tokenizer)
+        # The automaton is only built once per tokenizer and schema.
+        self.assertIs(constraint, TokenConstraint.from_json_schema(schema, self.tokenizer))
+        pred = self.model.generate(
+            prompts,
+            max_length=60,
+            tokenizer=self.tokenizer,
+            strip_prompt=True,
+            constraint=constraint,
+            sampling_params=SamplingParams(temperature=1.0, seed=0),
+        )
+        for text in pred:
+            # Outputs are either complete matches or truncated at max_length.
+            if text.endswith("}"):
+                self.assertEqual(set(json.loads(text)), {"city", "population"})
+            else:
+                self.assertTrue(text.startswith("{"))
+
+        pred = self.model.generate(
+            prompts[0],
+            max_length=20,
+            tokenizer=self.tokenizer,
+            strip_prompt=True,
+            constraint=TokenConstraint.from_regex(r"(yes|no)", self.tokenizer),
+        )
+        self.assertIsNotNone(re.fullmatch(r"(yes|no)", pred[0]))
+
+
+    @timeout(600)
+    def test_batch_generate_matches_generate(self):
+        prompts = ["hello world", "what is the capital of France?", "a", "count to ten", "b"]
+        dataset = ray.data.from_items([{"text": prompt} for prompt in prompts])
+        output_dir = tempfile.mkdtemp()
+        kwargs = dict(max_length=20, tokenizer=self.tokenizer)
+        files = self.model.batch_generate(
+            dataset, output_dir, per_device_batch_size=1, prompts_per_shard=2, **kwargs
+        )
+        self.assertEqual(len(files), 3)
+
+        def read_rows():
+            rows = []
+            for name in sorted(os.listdir(output_dir)):
+                with open(os.path.join(output_dir, name)) as f:
+                    rows.extend(json.loads(line) for line in f)
+            return rows
+
+        rows = read_rows()
+        self.assertEqual([row["index"] for row in rows], list(range(len(prompts))))
+        expected = self.model.generate(prompts, strip_prompt=True, **kwargs)
+        self.assertEqual([row["generation"] for row in rows], expected)
+        self.assertFalse(any(row["prompt_truncated"] for row in rows))
+
+        # Resume after the last completed shard.
+        os.remove(files[-1])
+        resumed = self.model.batch_generate(
+            dataset, output_dir, per_device_batch_size=1, prompts_per_shard=2, **kwargs
+        )
+        self.assertEqual(resumed, files)
+        self.assertEqual(read_rows(), rows)
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,181 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for multi-LoRA inference with KerasHub models.
+
+Run test on a TPU VM: python -m unittest tests/model/kerashub/test_multi_lora.py
+"""
+
+import json
+import os
+import tempfile
+import unittest
+import jax
+import jax.numpy as jnp
+import keras
+import numpy as np
+from safetensors.numpy import save_file
+from transformers import AutoTokenizer
+from kithara import KerasHubModel
+from kithara.model.kerashub.multi_lora import (
+    batched_lora_delta,
+    load_lora_adapter,
+    multi_lora_scope,
+)
+from tests.test_utils import timeout
+
+NUM_HEADS, HIDDEN_DIM, HEAD_DIM, RANK, NUM_ADAPTERS = 2, 6, 3, 2, 3
+
+
+def add_adapters(layer, in_features, out_features, rng):
+    layer._tracker.unlock()
+    layer.multi_lora_a = layer.add_weight(
+        name="multi_lora_a",
+        shape=(NUM_ADAPTERS, RANK, in_features),
+        initializer="zeros",
+        trainable=False,
+    )
+    layer.multi_lora_b = layer.add_weight(
+        name="multi_lora_b",
+        shape=(NUM_ADAPTERS, out_features, RANK),
+        initializer="zeros",
+        trainable=False,
+    )
+    layer._tracker.lock()
+    weight_a = rng.normal(size=layer.multi_lora_a.shape).astype(np.float32)
+    weight_a[0] = 0
+    layer.multi_lora_a.assign(weight_a)
+    layer.multi_lora_b.assign(rng.normal(size=layer.multi_lora_b.shape))
+
+
+def merged_delta(layer, adapter_id):
+    """The adapter's weight delta in HuggingFace layout [out, in]."""
+    return np.asarray(layer.multi_lora_b.value[adapter_id]) @ np.asarray(
+        layer.multi_lora_a.value[adapter_id]
+    )
+
+
+class TestMultiLora(unittest.TestCase):
+    def test_batched_lora_delta(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(3, 4, HIDDEN_DIM)).astype(np.float32)
+        lora_a = rng.normal(size=(NUM_ADAPTERS, RANK, HIDDEN_DIM)).astype(np.float32)
+        lora_b = rng.normal(size=(NUM_ADAPTERS, 5, RANK)).astype(np.float32)
+        adapter_ids = np.array([2, 0, 1])
+        delta = batched_lora_delta(x, lora_a, lora_b, adapter_ids)
+        for row, adapter_id in enumerate(adapter_ids):
+            expected = x[row] @ (lora_b[adapter_id] @ lora_a[adapter_id]).T
+            np.testing.assert_allclose(delta[row], expected, rtol=1e-5, atol=1e-5)
+
+    def test_scope_matches_merged_kernels(self):
+        rng = np.random.default_rng(0)
+        # Attention projections in the layout of KerasHub's Gemma.
+        query = keras.layers.EinsumDense(
+            "btd,ndh->btnh", output_shape=(None, NUM_HEADS, HEAD_DIM)
+        )
+        query.build((None, None, HIDDEN_DIM))
+        output = keras.layers.EinsumDense("btnh,nhd->btd", output_shape=(None, HIDDEN_DIM))
+        output.build((None, None, NUM_HEADS, HEAD_DIM))
+        add_adapters(query, HIDDEN_DIM, NUM_HEADS * HEAD_DIM, rng)
+        add_adapters(output, NUM_HEADS * HEAD_DIM, HIDDEN_DIM, rng)
+
+        x = rng.normal(size=(3, 4, HIDDEN_DIM)).astype(np.float32)
+        adapter_ids = jnp.array([0, 1, 2])
+
+        @jax.jit
+        def forward(x, adapter_ids):
+            with multi_lora_scope([query, output], adapter_ids):
+                return output(query(x))
+
+        outputs = np.asarray(forward(x, adapter_ids))
+        self.assertNotIn("call", query.__dict__)
+        for row, adapter_id in enumerate(adapter_ids):
+            query_kernel = np.asarray(query.kernel) + merged_delta(
+                query, adapter_id
+            ).reshape(NUM_HEADS, HEAD_DIM, HIDDEN_DIM).transpose(0, 2, 1)
+            output_kernel = np.asarray(output.kernel) + merged_delta(
+                output, adapter_id
+            ).T.reshape(NUM_HEADS, HEAD_DIM, HIDDEN_DIM)
+            expected = np.einsum(
+                "tnh,nhd->td", np.einsum("td,ndh->tnh", x[row], query_kernel), output_kernel
+            )
+            np.testing.assert_allclose(outputs[row], expected, rtol=1e-4, atol=1e-4)
+        # Adapter 0 is the base model.
+        np.testing.assert_allclose(
+            outputs[0], np.asarray(output(query(x)))[0], rtol=1e-5, atol=1e-5
+        )
+
+    def test_load_lora_adapter(self):
+        rng = np.random.default_rng(0)
+        module = "model.layers.0.self_attn.q_proj"
+        weight_a = rng.normal(size=(RANK, HIDDEN_DIM)).astype(np.float32)
+        weight_b = rng.normal(size=(NUM_HEADS * HEAD_DIM, RANK)).astype(np.float32)
+        with tempfile.TemporaryDirectory() as adapter_dir:
+            with open(os.path.join(adapter_dir, "adapter_config.json"), "w") as f:
+                json.dump({"r": RANK, "lora_alpha": 2 * RANK}, f)
+            save_file(
+                {
+                    f"base_model.model.{module}.lora_A.weight": weight_a,
+                    f"base_model.model.{module}.lora_B.weight": weight_b,
+                },
+                os.path.join(adapter_dir, "adapter_model.safetensors"),
+            )
+            weights, rank = load_lora_adapter(adapter_dir)
+        self.assertEqual(rank, RANK)
+        self.assertEqual(list(weights), [module])
+        np.testing.assert_allclose(weights[module][0], weight_a)
+        # The scaling factor lora_alpha / r is folded into B.
+        np.testing.assert_allclose(weights[module][1], 2 * weight_b)
+
+
+@unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+class TestMultiLoraGeneration(unittest.TestCase):
+    @timeout(600)
+    def test_generate_with_adapters_matches_merged_lora(self):
+        tokenizer = AutoTokenizer.from_pretrained("google/gemma-2-2b")
+        model = KerasHubModel.from_preset(
+            "hf://google/gemma-2-2b", lora_rank=4, precision="float32"
+        )
+        rng = np.random.default_rng(0)
+        lora_b = [v for v in model.weights if v.path.endswith("lora_kernel_b")]
+        for variable in lora_b:
+            variable.assign(rng.normal(size=variable.shape) * 0.05)
+        prompts = ["hello world", "what is the capital of France?"]
+        kwargs = dict(
+            max_length=20, stop_token_ids=[], tokenizer=tokenizer, return_decoded=False
+        )
+        with_lora = model.generate(prompts, **kwargs)
+
+        with tempfile.TemporaryDirectory() as adapter_dir:
+            model.save_in_hf_format(adapter_dir, only_save_adapters=True)
+            for variable in lora_b:
+                variable.assign(np.zeros(variable.shape))
+            base = model.generate(prompts, **kwargs)
+            model.enable_multi_lora(max_adapters=2, max_rank=4)
+            adapter_id = model.load_adapter(adapter_dir)
+
+        pred = model.generate(prompts, adapter_ids=[adapter_id, 0], **kwargs)
+        np.testing.assert_array_equal(pred["token_ids"][0], with_lora["token_ids"][0])
+        np.testing.assert_array_equal(pred["token_ids"][1], base["token_ids"][1])
+
+        model.unload_adapter(adapter_id)
+        self.assertEqual(model.adapters, {})
+        pred = model.generate(prompts, adapter_ids=adapter_id, **kwargs)
+        np.testing.assert_array_equal(pred["token_ids"], base["token_ids"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,95 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for KerasHubModel.quantize_for_inference()
+
+Run test on a TPU VM: python -m unittest tests/model/kerashub/test_quantization.py
+"""
+import unittest
+import numpy as np
+from transformers import AutoTokenizer
+from kithara import KerasHubModel, Model
+import time
+from tests.test_utils import timeout
+import os
+
+
+@unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+class TestQuantizeForInference(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = KerasHubModel.from_preset("hf://google/gemma-2-2b")
+        cls.tokenizer = AutoTokenizer.from_pretrained("google/gemma-2-2b")
+        prompt = "what is the capital of France?"
+        generated = cls.model.generate(
+            prompt,
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=cls.tokenizer,
+            return_decoded=False,
+        )
+        # Score the generated tokens of the full precision model.
+        token_ids = generated["token_ids"]
+        num_prompt_tokens = len(cls.tokenizer(prompt)["input_ids"])
+        labels = np.roll(token_ids, -1, axis=1)
+        labels[:, : num_prompt_tokens - 1] = 0
+        labels[:, -1] = 0
+        cls.scoring_batch = {
+            "x": {"token_ids": token_ids, "padding_mask": generated["padding_mask"]},
+            "y": labels,
+        }
+        cls.expected_scores = cls.model.score(cls.scoring_batch, ignore_label_id=0)
+        cls.model.quantize_for_inference("int8")
+
+    def setUp(self):
+        print(f"\nStarting test: {self._testMethodName}")
+        self.start_time = time.time()
+
+    def tearDown(self):
+        duration = time.time() - self.start_time
+        print(f"Completed test: {self._testMethodName} in {duration:.2f} seconds\n")
+
+    @timeout(30)
+    def test_only_kernels_are_quantized(self):
+        self.assertEqual(self.model.quantization_mode, "int8")
+        paths = set(self.model._quantized_values)
+        self.assertGreater(len(paths), 0)
+        self.assertTrue(all(path.endswith("kernel") for path in paths))
+        with self.assertRaises(ValueError):
+            self.model.quantize_for_inference("int4")
+
+    @timeout(200)
+    def test_score_matches_full_precision(self):
+        scores = self.model.score(self.scoring_batch, ignore_label_id=0)
+        np.testing.assert_allclose(
+            scores["log_probs"] / scores["num_tokens"],
+            self.expected_scores["log_probs"] / self.expected_scores["num_tokens"],
+            atol=0.1,
+        )
+
+    @timeout(200)
+    def test_generate_with_kv_cache_matches_full_forward_pass(self):
+        model_input = {
+            "token_ids": np.array([[2, 10, 20, 30, 0, 0, 0, 0, 0, 0], [2, 11, 0, 0, 0, 0, 0, 0, 0, 0]]),
+            "padding_mask": np.array([[1, 1, 1, 1, 0, 0, 0, 0, 0, 0], [1, 1, 0, 0, 0, 0, 0, 0, 0, 0]]),
+        }
+        cached = self.model._generate(model_input, max_length=8)
+        uncached = Model._generate(self.model, model_input, max_length=8)
+        np.testing.assert_array_equal(cached["token_ids"], uncached["token_ids"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
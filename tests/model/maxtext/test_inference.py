@@ -22,7 +22,7 @@ Run test on a TPU VM: python -m unittest tests/model/maxtext/test_inference.py
 import unittest
 import numpy as np
 from transformers import AutoTokenizer
-from kithara import MaxTextModel
+from kithara import MaxTextModel, Model, SamplingParams, InferenceEngine
 import time
 import unittest.result
 import jax
@@ -156,6 +156,225 @@ class TestModelGeneration(unittest.TestCase):
         )
         self.assertIsInstance(pred[0], str)
 
+    @timeout(200)
+    def test_generate_with_kv_cache_matches_full_forward_pass(self):
+        self.assertTrue(self.model.supports_kv_cache)
+
+        def make_prompt():
+            segment_ids = np.zeros((jax.device_count(), 100), dtype=np.int32)
+            segment_ids[:, :10] = 1
+            return {
+                "tokens": np.array([[i for i in range(100)]] * jax.device_count()),
+                "positions": np.array([[i for i in range(100)]] * jax.device_count()),
+                "segment_ids": segment_ids,
+            }
+
+        cached = self.model._generate(make_prompt(), max_length=15)
+        uncached = Model._generate(
+            self.model,
+            make_prompt(),
+            max_length=15,
+            tokens_key="tokens",
+            padding_mask_key="segment_ids",
+        )
+        self.assertEqual(cached["token_ids"].shape, (jax.device_count(), 15))
+        np.testing.assert_array_equal(cached["token_ids"], uncached["token_ids"])
+        np.testing.assert_array_equal(
+            cached["padding_mask"], uncached["padding_mask"]
+        )
+
+    @timeout(200)
+    def test_generate_reuses_compiled_functions(self):
+        self.model.clear_compiled_generate_fns()
+        for num_prompts in [3, 4, 3]:
+            self.model.generate(
+                [self.test_prompt] * num_prompts,
+                max_length=20,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+            )
+        # Both batch sizes fall in the same batch bucket, and the prompts fall
+        # in the same prompt length bucket.
+        self.assertEqual(len(self.model._compiled_generate_fns), 1)
+
+    @timeout(200)
+    def test_generate_with_prompts_of_different_lengths(self):
+        prompts = ["hello world", "what is the capital of France?"]
+        batched = self.model.generate(
+            prompts,
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+            strip_prompt=True,
+        )
+        for i, prompt in enumerate(prompts):
+            single = self.model.generate(
+                prompt,
+                max_length=20,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+                strip_prompt=True,
+            )
+            num_tokens = int(np.sum(batched["padding_mask"][i]))
+            self.assertEqual(num_tokens, single["token_ids"].shape[1])
+            np.testing.assert_array_equal(
+                batched["token_ids"][i, :num_tokens], single["token_ids"][0]
+            )
+
+    @timeout(200)
+    def test_generate_with_sampling_params(self):
+        prompts = ["hello world", "what is the capital of France?"]
+
+        def sample(seed):
+            return self.model.generate(
+                prompts,
+                max_length=20,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+                sampling_params=SamplingParams(
+                    temperature=[1.0, 0.0], top_k=50, top_p=0.9, min_p=0.05, seed=seed
+                ),
+            )
+
+        greedy = self.model.generate(
+            prompts[1],
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+        )
+        first, second = sample(seed=0), sample(seed=0)
+        np.testing.assert_array_equal(first["token_ids"], second["token_ids"])
+        # The second prompt uses greedy decoding.
+        num_tokens = greedy["token_ids"].shape[1]
+        np.testing.assert_array_equal(
+            first["token_ids"][1, :num_tokens], greedy["token_ids"][0]
+        )
+
+    @timeout(300)
+    def test_inference_engine_matches_generate(self):
+        prompts = [
+            "hello world",
+            "what is the capital of France?",
+            "count from one to ten",
+            "a",
+        ]
+        # Two slots for four prompts, so that slots are reused after insertion.
+        engine = InferenceEngine(self.model, num_slots=2, decode_steps_per_sync=4)
+        results = engine.generate(
+            [self.tokenizer(prompt)["input_ids"] for prompt in prompts],
+            max_new_tokens=10,
+        )
+        for prompt, result in zip(prompts, results):
+            expected = self.model.generate(
+                prompt,
+                max_length=len(result.prompt_token_ids) + 10,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+                strip_prompt=True,
+            )
+            np.testing.assert_array_equal(result.token_ids, expected["token_ids"][0])
+
+    @timeout(200)
+    def test_generate_stream_matches_generate(self):
+        prompts = ["hello world", "what is the capital of France?"]
+        expected = self.model.generate(
+            prompts,
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+            strip_prompt=True,
+        )
+        chunks = list(
+            self.model.generate_stream(
+                prompts,
+                max_length=20,
+                stop_token_ids=[],
+                tokenizer=self.tokenizer,
+                return_decoded=False,
+                steps_per_chunk=4,
+            )
+        )
+        self.assertGreater(len(chunks), 1)
+        for i in range(len(prompts)):
+            streamed = np.concatenate([chunk[i] for chunk in chunks])
+            num_tokens = int(np.sum(expected["padding_mask"][i]))
+            np.testing.assert_array_equal(
+                streamed, expected["token_ids"][i, :num_tokens]
+            )
+
+        text = self.model.generate(
+            prompts[0], max_length=20, tokenizer=self.tokenizer, strip_prompt=True
+        )
+        streamed_text = "".join(
+            chunk[0]
+            for chunk in self.model.generate_stream(
+                prompts[0], max_length=20, tokenizer=self.tokenizer
+            )
+        )
+        self.assertEqual(streamed_text, text[0])
+
+    @timeout(300)
+    def test_beam_search(self):
+        prompts = ["hello world", "what is the capital of France?"]
+        kwargs = dict(
+            max_length=20,
+            stop_token_ids=[],
+            tokenizer=self.tokenizer,
+            return_decoded=False,
+        )
+        batched = self.model.generate(prompts, num_beams=4, **kwargs)
+        self.assertEqual(batched["token_ids"].shape[0], len(prompts))
+        # Beams are part of the batch, so prompts do not affect each other.
+        for i, prompt in enumerate(prompts):
+            single = self.model.generate(prompt, num_beams=4, **kwargs)
+            num_tokens = int(np.sum(single["padding_mask"][0]))
+            np.testing.assert_array_equal(
+                batched["token_ids"][i, :num_tokens], single["token_ids"][0, :num_tokens]
+            )
+
+        with self.assertRaises(ValueError):
+            self.model.generate(
+                prompts, num_beams=4, sampling_params=SamplingParams(temperature=1.0), **kwargs
+            )
+
+    @timeout(30)
+    def test_speculative_decoding_is_not_supported(self):
+        with self.assertRaises(ValueError):
+            self.model.generate(
+                self.test_prompt,
+                max_length=20,
+                tokenizer=self.tokenizer,
+                draft_model=self.model,
+            )
+
+    @timeout(200)
+    def test_embed(self):
+        prompts = [self.test_prompt, "what is the capital of France?"]
+        embeddings = self.model.embed(prompts, tokenizer=self.tokenizer, max_length=16)
+        self.assertEqual(embeddings.dtype, np.float16)
+        self.assertEqual(embeddings.shape[0], 2)
+        # Padding does not change the embedding.
+        np.testing.assert_allclose(
+            self.model.embed(prompts[:1], tokenizer=self.tokenizer, max_length=8),
+            embeddings[:1],
+            rtol=1e-2,
+            atol=1e-2,
+        )
+        embeddings = self.model.embed(
+            prompts, layer=0, pooling="last", normalize=True,
+            tokenizer=self.tokenizer, max_length=16,
+        )
+        np.testing.assert_allclose(
+            np.linalg.norm(embeddings.astype(np.float32), axis=-1), 1.0, rtol=1e-2
+        )
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -0,0 +1,82 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for MaxTextModel.quantize_for_inference()
+
+Run test on a TPU VM: python -m unittest tests/model/maxtext/test_quantization.py
+"""
+
+import unittest
+import numpy as np
+from kithara import MaxTextModel, Model
+import time
+import jax
+import jax.numpy as jnp
+from tests.test_utils import timeout
+import os
+
+
+@unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+class TestQuantizeForInference(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = MaxTextModel.from_random("gemma2-2b", seq_len=100)
+        cls.model.quantize_for_inference("int4")
+
+    def setUp(self):
+        print(f"\nStarting test: {self._testMethodName}")
+        self.start_time = time.time()
+
+    def tearDown(self):
+        duration = time.time() - self.start_time
+        print(f"Completed test: {self._testMethodName} in {duration:.2f} seconds\n")
+
+    @timeout(30)
+    def test_kernels_have_per_channel_scales(self):
+        self.assertEqual(self.model.quantization_mode, "int4")
+        for path, quantized in self.model._quantized_values.items():
+            self.assertTrue(path.endswith("-kernel"))
+            self.assertEqual(quantized.values.dtype, jnp.int4)
+            # The output features of every kernel have their own scale.
+            self.assertEqual(quantized.scale.shape[-1], quantized.shape[-1])
+            if path.endswith("-out-kernel"):
+                self.assertEqual(quantized.scale.shape[:2], (1, 1))
+
+    @timeout(200)
+    def test_generate_with_kv_cache_matches_full_forward_pass(self):
+        segment_ids = np.zeros((jax.device_count(), 100), dtype=np.int32)
+        segment_ids[:, :10] = 1
+
+        def make_prompt():
+            return {
+                "tokens": np.array([[i for i in range(100)]] * jax.device_count()),
+                "positions": np.array([[i for i in range(100)]] * jax.device_count()),
+                "segment_ids": segment_ids.copy(),
+            }
+
+        cached = self.model._generate(make_prompt(), max_length=15)
+        uncached = Model._generate(
+            self.model,
+            make_prompt(),
+            max_length=15,
+            tokens_key="tokens",
+            padding_mask_key="segment_ids",
+        )
+        np.testing.assert_array_equal(cached["token_ids"], uncached["token_ids"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,135 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Unit tests for the chunked cross entropy.
+
+Run test on a single host VM: python -m unittest tests/trainer/test_losses.py
+"""
+
+import unittest
+import jax
+import jax.numpy as jnp
+import numpy as np
+from kithara.trainer.losses import chunked_cross_entropy, gather_supervised_positions
+
+
+def head_fn(trainable_values, frozen_values, hidden_states):
+    (kernel,) = trainable_values
+    (bias,) = frozen_values
+    # Soft-capped logits, as in Gemma 2.
+    return jnp.tanh((hidden_states @ kernel + bias) / 3.0) * 3.0
+
+
+class TestChunkedCrossEntropy(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.hidden_states = rng.normal(size=(2, 7, 4)).astype(np.float32)
+        self.kernel = rng.normal(size=(4, 11)).astype(np.float32)
+        self.bias = rng.normal(size=(11,)).astype(np.float32)
+        self.labels = rng.randint(0, 11, size=(2, 7)).astype(np.int32)
+        self.mask = rng.rand(2, 7) > 0.3
+
+    def full_cross_entropy(self, kernel, bias, hidden_states):
+        log_probs = jax.nn.log_softmax(head_fn([kernel], [bias], hidden_states))
+        nll = -jnp.take_along_axis(log_probs, self.labels[..., None], axis=-1)[..., 0]
+        return jnp.sum(nll * self.mask) / np.sum(self.mask)
+
+    def chunked_cross_entropy(self, kernel, bias, hidden_states, chunk_size):
+        return chunked_cross_entropy(
+            head_fn,
+            [kernel],
+            [bias],
+            hidden_states,
+            self.labels,
+            self.mask,
+            chunk_size,
+        )
+
+    def test_matches_full_cross_entropy(self):
+        expected = self.full_cross_entropy(self.kernel, self.bias, self.hidden_states)
+        # The sequence length is not a multiple of the chunk size for 2 and 3.
+        for chunk_size in [1, 2, 3, 7, 16]:
+            loss = jax.jit(self.chunked_cross_entropy, static_argnums=3)(
+                self.kernel, self.bias, self.hidden_states, chunk_size
+            )
+            np.testing.assert_allclose(loss, expected, rtol=1e-5)
+
+    def test_gradients_match_full_cross_entropy(self):
+        expected = jax.grad(self.full_cross_entropy, argnums=(0, 2))(
+            self.kernel, self.bias, self.hidden_states
+        )
+        grads = jax.jit(
+            jax.grad(self.chunked_cross_entropy, argnums=(0, 1, 2)), static_argnums=3
+        )(self.kernel, self.bias, self.hidden_states, 3)
+        np.testing.assert_allclose(grads[0], expected[0], rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(grads[2], expected[1], rtol=1e-4, atol=1e-6)
+        # Frozen values do not receive a gradient.
+        np.testing.assert_array_equal(grads[1], 0)
+
+    def test_fully_masked_batch(self):
+        self.mask = np.zeros_like(self.mask)
+        loss = self.chunked_cross_entropy(self.kernel, self.bias, self.hidden_states, 3)
+        self.assertEqual(float(loss), 0.0)
+
+
+class TestGatherSupervisedPositions(unittest.TestCase):
+
+    def setUp(self):
+        self.hidden_states = np.arange(2 * 5 * 3, dtype=np.float32).reshape(2, 5, 3)
+        self.labels = np.arange(10, dtype=np.int32).reshape(2, 5)
+        self.mask = np.array([[0, 0, 1, 1, 0], [0, 1, 1, 1, 1]], dtype=bool)
+
+    def test_gathers_masked_positions_in_order(self):
+        hidden_states, labels, mask, num_dropped = gather_supervised_positions(
+            self.hidden_states, self.labels, self.mask, token_budget=7
+        )
+        self.assertEqual(int(num_dropped), 0)
+        # The budget is rounded up to a multiple of the batch size.
+        self.assertEqual(hidden_states.shape, (2, 4, 3))
+        np.testing.assert_array_equal(labels[mask], [2, 3, 6, 7, 8, 9])
+        np.testing.assert_array_equal(
+            hidden_states[mask], self.hidden_states[self.mask]
+        )
+        np.testing.assert_array_equal(mask, [[1, 1, 1, 1], [1, 1, 0, 0]])
+
+    def test_drops_positions_beyond_budget(self):
+        _, labels, mask, num_dropped = gather_supervised_positions(
+            self.hidden_states, self.labels, self.mask, token_budget=4
+        )
+        # The last positions of the batch are dropped, and counted.
+        np.testing.assert_array_equal(labels, [[2, 3], [6, 7]])
+        self.assertTrue(np.all(mask))
+        self.assertEqual(int(num_dropped), 2)
+
+    def test_loss_matches_loss_of_all_positions(self):
+        rng = np.random.RandomState(0)
+        kernel = rng.normal(size=(3, 11)).astype(np.float32) / 10
+        bias = np.zeros(11, np.float32)
+        expected = chunked_cross_entropy(
+            head_fn, [kernel], [bias], self.hidden_states, self.labels, self.mask, 5
+        )
+        hidden_states, labels, mask, _ = gather_supervised_positions(
+            self.hidden_states, self.labels, self.mask, token_budget=6
+        )
+        loss = chunked_cross_entropy(
+            head_fn, [kernel], [bias], hidden_states, labels, mask, 3
+        )
+        np.testing.assert_allclose(loss, expected, rtol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
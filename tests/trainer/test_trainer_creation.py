@@ -34,6 +34,9 @@ import ray
 from kithara.utils.gcs_utils import find_cache_root_dir
 import shutil
 import keras 
+import itertools
+import jax
+import numpy as np
 
 
 class TestRunningSFT(unittest.TestCase):
@@ -64,7 +67,8 @@ class TestRunningSFT(unittest.TestCase):
             scan_layers=True,
         )
 
-    def _create_dataloaders(self):
+    def _create_dataloaders(self, per_device_batch_size=None):
+        per_device_batch_size = per_device_batch_size or self.PER_DEVICE_BATCH_SIZE
         dataset_items = [
             {"text": f"{i} What is your name? My name is Mary."} for i in range(100)
         ]
@@ -83,12 +87,12 @@ class TestRunningSFT(unittest.TestCase):
         )
         train_dataloader = Dataloader(
             train_dataset,
-            per_device_batch_size=self.PER_DEVICE_BATCH_SIZE,
+            per_device_batch_size=per_device_batch_size,
             dataset_is_sharded_per_host=False,
         )
         eval_dataloader = Dataloader(
             eval_dataset,
-            per_device_batch_size=self.PER_DEVICE_BATCH_SIZE,
+            per_device_batch_size=per_device_batch_size,
             dataset_is_sharded_per_host=False,
         )
 
@@ -199,5 +203,277 @@ class TestRunningSFT(unittest.TestCase):
         # Start training
         trainer.train()
 
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_loss_from_hidden_states_matches_full_loss(self):
+
+        train_dataloader, _ = self._create_dataloaders()
+        model = self._create_model()
+        optimizer = keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE)
+        trainer = Trainer(
+            model=model,
+            optimizer=optimizer,
+            train_dataloader=train_dataloader,
+            steps=2,
+        )
+        batch = trainer._prepare_batch_input_for_training(
+            next(iter(train_dataloader))
+        )
+        trainable_variables, non_trainable_variables = trainer._get_jax_state(
+            trainable_variables=True, non_trainable_variables=True
+        )
+
+        def loss_and_grads(loss_chunk_size=None, loss_token_budget=None):
+            trainer.loss_chunk_size = loss_chunk_size
+            trainer.loss_token_budget = loss_token_budget
+            (loss, _), grads = jax.jit(trainer.grad_fn)(
+                trainable_variables, non_trainable_variables, batch["x"], batch["y"]
+            )
+            return loss, grads
+
+        expected_loss, expected_grads = loss_and_grads()
+        # The prompts are short, so every label fits in the token budget.
+        token_budget = 32 * trainer.global_batch_size
+        for kwargs in [
+            dict(loss_chunk_size=32),
+            dict(loss_token_budget=token_budget),
+            dict(loss_chunk_size=8, loss_token_budget=token_budget),
+        ]:
+            loss, grads = loss_and_grads(**kwargs)
+            np.testing.assert_allclose(loss, expected_loss, rtol=1e-2)
+            for grad, expected_grad in zip(grads, expected_grads):
+                grad = np.asarray(grad, np.float32)
+                expected_grad = np.asarray(expected_grad, np.float32)
+                self.assertLessEqual(
+                    np.linalg.norm(grad - expected_grad),
+                    5e-2 * np.linalg.norm(expected_grad) + 1e-6,
+                )
+
+        trainer.train()
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_gradient_accumulation_matches_full_batch(self):
+
+        train_dataloader, _ = self._create_dataloaders(per_device_batch_size=4)
+        model = self._create_model()
+        optimizer = keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE)
+        trainer = Trainer(
+            model=model,
+            optimizer=optimizer,
+            train_dataloader=train_dataloader,
+            steps=2,
+            gradient_accumulation_steps=2,
+        )
+        batch = trainer._prepare_batch_input_for_training(
+            next(iter(train_dataloader))
+        )
+        trainable_variables, non_trainable_variables = trainer._get_jax_state(
+            trainable_variables=True, non_trainable_variables=True
+        )
+
+        def loss_and_grads(gradient_accumulation_steps):
+            trainer.gradient_accumulation_steps = gradient_accumulation_steps
+            loss, _, grads = jax.jit(trainer._compute_gradients)(
+                trainable_variables, non_trainable_variables, batch["x"], batch["y"]
+            )
+            return loss, grads
+
+        expected_loss, expected_grads = loss_and_grads(1)
+        for gradient_accumulation_steps in [2, 4]:
+            loss, grads = loss_and_grads(gradient_accumulation_steps)
+            np.testing.assert_allclose(loss, expected_loss, rtol=1e-2)
+            for grad, expected_grad in zip(grads, expected_grads):
+                grad = np.asarray(grad, np.float32)
+                expected_grad = np.asarray(expected_grad, np.float32)
+                self.assertLessEqual(
+                    np.linalg.norm(grad - expected_grad),
+                    5e-2 * np.linalg.norm(expected_grad) + 1e-6,
+                )
+
+        trainer.gradient_accumulation_steps = 2
+        trainer.train()
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_multi_step_dispatch_matches_single_steps(self):
+
+        train_dataloader, eval_dataloader = self._create_dataloaders()
+        model = self._create_model()
+        optimizer = keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE)
+        trainer = Trainer(
+            model=model,
+            optimizer=optimizer,
+            train_dataloader=train_dataloader,
+            eval_dataloader=eval_dataloader,
+            steps=10,
+            eval_steps_interval=5,
+            steps_per_dispatch=3,
+        )
+        batches = [
+            trainer._prepare_batch_input_for_training(batch)
+            for batch in itertools.islice(train_dataloader, 3)
+        ]
+
+        def get_state():
+            return trainer._get_jax_state(
+                trainable_variables=True,
+                non_trainable_variables=True,
+                optimizer_variables=True,
+            )
+
+        state = get_state()
+        expected_losses = []
+        for batch in batches:
+            loss, state = jax.jit(trainer._train_step)(state, batch)
+            expected_losses.append(float(loss))
+        losses, multi_step_state = jax.jit(trainer._multi_train_step)(
+            get_state(), batches
+        )
+        np.testing.assert_allclose(losses, expected_losses, rtol=1e-2)
+        for value, expected_value in zip(
+            jax.tree_util.tree_leaves(multi_step_state), jax.tree_util.tree_leaves(state)
+        ):
+            np.testing.assert_allclose(
+                np.asarray(value, np.float32),
+                np.asarray(expected_value, np.float32),
+                rtol=1e-2,
+                atol=1e-3,
+            )
+
+        # Dispatches end after steps 3, 5, 8 and 10, where the model is
+        # evaluated or the training ends.
+        trainer.train()
+        self.assertEqual(trainer.step_count, 10)
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_train_with_non_blocking_metrics(self):
+
+        train_dataloader, eval_dataloader = self._create_dataloaders()
+        model = self._create_model()
+        learning_rate = keras.optimizers.schedules.PolynomialDecay(
+            self.LEARNING_RATE, decay_steps=12, end_learning_rate=0.0
+        )
+        optimizer = keras.optimizers.AdamW(learning_rate=learning_rate)
+        trainer = Trainer(
+            model=model,
+            optimizer=optimizer,
+            train_dataloader=train_dataloader,
+            eval_dataloader=eval_dataloader,
+            steps=12,
+            eval_steps_interval=6,
+            log_steps_interval=self.LOG_STEPS_INTERVAL,
+            steps_per_dispatch=2,
+            non_blocking_metrics=True,
+        )
+        logged_steps = []
+        trainer.callbacks.append(
+            keras.callbacks.LambdaCallback(
+                on_train_batch_end=lambda step, logs: logged_steps.append(
+                    (step, logs["loss"], logs["learning_rate"])
+                )
+            )
+        )
+        trainer.train()
+        # Every step is still logged once, in order, with a finite loss.
+        self.assertEqual([step for step, _, _ in logged_steps], list(range(1, 13)))
+        self.assertTrue(all(np.isfinite(loss) for _, loss, _ in logged_steps))
+        # The learning rate of every step is logged, not the one of the last
+        # step whose loss was fetched.
+        for step, _, step_learning_rate in logged_steps:
+            np.testing.assert_allclose(
+                step_learning_rate, self.LEARNING_RATE * (1 - step / 12), rtol=1e-5
+            )
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_lazy_state_sync_matches_eager_state_sync(self):
+
+        def train(lazy_state_sync):
+            train_dataloader, eval_dataloader = self._create_dataloaders()
+            model = self._create_model()
+            trainer = Trainer(
+                model=model,
+                optimizer=keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE),
+                train_dataloader=train_dataloader,
+                eval_dataloader=eval_dataloader,
+                steps=4,
+                eval_steps_interval=2,
+                log_steps_interval=self.LOG_STEPS_INTERVAL,
+                tensorboard_dir=os.path.join(self.TMP_DIR, "tensorboard"),
+                lazy_state_sync=lazy_state_sync,
+            )
+            trainer.train()
+            self.assertFalse(trainer._model_state_is_stale)
+            return [np.asarray(v.value) for v in model.trainable_variables]
+
+        # TensorBoard reads the optimizer variables after every step and
+        # evaluation, and variables are written back at the end of training.
+        for lazy, eager in zip(train(True), train(False)):
+            np.testing.assert_allclose(lazy, eager, rtol=1e-5, atol=1e-5)
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_sharding_is_validated_once_per_compilation(self):
+
+        train_dataloader, _ = self._create_dataloaders()
+        trainer = Trainer(
+            model=self._create_model(),
+            optimizer=keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE),
+            train_dataloader=train_dataloader,
+            steps=6,
+            log_steps_interval=self.LOG_STEPS_INTERVAL,
+        )
+        trainer.train()
+        # The train step is compiled for the initial state, and at most once
+        # more if the state returned by the first step is sharded differently.
+        self.assertIn(len(trainer.sharding_reports), [1, 2])
+        for report in trainer.sharding_reports:
+            self.assertTrue(report.is_sharded, str(report))
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_sharding_validation_without_compilation_count(self):
+
+        train_dataloader, _ = self._create_dataloaders()
+        trainer = Trainer(
+            model=self._create_model(),
+            optimizer=keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE),
+            train_dataloader=train_dataloader,
+            steps=6,
+            log_steps_interval=self.LOG_STEPS_INTERVAL,
+        )
+        # A step function that does not expose its number of compilations.
+        train_step = trainer.train_step
+        trainer.train_step = lambda state, data: train_step(state, data)
+        self.assertIsNone(trainer._num_compilations(trainer.train_step))
+        trainer.train()
+        # Every step is validated, but reports are deduplicated by the
+        # sharding signature of the inputs.
+        self.assertIn(len(trainer.sharding_reports), [1, 2])
+        for report in trainer.sharding_reports:
+            self.assertTrue(report.is_sharded, str(report))
+
+    @unittest.skipIf(int(os.getenv('RUN_LIGHT_TESTS_ONLY', 0)) == 1, "Heavy Test")
+    def test_token_throughput_excludes_padding(self):
+
+        train_dataloader, _ = self._create_dataloaders()
+        trainer = Trainer(
+            model=self._create_model(),
+            optimizer=keras.optimizers.AdamW(learning_rate=self.LEARNING_RATE),
+            train_dataloader=train_dataloader,
+            steps=4,
+            log_steps_interval=self.LOG_STEPS_INTERVAL,
+        )
+        step_logs = []
+        trainer.callbacks.append(
+            keras.callbacks.LambdaCallback(
+                on_train_batch_end=lambda step, logs: step_logs.append(logs)
+            )
+        )
+        trainer.train()
+        self.assertEqual(len(step_logs), 4)
+        for logs in step_logs:
+            # The samples are much shorter than SEQ_LEN.
+            tokens_per_sample = logs["tokens_per_second"] / logs["samples_per_second"]
+            self.assertGreater(tokens_per_sample, 0)
+            self.assertLess(tokens_per_sample, self.SEQ_LEN / 2)
+            # MFU is only reported for models with a known configuration.
+            self.assertNotIn("mfu", logs)
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)